@@ -0,0 +1,307 @@
+"""Accelerator for pickall.
+
+This subclasses the C implementation of pickle's Pickler, so that all of the
+standard types are pickled at native speed. Only the objects that pickall
+knows how to pickle and pickle doesn't (functions, classes pickled by value,
+modules, code objects, cells, compiled regular expressions, generators,
+coroutines and the dispatch_singletons) are handed to Python, by way of
+reducer_override.
+
+reducer_override was added in Python 3.8; on older versions, importing this
+module raises ImportError, and pickall uses its pure-Python _Pickler without
+trying to. This module imports pickall, but not the other way around:
+pickall imports Pickler and dump from here when they're first used.
+"""
+import pickle
+import types
+import re
+import sys
+import io
+import abc
+
+if sys.version_info < (3, 8):
+    raise ImportError("_pickall needs pickle.Pickler.reducer_override")
+
+from pickall import (
+    _Pickler,
+    _atomic_types,
+    _by_reference,
+    _cached_code,
+    _cell_contents,
+    _check_module_policy,
+    _class_by_value,
+    _class_dicts,
+    _code_args,
+    _generator_reduction,
+    _module_by_value,
+    _module_token,
+    _new_generator,
+    _new_module,
+    _pattern_type,
+    __newobj__,
+    _pruned_globals,
+    _set_generator_state,
+    _shared_globals_module,
+    _slim_code_args,
+    load_code,
+    resolve_location,
+    set_class_namespace,
+    set_function_state,
+    set_module_namespace,
+)
+
+class _Call:
+    """A function call, to be made when unpickling.
+
+    This is the reduce-tuple equivalent of _Pickler.save_function_call;
+    nested calls are just _Call objects in the arguments. _Call objects are
+    callable so that they can also be used as the callable of a reduction."""
+    __slots__ = ('func', 'args')
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self, *args):
+        return self.func(*self.args)(*args)
+
+    def __reduce__(self):
+        return self.func, self.args
+
+def _is_global(obj):
+    """Check whether obj can be found by its __module__ and __qualname__."""
+    module = sys.modules.get(getattr(obj, '__module__', None))
+    if module is None:
+        return False
+    value = module
+    try:
+        for part in obj.__qualname__.split('.'):
+            value = getattr(value, part)
+    except AttributeError:
+        return False
+    return value is obj
+
+def _pure_options(stats=False, frame_size=None, deterministic=False,
+                  **kwargs):
+    """Return whether _Pickler options that Pickler lacks are given."""
+    return bool(stats or frame_size is not None or deterministic)
+
+class Pickler(pickle.Pickler):
+    # The C Pickler reads this at initialisation; it is shared with _Pickler
+    # so that reducers registered on either apply to both.
+    dispatch_table = _Pickler.dispatch_table
+
+    # reducer_dispatch is a dictionary where the keys are the type of object
+    # and the values are reduce_x methods, returning a reduce tuple.
+    # It plays the part of _Pickler.dispatch.
+    reducer_dispatch = {}
+
+    def __new__(cls, *args, **kwargs):
+        # The C Pickler can't be measured as it saves, or change its frame
+        # size or the order it saves things in, so Pickler(...), dump and
+        # dumps use _Pickler for those options.
+        if cls is Pickler and _pure_options(**kwargs):
+            return _Pickler(*args, **kwargs)
+        return super().__new__(cls)
+
+    def __init__(self, file, protocol=None, *args, prune_globals=False,
+                 code_cache=None, buffer_threshold=1024, slim=False,
+                 module_policy='auto', stats=False, frame_size=None,
+                 deterministic=False, **kwargs):
+        if _pure_options(stats=stats, frame_size=frame_size,
+                         deterministic=deterministic):
+            raise TypeError("stats, frame_size and deterministic need "
+                            "pickall._Pickler")
+        super().__init__(file, protocol, *args, **kwargs)
+        # The C Pickler doesn't expose its protocol, but the reducers need it.
+        if protocol is None:
+            protocol = pickle.DEFAULT_PROTOCOL
+        elif protocol < 0:
+            protocol = pickle.HIGHEST_PROTOCOL
+        self.proto = protocol
+        self._buffer_callback = kwargs.get(
+            'buffer_callback', args[1] if len(args) > 1 else None)
+        # See _Pickler.__init__
+        self.code_cache = code_cache
+        self.buffer_threshold = buffer_threshold
+        self.slim = slim
+        self.prune_globals = prune_globals
+        self._pruned_globals = {}
+        _check_module_policy(module_policy)
+        self.module_policy = module_policy
+        # The C Pickler doesn't say when a function has been memoized, or
+        # what's in its memo, so cells whose contents might refer back to
+        # the function (directly or not) are saved empty, and filled in by
+        # its state_setter; see reduce_function.
+        self._unfilled_cells = set()
+
+    def clear_memo(self):
+        super().clear_memo()
+        self._pruned_globals.clear()
+        self._unfilled_cells.clear()
+
+    def reset(self):
+        # See _Pickler.reset
+        self.clear_memo()
+
+    def out_of_band(self, value):
+        """Wrap a large bytes or bytearray, so that it's offered to the
+        buffer_callback; tuples (such as co_consts) are wrapped item by item.
+
+        See _Pickler.save_out_of_band. The C Pickler doesn't call
+        reducer_override for these types, so this is used on the arguments
+        of reductions instead: code objects' fields and pruned globals.
+        _Pickler.allow_out_of_band allows the same ones."""
+        if self._buffer_callback is None:
+            return value
+        if type(value) is tuple:
+            return tuple(map(self.out_of_band, value))
+        if (type(value) in (bytes, bytearray) and
+                len(value) >= self.buffer_threshold):
+            return _Call(type(value), pickle.PickleBuffer(value))
+        return value
+
+    def reducer_override(self, obj):
+        # _Pickler.dispatch_singletons has priority over dispatch_x
+        singleton = self.reducer_singletons.get(id(obj))
+        if singleton is not None:
+            return singleton()
+
+        reduce = self.reducer_dispatch.get(type(obj))
+        if reduce is None:
+            return NotImplemented
+        return reduce(self, obj)
+
+    def reduce_type(self, obj):
+        # See _Pickler.save_type; this needs doing here because the C
+        # save_global doesn't use pickall's whichmodule.
+        location = resolve_location(obj)
+        if location is None:
+            if _class_by_value(obj):
+                # See _Pickler.save_class
+                created, namespace = _class_dicts(obj, self.slim)
+                return (type(obj), (obj.__name__, obj.__bases__, created),
+                        namespace or None, None, None, set_class_namespace)
+            return NotImplemented
+        module_name, qualname = location
+        # __import__, unlike importlib.import_module, is a builtin so it will
+        # be pickled by reference; a non-empty fromlist makes it return the
+        # module itself instead of the top-level package.
+        return getattr, (_Call(__import__, module_name, None, None, ('*',)),
+                         qualname)
+    reducer_dispatch[type] = reduce_type
+    reducer_dispatch[abc.ABCMeta] = reduce_type  # See _class_metaclasses
+
+    def reduce_function(self, obj):
+        # See _Pickler.save_function
+        if obj in _by_reference or (obj.__module__ in ('ctypes',) and
+                                    _is_global(obj)):
+            return NotImplemented
+
+        func = types.FunctionType
+        pre_args = ()
+        if self.proto >= 2:
+            pre_args = (func,)
+            func = __newobj__
+
+        globals_ = obj.__globals__
+        new_globals = new_builtins = {}
+        if self.prune_globals:
+            globals_, new_globals, new_builtins = _pruned_globals(
+                self._pruned_globals, obj)
+            new_globals = {name: self.out_of_band(value)
+                           for name, value in new_globals.items()}
+        else:
+            globals_ = self.module_dict(globals_)
+        args = pre_args + (obj.__code__, globals_, obj.__name__,
+                           obj.__defaults__, obj.__closure__)
+
+        cells = []
+        for cell_ in obj.__closure__ or ():
+            contents = _cell_contents(cell_)
+            if contents and type(contents[0]) not in _atomic_types:
+                self._unfilled_cells.add(id(cell_))
+                cells.append((cell_, contents[0]))
+
+        annotations = {} if self.slim else obj.__annotations__
+        if (annotations or obj.__kwdefaults__ or
+                new_globals or new_builtins or cells):
+            # __annotations__ and __kwdefaults__ are descriptors, so they
+            # have to be set by a state_setter instead of BUILD. The pruned
+            # globals and unfilled cells are set there too, so that they're
+            # pickled after the function is memoized.
+            state = (vars(obj), annotations, obj.__kwdefaults__,
+                     new_globals, new_builtins, cells)
+            return func, args, state, None, None, set_function_state
+        return func, args, vars(obj)
+    reducer_dispatch[types.FunctionType] = reduce_function
+
+    def module_dict(self, obj):
+        """Return obj, or a call to vars(module) if it's the __dict__ of a
+        module that _shared_globals_module picks; see
+        _Pickler.save_module_dict."""
+        module = _shared_globals_module(obj, self.module_policy)
+        if module is None:
+            return obj
+        return _Call(vars, module)
+
+    def reduce_module(self, obj):
+        # See _Pickler.save_module. The C Pickler can't memoize the module's
+        # __dict__ as vars(module), so functions' globals are saved as calls
+        # to it instead, by module_dict.
+        if not _module_by_value(obj, self.module_policy):
+            return __import__, (obj.__name__, None, None, ('*',))
+        namespace = vars(obj)
+        builtins_ = namespace.get('__builtins__')
+        if type(builtins_) is dict:
+            namespace = dict(namespace,
+                             __builtins__=self.module_dict(builtins_))
+        return (_new_module, (obj.__name__, _module_token(obj)), namespace,
+                None, None, set_module_namespace)
+    reducer_dispatch[types.ModuleType] = reduce_module
+
+    def reduce_code(self, obj):
+        # See _Pickler.save_code
+        if self.code_cache is not None:
+            return load_code, self.out_of_band(
+                _cached_code(self.code_cache, obj, self.slim))
+        args = self.out_of_band(
+            _slim_code_args(obj) if self.slim else _code_args(obj))
+        if self.proto >= 2:
+            return __newobj__, (types.CodeType,) + args
+        return types.CodeType, args
+    reducer_dispatch[types.CodeType] = reduce_code
+
+    def reduce_cell(self, obj):
+        # See _Pickler.save_cell
+        if id(obj) in self._unfilled_cells:
+            return types.CellType, ()
+        return types.CellType, _cell_contents(obj)
+    reducer_dispatch[types.CellType] = reduce_cell
+
+    def reduce_compiled_regex(self, obj):
+        # See _Pickler.save_compiled_regex
+        return re._compile, (obj.pattern, obj.flags)
+    reducer_dispatch[_pattern_type] = reduce_compiled_regex
+
+    def reduce_generator(self, obj):
+        # See _Pickler.save_generator
+        func, qualname, state = _generator_reduction(obj)
+        return (_new_generator, (func, qualname), state, None, None,
+                _set_generator_state)
+    reducer_dispatch[types.GeneratorType] = reduce_generator
+    reducer_dispatch[types.CoroutineType] = reduce_generator
+
+    # reducer_singletons is like _Pickler.dispatch_singletons, but the values
+    # return a reduce tuple. types.CellType exists on every Python version
+    # that this module supports, so it's currently empty.
+    reducer_singletons = {}
+
+# Shorthands
+def dump(obj, file, protocol=None, *, fix_imports=True, **kwargs):
+    Pickler(file, protocol, fix_imports=fix_imports, **kwargs).dump(obj)
+
+def dumps(obj, protocol=None, *, fix_imports=True, **kwargs):
+    f = io.BytesIO()
+    Pickler(f, protocol, fix_imports=fix_imports, **kwargs).dump(obj)
+    return f.getvalue()
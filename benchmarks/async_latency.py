@@ -0,0 +1,74 @@
+"""Compare event loop latency while pickling with dumps and dump_async.
+
+A task that sleeps for 1 ms at a time records how late it wakes up, while a
+large closure is pickled and sent over a local connection, either with
+_dumps and StreamWriter.write or with dump_async.
+
+Usage: python benchmarks/async_latency.py [list length]
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickall
+
+def make_closure(length):
+    data = [(i, str(i)) for i in range(length)]
+    def closure():
+        return len(data)
+    return closure
+
+async def measure(send, obj):
+    delays = []
+    done = False
+
+    async def tick():
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            delays.append(time.perf_counter() - start - 0.001)
+
+    async def discard(reader, writer):
+        while await reader.read(1 << 16):
+            pass
+        writer.close()
+
+    server = await asyncio.start_server(discard, '127.0.0.1', 0)
+    port = server.sockets[0].getsockname()[1]
+    _, writer = await asyncio.open_connection('127.0.0.1', port)
+    ticker = asyncio.ensure_future(tick())
+    await asyncio.sleep(0.05)
+    start = time.perf_counter()
+    await send(obj, writer)
+    elapsed = time.perf_counter() - start
+    done = True
+    await ticker
+    writer.close()
+    await asyncio.sleep(0.05)  # Let discard finish
+    server.close()
+    delays.sort()
+    return elapsed, delays[int(len(delays) * 0.99)], delays[-1]
+
+async def send_dumps(obj, writer):
+    writer.write(pickall._dumps(obj, 4, prune_globals=True))
+    await writer.drain()
+
+async def send_dump_async(obj, writer):
+    await pickall.dump_async(obj, writer, 4, prune_globals=True)
+
+def main(length):
+    obj = make_closure(length)
+    loop = asyncio.new_event_loop()
+    print("{:>12} {:>10} {:>14} {:>14}".format(
+        "", "total (s)", "p99 delay (ms)", "max delay (ms)"))
+    for name, send in (("dumps", send_dumps),
+                       ("dump_async", send_dump_async)):
+        elapsed, p99, worst = loop.run_until_complete(measure(send, obj))
+        print("{:>12} {:>10.2f} {:>14.2f} {:>14.2f}".format(
+            name, elapsed, p99 * 1e3, worst * 1e3))
+    loop.close()
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
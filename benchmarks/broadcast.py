@@ -0,0 +1,62 @@
+"""Compare broadcasting a large closure to worker processes through pipes
+and with pickall.share.
+
+The closure refers to a large bytes global, like a model's weights. With
+pipes, the pickle is sent to every worker and loaded from there; with share,
+it's written to a shared memory segment once, and each worker is only sent
+the segment's handle. Each worker loads it and calls it once. Pools are
+started before timing. Needs Python 3.8+.
+
+Usage: python benchmarks/broadcast.py [megabytes [worker counts...]]
+"""
+import multiprocessing
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickall
+
+WEIGHTS = b""
+
+def make_scorer():
+    def score(x):
+        return WEIGHTS[x % len(WEIGHTS)] * x
+    return score
+
+def score_pickle(data):
+    return pickall.loads(data)(1)
+
+def score_shared(handle):
+    return handle.load()(1)
+
+def broadcast(pool, workers, func, arg):
+    start = time.perf_counter()
+    results = pool.map(func, [arg] * workers, chunksize=1)
+    assert len(set(results)) == 1
+    return time.perf_counter() - start
+
+def main(megabytes, counts):
+    global WEIGHTS
+    WEIGHTS = bytes(range(256)) * (megabytes * 4096)
+    scorer = make_scorer()
+    print("payload: {} MB".format(megabytes))
+    print("{:>8} {:>12} {:>12}".format("workers", "pipes (ms)", "share (ms)"))
+    for workers in counts:
+        with multiprocessing.Pool(workers) as pool:
+            pool.map(abs, range(workers))  # Start them all
+            start = time.perf_counter()
+            data = pickall.dumps(scorer, prune_globals=True)
+            pipes = time.perf_counter() - start
+            pipes += broadcast(pool, workers, score_pickle, data)
+            start = time.perf_counter()
+            with pickall.share(scorer, prune_globals=True) as shared:
+                shared_time = time.perf_counter() - start
+                shared_time += broadcast(pool, workers, score_shared,
+                                         shared.handle)
+        print("{:>8} {:>12.1f} {:>12.1f}".format(
+            workers, pipes * 1e3, shared_time * 1e3))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 64,
+         [int(count) for count in sys.argv[2:]] or [1, 2, 4, 8, 16, 32, 64])
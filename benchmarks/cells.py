@@ -0,0 +1,75 @@
+"""Compare the load cost of the old and new ways of pickling cells.
+
+pickall used to rebuild each cell with a chain of ctypes calls:
+getattr(ctypes.cast(ctypes.pythonapi.PyCell_New(ctypes.py_object(x)),
+ctypes.py_object), "value"). It now saves types.CellType(x), or calls a
+by-value _new_cell where types.CellType doesn't exist.
+
+The old chain relies on PyCell_New returning an int, which truncates the
+pointer on 64-bit builds; it's given a c_void_p restype here so that it can
+be measured at all.
+
+Usage: python benchmarks/cells.py [closure counts...]
+"""
+import ctypes
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickle
+import pickall
+
+ctypes.pythonapi.PyCell_New.restype = ctypes.c_void_p
+
+class LegacyCellPickler(pickall._Pickler):
+    dispatch = pickall._Pickler.dispatch.copy()
+
+    def save_cell(self, obj):
+        self.save_function_call(
+            getattr, (1,
+                ctypes.cast, (1,
+                    ctypes.pythonapi.PyCell_New, (1,
+                        ctypes.py_object, (0, obj.cell_contents)
+                    )
+                ),
+                (0, ctypes.py_object)
+            ), (0, "value")
+        )
+    dispatch[pickall.cell] = save_cell
+
+def make_closures(count):
+    def make(i):
+        a, b, c = i, str(i), float(i)
+        def closure():
+            return a, b, c
+        return closure
+    return [make(i) for i in range(count)]
+
+def dumps(Pickler, obj):
+    f = io.BytesIO()
+    Pickler(f, pickle.HIGHEST_PROTOCOL, prune_globals=True).dump(obj)
+    return f.getvalue()
+
+def main(counts):
+    print("{:>8} {:>12} {:>12} {:>12} {:>12}".format(
+        "closures", "old (bytes)", "new (bytes)", "old (ms)", "new (ms)"))
+    for count in counts:
+        closures = make_closures(count)
+        old = dumps(LegacyCellPickler, closures)
+        new = dumps(pickall._Pickler, closures)
+        assert ([f() for f in pickle.loads(old)] ==
+                [f() for f in pickle.loads(new)])
+
+        number = 5
+        old_time = min(timeit.repeat(
+            lambda: pickle.loads(old), number=number, repeat=3))
+        new_time = min(timeit.repeat(
+            lambda: pickle.loads(new), number=number, repeat=3))
+        print("{:>8} {:>12} {:>12} {:>12.2f} {:>12.2f}".format(
+            count, len(old), len(new),
+            old_time / number * 1e3, new_time / number * 1e3))
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [100, 1000, 10000])
@@ -0,0 +1,54 @@
+"""Compare the size and speed of dump_compressed's codecs and levels.
+
+The corpus is the code of every function defined in a few standard library
+modules, as in slim.py: mostly bytecode and tuples of names. Times are for
+the whole dump or load, including pickling, so "none" (dumps_compressed's
+framing, uncompressed) is included for reference, as is compressing the
+whole pickle with zlib afterwards.
+
+Usage: python benchmarks/compression.py [module names...]
+"""
+import io
+import os
+import sys
+import timeit
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickle
+import pickall
+from slim import MODULES, corpus
+
+CODECS = [('zlib', 1), ('zlib', 6), ('zlib', 9), ('lzma', 0), ('lzma', 6),
+          ('bz2', 1), ('bz2', 9)]
+
+def best(func, number=3):
+    return min(timeit.repeat(func, number=number, repeat=7)) / number
+
+def main(module_names):
+    codes = corpus(module_names)
+    pickall.register_codec('none', lambda data, level: bytes(data), bytes)
+    plain = pickall._dumps(codes, 4)
+    print("{} code objects, {} bytes pickled".format(len(codes), len(plain)))
+    print("{:>14} {:>10} {:>8} {:>10} {:>10}".format(
+        "codec", "bytes", "ratio", "dump (ms)", "load (ms)"))
+
+    def row(name, data, dump_time, load_time):
+        print("{:>14} {:>10} {:>8.2f} {:>10.1f} {:>10.1f}".format(
+            name, len(data), len(plain) / len(data),
+            dump_time * 1e3, load_time * 1e3))
+
+    data = zlib.compress(pickall._dumps(codes, 4))
+    row("zlib 6, whole", data,
+        best(lambda: zlib.compress(pickall._dumps(codes, 4))),
+        best(lambda: pickle.loads(zlib.decompress(data))))
+    for codec, level in [('none', None)] + CODECS:
+        data = pickall.dumps_compressed(codes, 4, codec=codec, level=level)
+        assert len(pickall.loads_compressed(data)) == len(codes)
+        row(codec if level is None else "{} {}".format(codec, level), data,
+            best(lambda: pickall.dumps_compressed(codes, 4, codec=codec,
+                                                  level=level)),
+            best(lambda: pickall.loads_compressed(data)))
+
+if __name__ == '__main__':
+    main(sys.argv[1:] or MODULES)
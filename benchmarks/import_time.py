@@ -0,0 +1,65 @@
+"""Measure how long import pickall takes, with python -X importtime.
+
+Each import is done in a new interpreter, several times over, and the
+fastest time for each module is reported: its own time and its cumulative
+time, including what it imports. Only modules taking at least --min-us
+cumulatively are shown. Needs Python 3.7+.
+
+With --max-ms, exits with status 1 if pickall's cumulative time is over it,
+to catch regressions.
+
+Usage: python benchmarks/import_time.py [--runs N] [--min-us US]
+                                        [--max-ms MS] [module]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+# Imports are timed as they usually happen, from .pyc files.
+ENV = dict(os.environ)
+ENV.pop('PYTHONDONTWRITEBYTECODE', None)
+
+def import_times(module):
+    """Return {name: (self_us, cumulative_us)} for one import of module."""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=ROOT, env=ENV, stderr=subprocess.PIPE, universal_newlines=True,
+        check=True)
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(self_us), int(cumulative_us)
+    return times
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('module', nargs='?', default='pickall')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--min-us', type=int, default=500)
+    parser.add_argument('--max-ms', type=float)
+    args = parser.parse_args(args)
+
+    subprocess.run([sys.executable, '-c', 'import ' + args.module],
+                   cwd=ROOT, env=ENV, check=True)  # Write the .pyc files
+    best = {}
+    for _ in range(args.runs):
+        for name, times in import_times(args.module).items():
+            best[name] = min(best.get(name, times), times)
+    print("{:>10} {:>10}  module".format("self (us)", "cumul (us)"))
+    for name, (self_us, cumulative_us) in sorted(
+            best.items(), key=lambda item: item[1][1]):
+        if cumulative_us >= args.min_us:
+            print("{:>10} {:>10}  {}".format(self_us, cumulative_us, name))
+    total = best[args.module][1] / 1000
+    if args.max_ms is not None and total > args.max_ms:
+        print("{} took {:.1f} ms, over the limit of {} ms".format(
+            args.module, total, args.max_ms))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
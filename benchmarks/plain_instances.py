@@ -0,0 +1,60 @@
+"""Compare pickling instances of a plain class with and without a template.
+
+_Pickler saves instances of plain classes (see pickall._plain_class) with
+_save_plain_instance, which writes what object.__reduce_ex__ and save_reduce
+would, without calling them for each instance. ReduceExPickler goes back to
+_save_reduce_ex for them. The class is local, so it's pickled by value.
+
+Times are CPU times, the fastest of several interleaved runs.
+
+Usage: python benchmarks/plain_instances.py [instance counts...]
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickle
+import pickall
+
+class ReduceExPickler(pickall._Pickler):
+    def _compile_plan(self, t):
+        plan = super()._compile_plan(t)
+        if plan is pickall._Pickler._save_plain_instance:
+            return pickall._Pickler._save_reduce_ex
+        return plan
+
+def make_points(count):
+    class Point:
+        def __init__(self, x, y):
+            self.x = x
+            self.y = y
+    return [Point(i, -i) for i in range(count)]
+
+def dumps(Pickler, obj):
+    f = io.BytesIO()
+    Pickler(f, 4, prune_globals=True).dump(obj)
+    return f.getvalue()
+
+def main(counts, runs=20):
+    print("{:>10} {:>15} {:>15}".format(
+        "instances", "reduce_ex (ms)", "template (ms)"))
+    for count in counts:
+        points = make_points(count)
+        assert ([vars(p) for p in pickle.loads(dumps(ReduceExPickler,
+                                                     points))] ==
+                [vars(p) for p in pickle.loads(dumps(pickall._Pickler,
+                                                     points))])
+        best = {ReduceExPickler: float('inf'), pickall._Pickler: float('inf')}
+        for _ in range(runs):
+            for Pickler in best:
+                start = time.process_time()
+                dumps(Pickler, points)
+                best[Pickler] = min(best[Pickler],
+                                    time.process_time() - start)
+        print("{:>10} {:>15.1f} {:>15.1f}".format(
+            count, best[ReduceExPickler] * 1e3, best[pickall._Pickler] * 1e3))
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [1000, 10000])
@@ -0,0 +1,47 @@
+"""Compare the per-call cost of pickall.dumps against a fresh pickler per call.
+
+pickall.dumps reuses a pooled pickler and BytesIO for each thread; before the
+pool, every call made a new BytesIO and Pickler. pickle.dumps is included for
+reference.
+
+Usage: python benchmarks/pooled_dumps.py [calls]
+"""
+import io
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickle
+import pickall
+
+def fresh_dumps(obj, protocol=None):
+    f = io.BytesIO()
+    pickall.Pickler(f, protocol).dump(obj)
+    return f.getvalue()
+
+MESSAGES = {
+    "tuple": (1, "add", 2.5),
+    "dict": {"id": 12345, "method": "get", "params": ["key", None, True]},
+    "list of 100 ints": list(range(100)),
+}
+
+def main(number):
+    print("Pickler: {}.{}".format(pickall.Pickler.__module__,
+                                  pickall.Pickler.__name__))
+    print("{:>18} {:>10} {:>12} {:>12} {:>12}".format(
+        "message", "protocol", "pickle (us)", "fresh (us)", "pooled (us)"))
+    for name, message in MESSAGES.items():
+        for protocol in (2, pickle.HIGHEST_PROTOCOL):
+            assert (fresh_dumps(message, protocol) ==
+                    pickall.dumps(message, protocol))
+            times = [
+                min(timeit.repeat(lambda: dumps(message, protocol),
+                                  number=number, repeat=5)) / number * 1e6
+                for dumps in (pickle.dumps, fresh_dumps, pickall.dumps)
+            ]
+            print("{:>18} {:>10} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+                name, protocol, *times))
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
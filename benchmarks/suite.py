@@ -0,0 +1,271 @@
+"""Measure pickall against pickle over a corpus, for every protocol.
+
+For each corpus, implementation and protocol, this reports how many dumps
+and loads a second there are, the size of the pickle, and the peak memory
+that tracemalloc sees during one dump and one load. The implementations are
+pickle.dumps, pickall.dumps and, when the accelerator is in use, the
+pure-Python pickall._dumps; everything is loaded with pickle.loads. pickle
+can't pickle functions or code objects, so those rows are left blank for it.
+
+The corpora:
+    plain_data: lists and dicts of ints, floats, strs and tuples.
+    small_closures: many small closures, with pruned globals.
+    deep_closures: closures that call each other through their cells.
+    module_globals: functions from a module with thousands of globals,
+        which are pruned to the few they use.
+    regexes: compiled regular expressions.
+    nested_code: the code objects of whole standard library modules, with
+        the functions and classes in them nested in co_consts.
+
+With --json, the results are also written to a file ('-' for stdout); with
+--baseline, they're compared to a file written that way, and this exits with
+status 1 if any of them is worse than it by more than --tolerance.
+
+Usage: python benchmarks/suite.py [--corpus NAME]... [--protocol N]...
+                                  [--min-time S] [--repeat N] [--json FILE]
+                                  [--baseline FILE] [--tolerance T]
+"""
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import timeit
+import tracemalloc
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickle
+import pickall
+
+# Corpora
+def plain_data():
+    return {
+        'ints': list(range(-5000, 5000, 3)),
+        'floats': [i / 7 for i in range(2000)],
+        'strs': ['item {}'.format(i) * (i % 5 + 1) for i in range(2000)],
+        'records': [(i, str(i), i % 3 == 0, None) for i in range(2000)],
+        'index': {str(i): [i, i * 2, {'squared': i * i}]
+                  for i in range(1000)},
+    }
+
+def small_closures():
+    def make_adder(n):
+        return lambda x: x + n
+    return [make_adder(i) for i in range(500)]
+
+def deep_closures(depth=50):
+    def wrap(inner, i):
+        def outer(x):
+            return inner(x) + i
+        return outer
+    func = lambda x: x
+    for i in range(depth):
+        func = wrap(func, i)
+    return [func]
+
+MODULE_GLOBALS_SOURCE = """
+TABLE = {}
+""" + "".join("CONSTANT_{0} = {0}\n".format(i) for i in range(5000)) + """
+def lookup(key):
+    return TABLE.get(key, CONSTANT_1) + CONSTANT_2
+
+def scale(x):
+    return x * CONSTANT_3 - lookup(x)
+"""
+
+def module_globals():
+    module = types.ModuleType('_bench_module_globals')
+    exec(MODULE_GLOBALS_SOURCE, vars(module))
+    return [module.lookup, module.scale] * 10
+
+def regexes():
+    return [re.compile(r'(?P<key>\w+)\s*=\s*(?P<value>[^;]{%d,})' % i,
+                       re.IGNORECASE if i % 2 else 0)
+            for i in range(200)]
+
+def nested_code(module_names=('argparse', 'textwrap')):
+    import importlib
+    codes = []
+    for name in module_names:
+        path = importlib.import_module(name).__file__
+        with open(path, encoding='utf-8') as file:
+            codes.append(compile(file.read(), path, 'exec'))
+    return codes
+
+# Each corpus, with the options that pickall's dumps are given for it
+CORPORA = {
+    'plain_data': (plain_data, {}),
+    'small_closures': (small_closures, {'prune_globals': True}),
+    'deep_closures': (deep_closures, {'prune_globals': True}),
+    'module_globals': (module_globals, {'prune_globals': True}),
+    'regexes': (regexes, {}),
+    'nested_code': (nested_code, {}),
+}
+
+def implementations():
+    implementations = [('pickle', pickle.dumps, False),
+                       ('pickall', pickall.dumps, True)]
+    if pickall.Pickler is not pickall._Pickler:
+        implementations.append(('pickall (pure)', pickall._dumps, True))
+    return implementations
+
+# Measurement
+def ops_per_second(func, min_time, repeat):
+    # Like Timer.autorange, but aiming for min_time, which can be shorter.
+    timer = timeit.Timer(func)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time / 10:
+            break
+        number *= 10
+    number = max(1, round(number * min_time / elapsed))
+    return number / min(timer.repeat(repeat=repeat, number=number))
+
+def peak_memory(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def measure(obj, dumps, options, protocol, min_time, repeat):
+    dump = lambda: dumps(obj, protocol, **options)
+    try:
+        data = dump()
+        pickle.loads(data)
+    except Exception as e:
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+    load = lambda: pickle.loads(data)
+    return {
+        'dump_ops': ops_per_second(dump, min_time, repeat),
+        'load_ops': ops_per_second(load, min_time, repeat),
+        'bytes': len(data),
+        'dump_peak': peak_memory(dump),
+        'load_peak': peak_memory(load),
+    }
+
+def run(corpus_names, protocols, min_time, repeat, file=sys.stdout):
+    results = []
+    for corpus_name in corpus_names:
+        make, options = CORPORA[corpus_name]
+        obj = make()
+        for name, dumps, is_pickall in implementations():
+            for protocol in protocols:
+                result = {'corpus': corpus_name, 'implementation': name,
+                          'protocol': protocol}
+                result.update(measure(obj, dumps,
+                                      options if is_pickall else {},
+                                      protocol, min_time, repeat))
+                results.append(result)
+                print_row(result, file=file)
+    return results
+
+# Reporting
+# Metrics, and whether bigger numbers are better
+METRICS = [('dump_ops', True), ('load_ops', True), ('bytes', False),
+           ('dump_peak', False), ('load_peak', False)]
+
+HEADER = "{:<15} {:<15} {:>5} {:>12} {:>12} {:>10} {:>10} {:>10}".format(
+    "corpus", "implementation", "proto", "dumps/s", "loads/s", "bytes",
+    "dump KiB", "load KiB")
+
+def print_row(result, file=sys.stdout):
+    if 'error' in result:
+        values = ("-",) * 5
+    else:
+        values = ("{:.1f}".format(result['dump_ops']),
+                  "{:.1f}".format(result['load_ops']),
+                  result['bytes'],
+                  "{:.0f}".format(result['dump_peak'] / 1024),
+                  "{:.0f}".format(result['load_peak'] / 1024))
+    print("{:<15} {:<15} {:>5} {:>12} {:>12} {:>10} {:>10} {:>10}".format(
+        result['corpus'], result['implementation'], result['protocol'],
+        *values), file=file)
+
+def compare(results, baseline, tolerance, file=sys.stdout):
+    """Print how each result compares to baseline; return how many are
+    worse than it by more than tolerance."""
+    old_results = {(result['corpus'], result['implementation'],
+                    result['protocol']): result
+                   for result in baseline['results']}
+    print("{:<15} {:<15} {:>5} {:<10} {:>12} {:>12} {:>8}".format(
+        "corpus", "implementation", "proto", "metric", "baseline", "now",
+        "change"), file=file)
+    regressions = 0
+    for result in results:
+        old = old_results.get((result['corpus'], result['implementation'],
+                               result['protocol']))
+        if old is None or 'error' in old or 'error' in result:
+            continue
+        for metric, bigger_is_better in METRICS:
+            change = result[metric] / old[metric] - 1 if old[metric] else 0
+            worse = -change if bigger_is_better else change
+            if worse > tolerance:
+                regressions += 1
+                flag = "  worse"
+            else:
+                flag = ""
+            print("{:<15} {:<15} {:>5} {:<10} {:>12.1f} {:>12.1f} "
+                  "{:>+7.1%}{}".format(
+                      result['corpus'], result['implementation'],
+                      result['protocol'], metric, old[metric],
+                      result[metric], change, flag), file=file)
+    return regressions
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--corpus', action='append', choices=list(CORPORA),
+                        help="a corpus to measure (default: all of them)")
+    parser.add_argument('--protocol', action='append', type=int,
+                        help="a protocol to measure (default: all of them)")
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help="seconds that each timing should take")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timings to take the fastest of")
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results to FILE as JSON")
+    parser.add_argument('--baseline', metavar='FILE',
+                        help="compare the results to a --json FILE")
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help="how much worse than the baseline is allowed")
+    args = parser.parse_args(args)
+
+    # The table goes to stderr if the JSON is going to stdout.
+    out = sys.stderr if args.json == '-' else sys.stdout
+    print("Python {} ({}), Pickler: {}.{}".format(
+        platform.python_version(), platform.python_implementation(),
+        pickall.Pickler.__module__, pickall.Pickler.__name__), file=out)
+    print(HEADER, file=out)
+    results = run(args.corpus or list(CORPORA),
+                  args.protocol or range(pickle.HIGHEST_PROTOCOL + 1),
+                  args.min_time, args.repeat, out)
+    report = {
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'pickler': '{}.{}'.format(pickall.Pickler.__module__,
+                                  pickall.Pickler.__name__),
+        'results': results,
+    }
+    if args.json == '-':
+        json.dump(report, sys.stdout, indent=1)
+        print()
+    elif args.json is not None:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline, args.tolerance, out)
+        if regressions:
+            print("{} results are more than {:.0%} worse than the "
+                  "baseline".format(regressions, args.tolerance), file=out)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,48 @@
+"""Compare the cost of whichmodule lookups against the number of loaded modules.
+
+pickle.whichmodule searches every module in sys.modules for objects without a
+__module__; pickall.whichmodule looks them up in its location index.
+
+Usage: python benchmarks/whichmodule.py [module counts...]
+"""
+import os
+import sys
+import timeit
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+import pickle
+import pickall
+
+def main(counts):
+    print("{:>8} {:>16} {:>16}".format("modules", "pickle (us)", "pickall (us)"))
+    added = []
+    for count in counts:
+        while len(added) < count:
+            module = types.ModuleType("_bench_module_{}".format(len(added)))
+            for i in range(20):
+                setattr(module, "attribute_{}".format(i), object())
+            sys.modules[module.__name__] = module
+            added.append(module)
+
+        # An object with no __module__, in the most recently added module
+        class Target:
+            pass
+        Target.__module__ = None
+        Target.__qualname__ = "Target"
+        added[-1].Target = Target
+
+        number = 20
+        pickle_time = timeit.timeit(
+            lambda: pickle.whichmodule(Target, "Target"), number=number)
+        pickall.whichmodule(Target, "Target")  # Index the new modules
+        pickall_time = timeit.timeit(
+            lambda: pickall.whichmodule(Target, "Target"), number=number)
+        assert (pickall.whichmodule(Target, "Target") ==
+                pickle.whichmodule(Target, "Target"))
+        print("{:>8} {:>16.1f} {:>16.1f}".format(
+            len(sys.modules), pickle_time / number * 1e6,
+            pickall_time / number * 1e6))
+
+if __name__ == '__main__':
+    main([int(count) for count in sys.argv[1:]] or [100, 1000, 5000, 20000])
@@ -5,9 +5,13 @@ import io
 import builtins
 import functools
 import copyreg
-import ctypes
 import sys
-import weakref
+import collections
+import marshal
+import time
+import _thread
+import opcode
+import abc
 
 # Ensure that pickall has the same interface as pickle
 __all__ = pickle.__all__
@@ -17,6 +21,8 @@ UnpicklingError = pickle.UnpicklingError
 Unpickler = pickle.Unpickler
 load = pickle.load
 loads = pickle.loads
+if hasattr(pickle, 'PickleBuffer'):  # Python 3.8+
+    PickleBuffer = pickle.PickleBuffer
 
 # Get references to types without any __qualname__-like reference
 def closure_container(x=None):
@@ -24,9 +30,117 @@ def closure_container(x=None):
 cell = closure_container()
 del closure_container
 
-# Add SHOUTY_VARIABLES from pickle's globals
+# types.CellType was added in Python 3.8; cell_contents is writable from 3.7.
+_CellType = getattr(types, 'CellType', None)
+_cell_contents_writable = sys.version_info >= (3, 7)
+
+# re._pattern_type was renamed to re.Pattern in Python 3.7
+_pattern_type = getattr(re, 'Pattern', None) or type(re.compile(''))
+
+# The positional arguments taken by types.CodeType, which change between
+# Python versions; the names match the attributes of code objects.
+_code_fields = ('co_argcount',)
+if hasattr(types.CodeType, 'co_posonlyargcount'):
+    _code_fields += ('co_posonlyargcount',)
+_code_fields += ('co_kwonlyargcount', 'co_nlocals', 'co_stacksize',
+                 'co_flags', 'co_code', 'co_consts', 'co_names',
+                 'co_varnames', 'co_filename', 'co_name')
+if hasattr(types.CodeType, 'co_qualname'):
+    _code_fields += ('co_qualname',)
+_code_fields += ('co_firstlineno',)
+if sys.version_info >= (3, 10):
+    _code_fields += ('co_linetable',)
+else:
+    _code_fields += ('co_lnotab',)
+if hasattr(types.CodeType, 'co_exceptiontable'):
+    _code_fields += ('co_exceptiontable',)
+_code_fields += ('co_freevars', 'co_cellvars')
+
+def _large_buffers(value, threshold):
+    """Yield the bytes and bytearrays in value that are at least threshold
+    long; tuples (such as co_consts) are searched item by item."""
+    if type(value) is tuple:
+        for item in value:
+            yield from _large_buffers(item, threshold)
+    elif type(value) in (bytes, bytearray) and len(value) >= threshold:
+        yield value
+
+def _code_args(code):
+    """Return the arguments that types.CodeType needs to recreate code."""
+    return tuple(getattr(code, field) for field in _code_fields)
+
+# weakref isn't imported until one of these caches is first used; see
+# _weak_key_cache.
+_slim_code_args_cache = None
+_global_names_cache = None
+
+def _weak_key_cache(name):
+    """Return the WeakKeyDictionary in the global called name, making it if
+    it hasn't been made yet."""
+    cache = globals()[name]
+    if cache is None:
+        import weakref
+        cache = globals()[name] = weakref.WeakKeyDictionary()
+    return cache
+
+# For slim pickling
+def _slim_code_args(code):
+    """Like _code_args, but without what's only there for debugging: the
+    filename, line numbers and docstring are blanked. Any code objects in
+    co_consts are left as they are."""
+    cache = _weak_key_cache('_slim_code_args_cache')
+    try:
+        return cache[code]
+    except KeyError:
+        pass
+    fields = dict(zip(_code_fields, _code_args(code)))
+    fields['co_filename'] = ''
+    fields['co_firstlineno'] = 1
+    if 'co_linetable' in fields:
+        fields['co_linetable'] = _flat_line_table(code)
+    else:
+        fields['co_lnotab'] = b''
+    # The docstring is the first constant, but a string that's actually used
+    # could be there too.
+    import dis
+    consts = code.co_consts
+    if consts and isinstance(consts[0], str) and not any(
+            instruction.opname == 'LOAD_CONST' and instruction.arg == 0
+            for instruction in dis.get_instructions(code)):
+        fields['co_consts'] = (None,) + consts[1:]
+    args = tuple(fields[name] for name in _code_fields)
+    cache[code] = args
+    return args
+
+def _flat_line_table(code):
+    """Return a co_linetable that puts all of code on its first line.
+
+    An empty table would do before Python 3.10, but since then it leaves
+    instructions without a line number, which tracebacks can't cope with."""
+    size = len(code.co_code)
+    if sys.version_info >= (3, 11):
+        # Entries with no column information and a line delta of 0, each
+        # for up to 8 code units.
+        units = size // 2
+        return b''.join(bytes((0xe8 | (min(units - i, 8) - 1), 0))
+                        for i in range(0, units, 8))
+    # Pairs of a bytecode delta (at most 254) and a line delta of 0.
+    return b''.join(bytes((min(size - i, 254), 0))
+                    for i in range(0, size, 254))
+
+def _slim_code(code):
+    """Return a copy of code, and of the code objects nested in it, with
+    _slim_code_args."""
+    args = dict(zip(_code_fields, _slim_code_args(code)))
+    args['co_consts'] = tuple(
+        _slim_code(const) if isinstance(const, types.CodeType) else const
+        for const in args['co_consts'])
+    return types.CodeType(*(args[name] for name in _code_fields))
+
+# Add SHOUTY_VARIABLES from pickle's globals; str methods are much quicker
+# than matching "[A-Z][A-Z0-9_]+$", which they're equivalent to here.
 globals().update({k: v for k, v in vars(pickle).items()
-                  if re.match("[A-Z][A-Z0-9_]+$", k)})
+                  if k.isupper() and not k.startswith('_')})
 
 class _ChainedDictionary(dict):
     """A chained dictionary implementation."""
@@ -35,13 +149,44 @@ class _ChainedDictionary(dict):
         self._dictionaries = dictionaries
 
     def __getitem__(self, key):
-        if key in self:
+        try:
             return super().__getitem__(key)
+        except KeyError:
+            pass
         for dictionary in self._dictionaries:
             if key in dictionary:
                 return dictionary[key]
         raise KeyError("Key {} not in any of the dictionaries.".format(key))
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+class _DispatchTable(_ChainedDictionary):
+    """A _ChainedDictionary of reducers, where the reducers for a module's
+    types can be added the first time one of them is looked up, so that the
+    module needn't be imported with pickall."""
+    def __init__(self, *dictionaries):
+        super().__init__(*dictionaries)
+        self._lazy = {}  # Maps module names to functions adding reducers
+
+    def add_lazy(self, module_name, add):
+        """Call add(self) when a type from module_name is first looked up.
+        """
+        self._lazy[module_name] = add
+
+    def __getitem__(self, key):
+        try:
+            return super().__getitem__(key)
+        except KeyError:
+            add = self._lazy.pop(getattr(key, '__module__', None), None)
+            if add is None:
+                raise
+        add(self)
+        return super().__getitem__(key)
+
 # Function duplication magic.
 class _DuplicateGlobals(_ChainedDictionary):
     def __init__(self, *dictionaries,
@@ -72,42 +217,105 @@ def _duplicate(func, globals_=_DuplicateGlobals(globals(), vars(pickle))):
 def _no_globals(func):
     return _duplicate(func, {})
 
-# Map of object to (module_name, qualname)
-# Currently built for CPython; I might add dynamic collection back in later
-# but my current implementation is flawed.
-_resolvable_location = {
-    types.BuiltinFunctionType: ('types', 'BuiltinFunctionType'),
-    types.CodeType: ('types', 'CodeType'),
-    types.CoroutineType: ('types', 'CoroutineType'),
-    types.FrameType: ('types', 'FrameType'),
-    types.FunctionType: ('types', 'FunctionType'),
-    types.GeneratorType: ('types', 'GeneratorType'),
-    types.GetSetDescriptorType: ('types', 'GetSetDescriptorType'),
-    types.MappingProxyType: ('types', 'MappingProxyType'),
-    types.MemberDescriptorType: ('types', 'MemberDescriptorType'),
-    types.MethodType: ('types', 'MethodType'),
-    types.ModuleType: ('types', 'ModuleType'),
-    types.TracebackType: ('types', 'TracebackType'),
-    functools._CacheInfo: ('functools', '_CacheInfo'),
-    re._pattern_type: ('re', '_pattern_type'),
-    weakref.ref: ('weakref', 'ref'),
-}
+class _LocationIndex:
+    """A reverse index of (module_name, qualname) for objects in sys.modules.
 
-def resolve_location(obj):
+    It's built lazily, and modules are indexed as they turn up in
+    sys.modules; objects that have been moved or deleted since their module
+    was indexed are dropped when they're looked up. Only the names are
+    kept, so the index doesn't keep objects alive; a location is only
+    returned for an object that's still there."""
+    # These are indexed first, so that their names for objects are preferred.
+    preferred_modules = ('types', 'functools', 're', 'weakref')
+
+    # Objects of these types are never looked up, so aren't worth indexing.
+    unindexed_types = frozenset({
+        type(None), bool, int, float, complex, str, bytes, bytearray,
+        tuple, list, dict, set, frozenset,
+    })
+
+    def __init__(self):
+        self._locations = {}  # Maps id(obj) to (module_name, qualname)
+        self._indexed = {}  # Maps module_name to id(module)
+        self._modules_seen = 0
+
+    def _index_module(self, module_name, module):
+        self._indexed[module_name] = id(module)
+        try:
+            items = list(vars(module).items())
+        except TypeError:
+            return
+        unindexed_types = self.unindexed_types
+        locations = self._locations
+        for name, value in items:
+            if type(value) in unindexed_types:
+                continue
+            location = locations.get(id(value))
+            # Prefer earlier modules, but prefer public names to private ones.
+            if location is None or (location[1].startswith('_') and
+                                    not name.startswith('_')):
+                locations[id(value)] = module_name, name
+
+    def _update(self):
+        modules = sys.modules
+        if not self._indexed:
+            for module_name in self.preferred_modules:
+                if module_name in modules:
+                    self._index_module(module_name, modules[module_name])
+        # Copied, in case indexing a module imports another
+        for module_name, module in list(modules.items()):
+            if module_name == '__main__' or module is None:
+                continue
+            if self._indexed.get(module_name) != id(module):
+                self._index_module(module_name, module)
+        self._modules_seen = len(modules)
+
+    def lookup(self, obj):
+        """Return (module_name, qualname) for obj, or None if not found."""
+        if self._modules_seen != len(sys.modules):
+            self._update()
+        location = self._locations.get(id(obj))
+        if location is None:
+            return None
+        module_name, qualname = location
+        if getattr(sys.modules.get(module_name), qualname, None) is obj:
+            return location
+        # Stale
+        del self._locations[id(obj)]
+        return None
+
+_location_index = _LocationIndex()
+
+def _find_global(module_name, qualname):
+    module = sys.modules.get(module_name)
+    if module is None:
+        return None
     try:
-        contains = obj in _resolvable_location
-    except Exception:
-        pass
-    else:
-        if contains:
-            return _resolvable_location[obj]
-    # More rules go here, if needed.
-    return None
+        for part in qualname.split('.'):
+            module = getattr(module, part)
+    except AttributeError:
+        return None
+    return module
+
+def resolve_location(obj):
+    """Return (module_name, qualname) for obj, if it can't be found by its
+    own __module__ and __qualname__ but can be found somewhere else.
+
+    Otherwise, return None."""
+    module_name = getattr(obj, '__module__', None)
+    qualname = getattr(obj, '__qualname__', None)
+    if (isinstance(module_name, str) and isinstance(qualname, str) and
+            _find_global(module_name, qualname) is obj):
+        return None
+    return _location_index.lookup(obj)
 
 @_no_globals
 def __newobj__(cls, *args):
     return cls.__new__(cls, *args)
 
+# The most items a __reduce__ tuple can have; state_setter was added in 3.8
+_max_reduce_length = 6 if sys.version_info >= (3, 8) else 5
+
 # For function pickling
 @_no_globals
 def set_function_descriptors(f, annotations, kwdefaults):
@@ -116,30 +324,989 @@ def set_function_descriptors(f, annotations, kwdefaults):
     f.__kwdefaults__ = kwdefaults
     return f
 
+@_no_globals
+def set_function_state(f, state):
+    # state_setter version of set_function_descriptors, used by _pickall.
+    # WARNING: Must NOT have __annotations__ or __kwdefaults__!
+    dict_, annotations, kwdefaults, globals_, builtins_, cells = state
+    f.__dict__.update(dict_)
+    f.__annotations__ = annotations
+    f.__kwdefaults__ = kwdefaults
+    # For pruned globals; see _pruned_globals
+    if globals_:
+        f.__globals__.update(globals_)
+    if builtins_:
+        f.__globals__['__builtins__'].update(builtins_)
+    # For recursive closures; see _pickall.Pickler.reduce_function
+    for cell, value in cells:
+        cell.cell_contents = value
+
+# For cells; types.CellType is used instead of _new_cell where it exists.
+@_no_globals
+def _new_cell(*contents):
+    """Make a new cell, containing contents[0] if given."""
+    if contents:
+        value, = contents
+    return (lambda: value).__closure__[0]
+
+# Cell contents of these types can't refer to anything, so they needn't
+# wait for the function to be memoized; see _Pickler.save_cell.
+_atomic_types = frozenset({type(None), bool, int, float, complex, str, bytes})
+
+def _cell_contents(cell):
+    """Return (contents,), or () if cell is empty. Used with _new_cell."""
+    try:
+        return (cell.cell_contents,)
+    except ValueError:
+        return ()
+
+@_no_globals
+def set_cell_contents(cell, value):
+    # Python 3.7+ only; see _Pickler.fill_cell
+    cell.cell_contents = value
+
+# For class pickling
+_heap_type = 1 << 9  # Py_TPFLAGS_HEAPTYPE, set for classes made by type()
+
+# The metaclasses of classes that can be pickled by value, mapped to the
+# names in a class's namespace that the metaclass makes itself. ABCMeta's
+# are its caches and registry, so virtual subclasses added with register()
+# aren't pickled; its __abstractmethods__ is, though, since the abstract
+# methods are only set after the class is made.
+_class_metaclasses = {
+    type: frozenset(),
+    abc.ABCMeta: frozenset({
+        '_abc_impl', '_abc_registry', '_abc_cache', '_abc_negative_cache',
+        '_abc_negative_cache_version',
+    }),
+}
+
+def _class_by_value(cls):
+    """Check whether cls should be pickled by value: it's made by a class
+    statement or type() (or with ABCMeta; see _class_metaclasses), and can't
+    be found by its name."""
+    return (type(cls) in _class_metaclasses and
+            bool(cls.__flags__ & _heap_type) and
+            _find_global(cls.__module__, cls.__qualname__) is not cls)
+
+def _class_dicts(cls, slim=False):
+    """Return (created, namespace) for a class pickled by value: what
+    type() needs to make it, and the attributes to set once it's made.
+
+    The slot descriptors, __dict__ and __weakref__ are left out, since
+    type() makes them again, as are the names the metaclass makes; see
+    _class_metaclasses. Attributes set afterwards don't get __set_name__
+    called on them."""
+    created = {'__module__': cls.__module__,
+               '__qualname__': cls.__qualname__}
+    namespace = {}
+    made = _class_metaclasses[type(cls)]
+    for name, value in vars(cls).items():
+        if name in ('__dict__', '__weakref__', '__module__') or name in made:
+            continue
+        if (type(value) is types.MemberDescriptorType and
+                value.__objclass__ is cls):
+            continue  # Made from __slots__
+        if name in ('__slots__', '__doc__'):
+            if not (slim and name == '__doc__'):
+                created[name] = value
+            continue
+        namespace[name] = value
+    return created, namespace
+
+@_no_globals
+def set_class_namespace(cls, namespace, setattr=setattr):
+    # setattr is a default, since _no_globals functions have no builtins.
+    for name, value in namespace.items():
+        setattr(cls, name, value)
+    return cls
+
+# Names which, in a class or its bases, might change how instances are
+# reduced from what _Pickler._save_plain_instance does.
+_reduce_names = frozenset({
+    '__reduce_ex__', '__reduce__', '__getnewargs_ex__', '__getnewargs__',
+    '__getstate__', '__slots__', '__getattr__', '__getattribute__',
+})
+
+def _instance_layout(cls):
+    return (cls.__basicsize__, cls.__itemsize__, cls.__dictoffset__,
+            cls.__weakrefoffset__)
+
+# Heap types can also be made in C, so instances of plain classes are also
+# checked to be laid out like this: with just a __dict__ and __weakref__.
+_plain_layout = _instance_layout(type('Plain', (), {}))
+
+def _plain_class(cls):
+    """Check whether instances of cls are reduced the way that
+    object.__reduce_ex__ does by default: cls and its bases, other than
+    object, are made by class statements or type(), without __slots__ or
+    methods of their own that change how their instances are reduced."""
+    mro = cls.__mro__
+    if mro[-1] is not object or _instance_layout(cls) != _plain_layout:
+        return False
+    for base in mro[:-1]:
+        if (not base.__flags__ & _heap_type or
+                not _reduce_names.isdisjoint(vars(base))):
+            return False
+    return True
+
+# For global pruning
+_implicit_builtins = ((opcode.opmap['IMPORT_NAME'], '__import__'),
+                      (opcode.opmap['LOAD_BUILD_CLASS'], '__build_class__'))
+
+def _global_names(code):
+    """Return the names of the globals that code, or any code nested in it,
+    might refer to."""
+    cache = _weak_key_cache('_global_names_cache')
+    try:
+        return cache[code]
+    except KeyError:
+        pass
+    names = set(code.co_names)
+    # Import statements and class definitions look up __import__ and
+    # __build_class__ in the builtins without naming them.
+    ops = set(code.co_code[::2])
+    for op, name in _implicit_builtins:
+        if op in ops:
+            names.add(name)
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    names = cache[code] = frozenset(names)
+    return names
+
+def _pruned_globals(session, func):
+    """Prune func.__globals__ down to the globals func refers to.
+
+    session maps the id of a globals dictionary to its pruned version, so
+    that functions sharing globals still share them after unpickling.
+
+    Returns the pruned dictionary, and two dictionaries of items that need
+    adding to the pruned dictionary and to its __builtins__ once func has
+    been created; the pruned dictionaries must be pickled before these items
+    are, or recursive functions would recurse forever.
+    """
+    globals_ = func.__globals__
+    try:
+        _, pruned, written = session[id(globals_)]
+    except KeyError:
+        # Builtins referred to get their own small __builtins__ dictionary.
+        pruned = {'__builtins__': {}}
+        written = set()
+        session[id(globals_)] = globals_, pruned, written
+
+    builtins_ = globals_.get('__builtins__', builtins)
+    if isinstance(builtins_, types.ModuleType):
+        builtins_ = vars(builtins_)
+
+    new_globals = {}
+    new_builtins = {}
+    for name in _global_names(func.__code__) - written:
+        if name in globals_:
+            new_globals[name] = globals_[name]
+        elif name in builtins_:
+            new_builtins[name] = builtins_[name]
+        else:
+            continue
+        written.add(name)
+    return pruned, new_globals, new_builtins
+
+# Functions that are pickled by reference, rather than by value, so that
+# they can share state with the unpickling process's copy of pickall.
+_by_reference = set()
+
+def _pickled_by_reference(func):
+    _by_reference.add(func)
+    return func
+
+# For the code cache
+CodeCacheInfo = collections.namedtuple(
+    'CodeCacheInfo', ['hits', 'misses', 'evictions', 'maxsize', 'currsize'])
+
+class CodeCache:
+    """A least-recently-used cache, for code objects.
+
+    Pass one as the code_cache argument to Pickler or dump(s) to reuse the
+    serialized form of code objects between calls; each is saved as its
+    content digest and marshalled data, which load_code uses to reuse the
+    code objects it's already made."""
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self._cache = collections.OrderedDict()
+        self.hits = self.misses = self.evictions = 0
+
+    def lookup(self, key, make_value):
+        """Return the cached value for key, calling make_value on a miss."""
+        try:
+            value = self._cache[key]
+        except KeyError:
+            self.misses += 1
+            value = self._cache[key] = make_value()
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            self._cache.move_to_end(key)
+        return value
+
+    def cache_info(self):
+        return CodeCacheInfo(self.hits, self.misses, self.evictions,
+                             self.maxsize, len(self._cache))
+
+    def cache_clear(self):
+        self._cache.clear()
+        self.hits = self.misses = self.evictions = 0
+
+def _serialize_code(code):
+    # The code object is kept in the value, so that its id isn't reused
+    # while it's in the cache.
+    import hashlib
+    data = marshal.dumps(code)
+    return code, hashlib.sha1(data).digest(), data
+
+def _cached_code(cache, code, slim=False):
+    """Return (digest, data) for code, using cache; slim code is cached
+    separately, see _slim_code."""
+    if slim:
+        key = id(code), 'slim'
+        # The original code is kept instead, since its id is the key.
+        serialize = lambda: (code,) + _serialize_code(_slim_code(code))[1:]
+    else:
+        key = id(code)
+        serialize = functools.partial(_serialize_code, code)
+    _, digest, data = cache.lookup(key, serialize)
+    return digest, data
+
+@_pickled_by_reference
+def load_code(digest, data):
+    """Load a code object pickled with a CodeCache.
+
+    load_code.cache holds the code objects already loaded."""
+    return load_code.cache.lookup(digest,
+                                  functools.partial(marshal.loads, data))
+load_code.cache = CodeCache()
+
+# For module pickling. With the default policy, modules that importing their
+# name gives are saved as a reference to that; others, such as __main__ and
+# modules made by types.ModuleType, are saved by value, with a token that
+# _new_module uses to load each one as a single module in each process.
+_module_policies = ('auto', 'reference', 'value')
+
+# Maps modules to their tokens; see _weak_key_cache.
+_module_tokens = None
+
+# Maps tokens to the modules loaded with them. Like sys.modules, this keeps
+# them alive, since functions only refer to their module's __dict__.
+_loaded_modules = {}
+
+def _check_module_policy(policy):
+    if not (callable(policy) or policy in _module_policies):
+        raise ValueError("module_policy must be 'auto', 'reference', 'value' "
+                         "or a function, not {!r}".format(policy))
+
+def _importable(module):
+    """Check whether importing module's name gives module."""
+    name = getattr(module, '__name__', None)
+    return (name != '__main__' and
+            getattr(module, '__spec__', None) is not None and
+            sys.modules.get(name) is module)
+
+def _module_by_value(module, policy):
+    """Check whether module should be pickled by value, under policy.
+
+    A policy that's a function is called with the module, and returns
+    'reference' or 'value'."""
+    if callable(policy):
+        policy = policy(module)
+        if policy not in ('reference', 'value'):
+            raise ValueError("module_policy must return 'reference' or "
+                             "'value', not {!r}".format(policy))
+    if policy == 'auto':
+        return not _importable(module)
+    return policy == 'value'
+
+def _module_token(module, deterministic=False):
+    """Return module's token. Deterministic tokens are made from the
+    module's name, so that they're the same in every process; modules with
+    the same name then load as one module."""
+    if deterministic:
+        return 'name:' + module.__name__
+    tokens = _weak_key_cache('_module_tokens')
+    token = tokens.get(module)
+    if token is None:
+        import os
+        token = tokens[module] = os.urandom(16).hex()
+    return token
+
+def _globals_module(globals_):
+    """Return the module in sys.modules whose __dict__ is globals_, if
+    there is one."""
+    module = sys.modules.get(globals_.get('__name__'))
+    if getattr(module, '__dict__', None) is globals_:
+        return module
+    return None
+
+def _shared_globals_module(globals_, policy):
+    """Return the module whose __dict__ globals_ is, if it's to be saved as
+    vars(module) under policy, rather than copied; see
+    _Pickler.save_module_dict.
+
+    That's when the module is pickled by value anyway, when it's builtins,
+    or when a policy other than 'auto' was asked for. Otherwise a function's
+    globals are copied, so that it loads where its module can't be
+    imported."""
+    module = _globals_module(globals_)
+    if (module is None or module is builtins or policy != 'auto' or
+            _module_by_value(module, policy)):
+        return module
+    return None
+
+@_pickled_by_reference
+def _new_module(name, token):
+    """Return the module loaded with token, or a new empty one called name
+    if there isn't one; its namespace is filled in once it's memoized.
+
+    Loading a module again updates its namespace, so functions from it that
+    are loaded separately still share their globals."""
+    module = _loaded_modules.get(token)
+    if module is None:
+        module = _loaded_modules[token] = types.ModuleType(name)
+        # So that pickling it again gives the same token
+        _weak_key_cache('_module_tokens')[module] = token
+    return module
+
+@_no_globals
+def set_module_namespace(module, namespace, vars=vars):
+    # state_setter for modules pickled by value, used by _pickall.
+    vars(module).update(namespace)
+
+# For generator pickling. Suspended generators and coroutines are saved as a
+# function that makes a new one, and the state of their frame, which is
+# read and written with ctypes; see _FrameLayout.
+class _FrameLayout:
+    """Reads and writes the frames of generators and coroutines on CPython
+    3.6 to 3.10, where they're PyFrameObjects.
+
+    A frame's state is (lasti, locals, stack, blocks). lasti is None if the
+    generator hasn't started; locals (including cells and free variables)
+    and stack have () for each empty slot and (value,) for each full one;
+    blocks are the (type, handler, level) of each block on the block stack.
+    """
+    # The block type of a running except block, from opcode.h
+    except_handler = 257
+
+    def __init__(self):
+        import ctypes
+        pointer = ctypes.c_void_p
+
+        class TryBlock(ctypes.Structure):
+            _fields_ = [('b_type', ctypes.c_int), ('b_handler', ctypes.c_int),
+                        ('b_level', ctypes.c_int)]
+
+        fields = [('ob_refcnt', ctypes.c_ssize_t), ('ob_type', pointer),
+                  ('ob_size', ctypes.c_ssize_t), ('f_back', pointer),
+                  ('f_code', pointer), ('f_builtins', pointer),
+                  ('f_globals', pointer), ('f_locals', pointer),
+                  ('f_valuestack', pointer)]
+        if sys.version_info < (3, 10):
+            fields.append(('f_stacktop', pointer))
+        fields.append(('f_trace', pointer))
+        if sys.version_info < (3, 7):
+            fields += [('f_exc_type', pointer), ('f_exc_value', pointer),
+                       ('f_exc_traceback', pointer)]
+        else:
+            if sys.version_info >= (3, 10):
+                fields.append(('f_stackdepth', ctypes.c_int))
+            fields += [('f_trace_lines', ctypes.c_char),
+                       ('f_trace_opcodes', ctypes.c_char)]
+        fields += [('f_gen', pointer), ('f_lasti', ctypes.c_int),
+                   ('f_lineno', ctypes.c_int), ('f_iblock', ctypes.c_int),
+                   ('f_state', ctypes.c_byte),  # f_executing before 3.10
+                   ('f_blockstack', TryBlock * 20),  # CO_MAXBLOCKS
+                   ('f_localsplus', pointer * 0)]
+
+        class Frame(ctypes.Structure):
+            _fields_ = fields
+
+        self.TryBlock = TryBlock
+        self.Frame = Frame
+
+    @staticmethod
+    def nlocalsplus(code):
+        """Return how many slots code's locals, cells and free variables
+        take up, before the value stack."""
+        return (code.co_nlocals + len(code.co_cellvars) +
+                len(code.co_freevars))
+
+    @staticmethod
+    def read_slot(address):
+        import ctypes
+        value = ctypes.c_void_p.from_address(address).value
+        if value is None:
+            return ()
+        return (ctypes.cast(value, ctypes.py_object).value,)
+
+    @staticmethod
+    def write_slot(address, contents, owned=True):
+        """Put contents, () or (value,), in the slot at address; if owned,
+        the slot holds a reference to what was there, which is released."""
+        import ctypes
+        slot = ctypes.c_void_p.from_address(address)
+        old = slot.value if owned else None
+        if contents:
+            ctypes.pythonapi.Py_IncRef(ctypes.py_object(contents[0]))
+            slot.value = id(contents[0])
+        else:
+            slot.value = None
+        if old is not None:
+            ctypes.pythonapi.Py_DecRef(ctypes.c_void_p(old))
+
+    def _struct(self, frame):
+        struct = self.Frame.from_address(id(frame))
+        if struct.f_code != id(frame.f_code):
+            raise PicklingError("can't read the frames of this Python")
+        return struct
+
+    def read(self, gen, frame):
+        import ctypes
+        struct = self._struct(frame)
+        size = ctypes.sizeof(ctypes.c_void_p)
+        start = id(frame) + self.Frame.f_localsplus.offset
+        locals_ = [self.read_slot(start + i * size)
+                   for i in range(self.nlocalsplus(frame.f_code))]
+        if sys.version_info < (3, 10):
+            depth = (struct.f_stacktop - struct.f_valuestack) // size
+        else:
+            depth = struct.f_stackdepth
+        stack = [self.read_slot(struct.f_valuestack + i * size)
+                 for i in range(depth)]
+        blocks = [(block.b_type, block.b_handler, block.b_level)
+                  for block in struct.f_blockstack[:struct.f_iblock]]
+        if any(block[0] == self.except_handler for block in blocks):
+            raise PicklingError(
+                "can't pickle a generator suspended in an except block")
+        lasti = None if struct.f_lasti == -1 else struct.f_lasti
+        return lasti, locals_, stack, blocks
+
+    def write(self, gen, frame, lasti, locals_, stack, blocks):
+        import ctypes
+        struct = self._struct(frame)
+        size = ctypes.sizeof(ctypes.c_void_p)
+        start = id(frame) + self.Frame.f_localsplus.offset
+        for i, contents in enumerate(locals_):
+            self.write_slot(start + i * size, contents)
+        # Slots above the stack top hold whatever was left there.
+        for i, contents in enumerate(stack):
+            self.write_slot(struct.f_valuestack + i * size, contents,
+                            owned=False)
+        if sys.version_info < (3, 10):
+            struct.f_stacktop = struct.f_valuestack + len(stack) * size
+        else:
+            struct.f_stackdepth = len(stack)
+        for i, block in enumerate(blocks):
+            struct.f_blockstack[i] = self.TryBlock(*block)
+        struct.f_iblock = len(blocks)
+        if lasti is not None:
+            struct.f_lasti = lasti
+            if sys.version_info >= (3, 10):
+                struct.f_state = -1  # FRAME_SUSPENDED
+
+class _InterpreterFrameLayout(_FrameLayout):
+    """A _FrameLayout for CPython 3.11, where a generator's frame is a
+    _PyInterpreterFrame inside the generator, and exceptions are handled
+    with the code's exception table instead of a block stack."""
+    def __init__(self):
+        import ctypes
+        pointer = ctypes.c_void_p
+
+        class FrameObject(ctypes.Structure):
+            _fields_ = [('ob_refcnt', ctypes.c_ssize_t), ('ob_type', pointer),
+                        ('f_back', pointer), ('f_frame', pointer)]
+
+        class Frame(ctypes.Structure):
+            _fields_ = [('f_func', pointer), ('f_globals', pointer),
+                        ('f_builtins', pointer), ('f_locals', pointer),
+                        ('f_code', pointer), ('frame_obj', pointer),
+                        ('previous', pointer), ('prev_instr', pointer),
+                        ('stacktop', ctypes.c_int),
+                        ('is_entry', ctypes.c_bool),
+                        ('owner', ctypes.c_char),
+                        ('localsplus', pointer * 0)]
+
+        self.FrameObject = FrameObject
+        self.Frame = Frame
+        # gi_frame_state is found by watching it change from FRAME_CREATED
+        # to FRAME_SUSPENDED, in the bytes before the frame.
+        def sample():
+            yield
+        gen = sample()
+        size = self._address(gen.gi_frame) - id(gen)
+        created = ctypes.string_at(id(gen), size)
+        next(gen)
+        suspended = ctypes.string_at(id(gen), size)
+        offsets = [i for i in range(size)
+                   if created[i] == 0xfe and suspended[i] == 0xff]
+        if not offsets:
+            raise PicklingError("can't read the frames of this Python")
+        self.state_offset = offsets[-1]
+
+    @staticmethod
+    def nlocalsplus(code):
+        # Arguments that are also cells only have one slot.
+        return (len(code.co_varnames) + len(code.co_freevars) +
+                len(set(code.co_cellvars) - set(code.co_varnames)))
+
+    def _address(self, frame):
+        return self.FrameObject.from_address(id(frame)).f_frame
+
+    def _struct(self, frame):
+        struct = self.Frame.from_address(self._address(frame))
+        if struct.f_code != id(frame.f_code):
+            raise PicklingError("can't read the frames of this Python")
+        return struct
+
+    def read(self, gen, frame):
+        import ctypes
+        struct = self._struct(frame)
+        size = ctypes.sizeof(ctypes.c_void_p)
+        start = self._address(frame) + self.Frame.localsplus.offset
+        slots = [self.read_slot(start + i * size)
+                 for i in range(struct.stacktop)]
+        nlocalsplus = self.nlocalsplus(frame.f_code)
+        state = ctypes.c_int8.from_address(id(gen) + self.state_offset)
+        lasti = None if state.value == -2 else frame.f_lasti
+        return lasti, slots[:nlocalsplus], slots[nlocalsplus:], []
+
+    def write(self, gen, frame, lasti, locals_, stack, blocks):
+        import ctypes
+        struct = self._struct(frame)
+        size = ctypes.sizeof(ctypes.c_void_p)
+        start = self._address(frame) + self.Frame.localsplus.offset
+        for i, contents in enumerate(locals_):
+            self.write_slot(start + i * size, contents)
+        for i, contents in enumerate(stack, len(locals_)):
+            self.write_slot(start + i * size, contents, owned=False)
+        struct.stacktop = len(locals_) + len(stack)
+        if lasti is not None:
+            # frame.f_lasti is prev_instr's offset from the first
+            # instruction, in bytes.
+            struct.prev_instr += lasti - frame.f_lasti
+            state = ctypes.c_int8.from_address(id(gen) + self.state_offset)
+            state.value = -1  # FRAME_SUSPENDED
+
+_frame_layout = None
+
+def _get_frame_layout():
+    """Return the _FrameLayout for this Python, or None if there isn't one.
+    """
+    global _frame_layout
+    if (_frame_layout is None and
+            sys.implementation.name == 'cpython' and
+            sys.version_info < (3, 12)):
+        if sys.version_info >= (3, 11):
+            _frame_layout = _InterpreterFrameLayout()
+        else:
+            _frame_layout = _FrameLayout()
+    return _frame_layout
+
+def _generator_parts(gen):
+    """Return (frame, code, running) for a generator or coroutine."""
+    if type(gen) is types.GeneratorType:
+        return gen.gi_frame, gen.gi_code, gen.gi_running
+    return gen.cr_frame, gen.cr_code, gen.cr_running
+
+def _generator_reduction(gen):
+    """Return (func, qualname, state) for a generator or coroutine.
+
+    func makes a new generator running the same code, with the same globals
+    and closure, when called by _new_generator; state is for
+    _set_generator_state, and is () if gen is exhausted."""
+    frame, code, running = _generator_parts(gen)
+    if running:
+        raise PicklingError("can't pickle a running {}".format(
+            type(gen).__name__))
+    layout = _get_frame_layout()
+    if layout is None:
+        raise PicklingError("can't pickle {} objects on this Python".format(
+            type(gen).__name__))
+    if frame is None:
+        # Exhausted, so the globals and closure don't matter.
+        closure = tuple((_CellType or _new_cell)() for _ in code.co_freevars)
+        func = types.FunctionType(code, {}, gen.__name__, None,
+                                  closure or None)
+        return func, gen.__qualname__, ()
+    state = layout.read(gen, frame)
+    locals_ = state[1]
+    closure = tuple(contents[0]
+                    for contents in locals_[len(locals_) -
+                                            len(code.co_freevars):])
+    func = types.FunctionType(code, frame.f_globals, gen.__name__, None,
+                              closure or None)
+    return func, gen.__qualname__, state
+
+@_pickled_by_reference
+def _new_generator(func, qualname):
+    """Call func with placeholder arguments, for _set_generator_state to
+    replace."""
+    code = func.__code__
+    kwonly = code.co_varnames[code.co_argcount:
+                              code.co_argcount + code.co_kwonlyargcount]
+    gen = func(*(None,) * code.co_argcount, **dict.fromkeys(kwonly))
+    gen.__qualname__ = qualname
+    return gen
+
+@_pickled_by_reference
+def _set_generator_state(gen, state):
+    """Set the state of a generator made by _new_generator; see _FrameLayout.
+    """
+    if not state:
+        gen.close()
+        return
+    frame, _, _ = _generator_parts(gen)
+    layout = _get_frame_layout()
+    if layout is None:
+        raise UnpicklingError("can't load {} objects on this Python".format(
+            type(gen).__name__))
+    layout.write(gen, frame, *state)
+
+class _SaveStats:
+    """Counts, bytes and time for each (save method, type) that a pickler
+    saves; see _Pickler.get_stats.
+
+    It replaces the pickler's save and write with counting versions, so
+    picklers without stats don't pay anything for them."""
+    def __init__(self, pickler):
+        self.pickler = pickler
+        self.records = {}  # (method, type): [count, bytes, seconds]
+        self.written = 0
+        self.max_depth = 0
+        # [bytes, seconds] spent in nested saves, for each save in progress;
+        # those are subtracted, so each record is exclusive of its children.
+        self.nested = []
+
+        self.original_save = pickler.save
+        pickler.save = self.save
+        self.original_write = pickler.write
+        pickler.write = self.write
+        if hasattr(pickler, '_write_large_bytes'):  # Python 3.8+
+            self.original_write_large_bytes = pickler._write_large_bytes
+            pickler._write_large_bytes = self.write_large_bytes
+
+    def write(self, data):
+        self.written += len(data)
+        self.original_write(data)
+
+    def write_large_bytes(self, header, payload):
+        self.written += len(header) + len(payload)
+        self.original_write_large_bytes(header, payload)
+
+    def save(self, obj, save_persistent_id=True):
+        pickler = self.pickler
+        # Which method saves obj is only known for sure afterwards, unless
+        # it's one of these.
+        method = None
+        if id(obj) in pickler.memo:
+            method = 'memo'
+        elif id(obj) in pickler.dispatch_singletons:
+            method = 'dispatch_singletons'
+
+        nested = [0, 0.0]
+        self.nested.append(nested)
+        self.max_depth = max(self.max_depth, len(self.nested))
+        written = self.written
+        start = time.perf_counter()
+        try:
+            self.original_save(obj, save_persistent_id)
+        finally:
+            seconds = time.perf_counter() - start
+            written = self.written - written
+            self.nested.pop()
+            if self.nested:
+                self.nested[-1][0] += written
+                self.nested[-1][1] += seconds
+
+            if method is None:
+                plan = pickler._plans.get(type(obj))
+                method = getattr(plan, '__name__', 'reducer_override')
+            record = self.records.setdefault((method, type(obj)),
+                                             [0, 0, 0.0])
+            record[0] += 1
+            record[1] += written - nested[0]
+            record[2] += seconds - nested[1]
+
+    def as_dict(self):
+        objects = []
+        methods = {}
+        types_ = {}
+        for (method, t), (count, written, seconds) in self.records.items():
+            type_name = t.__qualname__
+            if t.__module__ != 'builtins':
+                type_name = '{}.{}'.format(t.__module__, type_name)
+            objects.append({'method': method, 'type': type_name,
+                            'count': count, 'bytes': written,
+                            'seconds': seconds})
+            for totals, key in ((methods, method), (types_, type_name)):
+                total = totals.setdefault(
+                    key, {'count': 0, 'bytes': 0, 'seconds': 0.0})
+                total['count'] += count
+                total['bytes'] += written
+                total['seconds'] += seconds
+        objects.sort(key=lambda record: record['bytes'], reverse=True)
+        return {
+            'bytes': self.written,
+            'memo_size': len(self.pickler.memo),
+            'max_depth': self.max_depth,
+            'objects': objects,
+            'methods': methods,
+            'types': types_,
+        }
+
 class _Pickler(pickle._Pickler):
     # dispatch is a dictionary where the keys are the type of object
     # and the values are save_x methods.
     dispatch = pickle._Pickler.dispatch.copy()
     del dispatch[types.FunctionType]  # Don't treat it as a global
 
-    def save(self, obj, save_persistent_id=True, *args, **kwargs):
+    def __init__(self, file, protocol=None, *, prune_globals=False,
+                 code_cache=None, buffer_threshold=1024, stats=False,
+                 frame_size=None, slim=False, deterministic=False,
+                 module_policy='auto', **kwargs):
+        super().__init__(file, protocol, **kwargs)
+        # At protocol 4+, frames are committed once they're this big.
+        if frame_size is not None:
+            self.framer._FRAME_SIZE_TARGET = frame_size
+        # If code_cache is a CodeCache, code objects are saved through it.
+        self.code_cache = code_cache
+        # With a buffer_callback, the bytes and bytearrays at least this long
+        # in code objects and pruned globals are offered to it as
+        # out-of-band buffers; see save_out_of_band.
+        self.buffer_threshold = buffer_threshold
+        self._out_of_band = set()
+        # If slim is true, functions and code are saved without docstrings,
+        # annotations, filenames or line numbers; see _slim_code_args.
+        self.slim = slim
+        # If prune_globals is true, functions' globals only include what they
+        # refer to; see _pruned_globals.
+        self.prune_globals = prune_globals
+        self._pruned_globals = {}
+        # Cells saved while functions are being saved may be left empty,
+        # and filled in once the outermost function is memoized; see
+        # save_cell. _saving_functions is a stack of their ids.
+        self._saving_functions = []
+        self._unfilled_cells = {}
+        # If stats is true, what's saved is measured; see get_stats.
+        self._stats = _SaveStats(self) if stats else None
+        # If deterministic is true, equal objects are saved as the same
+        # bytes, whatever their dictionaries' insertion order, sets' hashes
+        # or strings' identities: dicts, sets and frozensets are saved in
+        # _canonical_order, and strs and bytes are memoized by value too.
+        # Loaded dicts are in that order, rather than the original one.
+        self.deterministic = deterministic
+        self._value_memo = {} if deterministic else None
+        if deterministic and code_cache is not None:
+            # Marshalled code depends on reference counts.
+            raise ValueError("deterministic can't be used with a code_cache")
+        # module_policy decides which modules are saved by value; see
+        # _module_by_value.
+        _check_module_policy(module_policy)
+        self.module_policy = module_policy
+
+    def clear_memo(self):
+        super().clear_memo()
+        self._pruned_globals.clear()
+        if self._value_memo is not None:
+            self._value_memo.clear()
+
+    def reset(self):
+        """Make the pickler ready for an unrelated object, as if it were new.
+
+        This is much cheaper than making a new pickler, and keeps the save
+        plans; it's what the pool behind dumps uses."""
+        self.clear_memo()
+        self._saving_functions.clear()
+        self._unfilled_cells.clear()
+
+    def get_stats(self):
+        """Return what's been measured so far, for a pickler made with
+        stats=True, as a dictionary:
+
+        bytes: The number of bytes written, excluding frame headers.
+        memo_size: The number of objects in the memo.
+        max_depth: The deepest that calls to save have been nested.
+        objects: A list of dictionaries with the count, bytes and seconds
+            spent for each method and type, most bytes first. Bytes and
+            seconds don't include those of the objects saved inside each one.
+        methods, types: The same totals, by method or by type name.
+        """
+        if self._stats is None:
+            raise ValueError("this pickler wasn't made with stats=True")
+        return self._stats.as_dict()
+
+    def dump(self, obj):
+        self._check_plans()
+        super().dump(obj)
+
+    def _check_plans(self):
+        # Each save plan is checked against what it was compiled from the
+        # first time it's used in a dump, so that changes since the last
+        # one, in place or by swapping a table, are noticed; _plans holds
+        # the ones checked so far.
+        if getattr(self, '_compiled_plans', None) is None:
+            self._plans = {}
+            self._compiled_plans = {}  # Maps types to (plan, source)
+        else:
+            self._plans.clear()
+        # Python 3.8's pickle._Pickler also supports this, for subclasses.
+        self._reducer_override = getattr(self, 'reducer_override', None)
+
+    def _plan(self, t):
+        """Return the plan for t, compiling it again if its source has
+        changed since it was compiled."""
+        source = self._plan_source(t)
+        compiled = self._compiled_plans.get(t)
+        if compiled is not None and compiled[1] is source:
+            return compiled[0]
+        plan = self._compile_plan(t)
+        self._compiled_plans[t] = plan, source
+        return plan
+
+    def _plan_source(self, t):
+        """Return what _compile_plan decides t's plan from: t's entry in
+        dispatch or the dispatch table in use, or else whether t is a plain
+        class."""
+        save = self.dispatch.get(t)
+        if save is not None:
+            return save
+        try:
+            return getattr(self, 'dispatch_table', copyreg.dispatch_table)[t]
+        except KeyError:
+            return self.proto >= 2 and _plain_class(t)
+
+    def save(self, obj, save_persistent_id=True):
+        # This does the same as pickle._Pickler.save, but with
+        # dispatch_singletons, and caches how to save each type as a plan.
+        self.framer.commit_frame()
+
+        # Check for persistent id (defined by a subclass)
+        pid = self.persistent_id(obj)
+        if pid is not None and save_persistent_id:
+            self.save_pers(pid)
+            return
+
+        # Check the memo
+        x = self.memo.get(id(obj))
+        if (x is None and self._value_memo is not None and
+                type(obj) in (str, bytes)):
+            x = self._value_memo.get((type(obj), obj))
+        if x is not None:
+            self.write(self.get(x[0]))
+            return
+
         # dispatch_singletons is a dictionary where the keys are the object's
         # id and the values are save_x methods.
-        if id(obj) not in self.dispatch_singletons:
-            return super().save(obj, save_persistent_id, *args, **kwargs)
+        save_singleton = self.dispatch_singletons.get(id(obj))
+        if save_singleton is not None:
+            save_singleton(self)
+            return
 
-        # Housekeeping
-        self.framer.commit_frame()
-        if save_persistent_id:
-            pid = self.persistent_id(obj)  # Has priority over dispatch_x
-            if pid is not None:
-                self.save_pers(pid)
+        if self._reducer_override is not None:
+            rv = self._reducer_override(obj)
+            if rv is not NotImplemented:
+                self._save_reduce_value(obj, rv, self._reducer_override)
                 return
-        if obj in self.memo:  # Has priority over dispatch_x
-            self.write(self.get(self.memo[obj])[0])
+
+        t = type(obj)
+        try:
+            plan = self._plans[t]
+        except KeyError:
+            plan = self._plans[t] = self._plan(t)
+        plan(self, obj)
+
+    def _compile_plan(self, t):
+        """Return a function that saves objects of type t, given (self, obj).
+
+        This is one of the methods in dispatch, a reducer from dispatch_table
+        (or copyreg.dispatch_table), save_global for classes with a custom
+        metaclass, _save_plain_instance (the template for instances of plain
+        classes; see _plain_class), or _save_reduce_ex."""
+        # Check the type dispatch table
+        save = self.dispatch.get(t)
+        if save is not None:
+            return save
+
+        # Check private dispatch table if any, or else copyreg.dispatch_table
+        try:
+            reduce = getattr(self, 'dispatch_table',
+                             copyreg.dispatch_table)[t]
+        except KeyError:
+            pass
+        else:
+            def save_dispatch_table(self, obj):
+                self._save_reduce_value(obj, reduce(obj), reduce)
+            return save_dispatch_table
+
+        # Check for a class with a custom metaclass; treat as regular class
+        try:
+            issc = issubclass(t, type)
+        except TypeError:  # t is not a class (old Boost; see SF #502085)
+            issc = False
+        if issc:
+            return _Pickler.save_global
+
+        if self.proto >= 2 and _plain_class(t):
+            return _Pickler._save_plain_instance
+        return _Pickler._save_reduce_ex
+
+    def _save_plain_instance(self, obj):
+        # What save_reduce does with what object.__reduce_ex__ returns, for
+        # an instance of a plain class, without calling either. An empty
+        # __dict__ isn't saved at all.
+        self.save(type(obj))
+        self.write(EMPTY_TUPLE + NEWOBJ)
+        if id(obj) in self.memo:
+            # Saved while saving its class, say as a class attribute
+            self.write(POP + self.get(self.memo[id(obj)][0]))
+        else:
+            self.memoize(obj)
+        state = obj.__dict__
+        if state:
+            self.save(state)
+            self.write(BUILD)
+
+    def _save_reduce_ex(self, obj):
+        # Check for a __reduce_ex__ method, fall back to __reduce__
+        reduce = getattr(obj, "__reduce_ex__", None)
+        if reduce is not None:
+            rv = reduce(self.proto)
+        else:
+            reduce = getattr(obj, "__reduce__", None)
+            if reduce is not None:
+                rv = reduce()
+            else:
+                raise PicklingError("Can't pickle %r object: %r" %
+                                    (type(obj).__name__, obj))
+        self._save_reduce_value(obj, rv, reduce)
+
+    def _save_reduce_value(self, obj, rv, reduce):
+        # Check for string returned by reduce(), meaning "save as global"
+        if isinstance(rv, str):
+            self.save_global(obj, rv)
             return
 
-        self.dispatch_singletons[id(obj)](self)
+        # Assert that reduce() returned a tuple
+        if not isinstance(rv, tuple):
+            raise PicklingError("%s must return string or tuple" % reduce)
+
+        # Assert that it returned an appropriately sized tuple
+        l = len(rv)
+        if not (2 <= l <= _max_reduce_length):
+            raise PicklingError("Tuple returned by %s must have "
+                                "two to %d elements" %
+                                (reduce, _max_reduce_length))
+
+        # Save the reduce() output and finally memoize the object
+        self.save_reduce(obj=obj, *rv)
 
     def save_function_call(self, func, *args):
         """Save a function and arguments, then call the function.
@@ -230,15 +1397,28 @@ class _Pickler(pickle._Pickler):
             # This means that I have to also override whichmodule, which means
             # that I have to _duplicate save_global.
             return self.save_global(obj, name=qualname)
+        if _class_by_value(obj):
+            return self.save_class(obj)
         return super().save_type(obj)
     dispatch[type] = save_type  # Mustn't forget this!
+    dispatch[abc.ABCMeta] = save_type  # See _class_metaclasses
+
+    def save_class(self, obj):
+        # The class is made and memoized before the rest of its namespace is
+        # set, since its methods can refer back to it (say, for super()).
+        created, namespace = _class_dicts(obj, self.slim)
+        self.save_reduce(type(obj), (obj.__name__, obj.__bases__, created),
+                         obj=obj)
+        if namespace:
+            self.save_reduce(set_class_namespace, (obj, namespace))
+            self.write(POP)
 
     # For explanation, see comments in save_type
     save_global = _duplicate(pickle._Pickler.save_global)
 
     def save_function(self, obj):
         # TODO: Be able to remove me!
-        if obj.__module__ in ('ctypes',):
+        if obj.__module__ in ('ctypes',) or obj in _by_reference:
             try:
                 self.save_global(obj)
                 return
@@ -258,7 +1438,8 @@ class _Pickler(pickle._Pickler):
         # descriptors, but aren't provided as arguments, they can't be
         # set in any way that pickle natively supports. Pickle does, however,
         # support arbitrary code execution.
-        has_descriptors = bool(obj.__annotations__) or bool(obj.__kwdefaults__)
+        annotations = {} if self.slim else obj.__annotations__
+        has_descriptors = bool(annotations) or bool(obj.__kwdefaults__)
         if has_descriptors:
             # Save function, then arguments.
             self.save(set_function_descriptors)
@@ -272,21 +1453,48 @@ class _Pickler(pickle._Pickler):
             else:
                 # We have to use variable-length tuple code.
                 self.write(MARK)
-            
-        self.save_reduce(
-            func, pre_args +
-            (obj.__code__, obj.__globals__,
-             # Afaik, function() copes with the optional arguments being
-             # the default "empty" values.
-             obj.__name__, obj.__defaults__, obj.__closure__),
-            state=vars(obj),
-            # Can't put __annotations__ and __kwdefaults__ here, since
-            # they're descriptors that don't match a constructor argument.
-            obj=obj
-        )
+
+        globals_ = obj.__globals__
+        if self.prune_globals:
+            globals_, new_globals, new_builtins = _pruned_globals(
+                self._pruned_globals, obj)
+        else:
+            self.save_module_dict(globals_)
+
+        self._saving_functions.append(id(obj))
+        try:
+            self.save_reduce(
+                func, pre_args +
+                (obj.__code__, globals_,
+                 # Afaik, function() copes with the optional arguments being
+                 # the default "empty" values.
+                 obj.__name__, obj.__defaults__, obj.__closure__),
+                state=vars(obj),
+                # Can't put __annotations__ and __kwdefaults__ here, since
+                # they're descriptors that don't match a constructor argument.
+                obj=obj
+            )
+        finally:
+            self._saving_functions.pop()
+
+        self.fill_cells(obj)
+
+        if self.prune_globals:
+            # Now that the function is memoized, it's safe to fill in the
+            # pruned globals; push each dictionary, add the items, then pop.
+            ids = self.allow_out_of_band(tuple(new_globals.values()))
+            try:
+                for dictionary, items in ((globals_, new_globals),
+                        (globals_['__builtins__'], new_builtins)):
+                    if items:
+                        self.write(self.get(self.memo[id(dictionary)][0]))
+                        self._batch_setitems(iter(self._dict_items(items)))
+                        self.write(POP)
+            finally:
+                self._out_of_band.difference_update(ids)
 
         if has_descriptors:
-            self.save(obj.__annotations__)
+            self.save(annotations)
             self.save(obj.__kwdefaults__)
             if self.proto >= 2:
                 # Same as above; TUPLE3 can be used.
@@ -300,7 +1508,168 @@ class _Pickler(pickle._Pickler):
                                 # because it's still the same object.
     dispatch[types.FunctionType] = save_function
 
+    def save_module(self, obj):
+        if not _module_by_value(obj, self.module_policy):
+            # See _pickall.Pickler.reduce_type
+            self.save_reduce(__import__, (obj.__name__, None, None, ('*',)),
+                             obj=obj)
+            return
+        # The module, then its __dict__, is memoized before the namespace is
+        # filled in, so that functions from the module share it as their
+        # globals.
+        self.save_reduce(_new_module,
+                         (obj.__name__,
+                          _module_token(obj, self.deterministic)),
+                         obj=obj)
+        namespace = vars(obj)
+        self.save_reduce(vars, (obj,), obj=namespace)
+        builtins_ = namespace.get('__builtins__')
+        if type(builtins_) is dict:
+            self.save_module_dict(builtins_)
+        self._batch_setitems(iter(self._dict_items(namespace)))
+        self.write(POP)
+    dispatch[types.ModuleType] = save_module
+
+    def save_module_dict(self, obj):
+        """Memoize obj as vars(module), if it's the __dict__ of a module in
+        sys.modules that _shared_globals_module picks, so that it's saved with
+        (or as a reference to) that module rather than as a copy; other
+        dictionaries are left alone."""
+        if id(obj) in self.memo:
+            return
+        module = _shared_globals_module(obj, self.module_policy)
+        if module is not None:
+            self.save_reduce(vars, (module,), obj=obj)
+            self.write(POP)
+
+    def allow_out_of_band(self, value):
+        """Let the large bytes and bytearrays in value be saved out-of-band,
+        and return their ids, to be removed from _out_of_band once value is
+        saved.
+
+        Only a code object's fields and pruned globals are allowed, since
+        those are all the C Pickler can offer; see _pickall.out_of_band."""
+        if self.proto < 5 or self._buffer_callback is None:
+            return ()
+        ids = {id(buffer) for buffer in
+               _large_buffers(value, self.buffer_threshold)}
+        self._out_of_band.update(ids)
+        return ids
+
+    def save_out_of_band(self, obj):
+        """Save a bytes or bytearray as an out-of-band buffer, if it's been
+        allowed to be and the buffer_callback wants it.
+
+        Returns False, having written nothing, if it should be in-band."""
+        if (self.proto < 5 or self._buffer_callback is None or
+                id(obj) not in self._out_of_band):
+            return False
+        if self._buffer_callback(PickleBuffer(obj)):
+            return False
+        # The buffer passed to load is converted back with bytes() or
+        # bytearray(); bytes(b) is b, so bytes buffers aren't even copied.
+        self.save(type(obj))
+        self.write(NEXT_BUFFER)
+        if type(obj) is bytes:
+            self.write(READONLY_BUFFER)
+        self.write(TUPLE1 + REDUCE)
+        self.memoize(obj)
+        return True
+
+    def save_bytes(self, obj):
+        if not self.save_out_of_band(obj):
+            pickle._Pickler.save_bytes(self, obj)
+    dispatch[bytes] = save_bytes
+
+    if bytearray in dispatch:  # Python 3.8+
+        def save_bytearray(self, obj):
+            if not self.save_out_of_band(obj):
+                pickle._Pickler.save_bytearray(self, obj)
+        dispatch[bytearray] = save_bytearray
+
+    def memoize(self, obj):
+        super().memoize(obj)
+        if (self._value_memo is not None and type(obj) in (str, bytes) and
+                id(obj) in self.memo):
+            self._value_memo.setdefault((type(obj), obj), self.memo[id(obj)])
+
+    def _canonical_order(self, values, key=lambda value: value):
+        """Return values sorted by key, for deterministic output.
+
+        strs, bytes and ints are compared directly. Anything else (such as
+        a mixture of types, or frozensets, which are only partially ordered)
+        is sorted by what it pickles to."""
+        values = list(values)
+        key_types = {type(key(value)) for value in values}
+        if not (key_types <= {str} or key_types <= {bytes} or
+                key_types <= {int, bool}):
+            value_key = key
+            key = lambda value: _dumps(value_key(value), self.proto,
+                                       prune_globals=self.prune_globals,
+                                       deterministic=True)
+        return sorted(values, key=key)
+
+    def _dict_items(self, obj):
+        if self.deterministic:
+            return self._canonical_order(obj.items(), key=lambda item: item[0])
+        return obj.items()
+
+    def save_dict(self, obj):
+        # The same as pickle._Pickler.save_dict, but with _dict_items
+        if self.bin:
+            self.write(EMPTY_DICT)
+        else:   # proto 0 -- can't use EMPTY_DICT
+            self.write(MARK + DICT)
+        self.memoize(obj)
+        self._batch_setitems(iter(self._dict_items(obj)))
+    dispatch[dict] = save_dict
+
+    def save_set(self, obj):
+        if not self.deterministic:
+            pickle._Pickler.save_set(self, obj)
+            return
+        items = self._canonical_order(obj)
+        if self.proto < 4:
+            self.save_reduce(set, (items,), obj=obj)
+            return
+        self.write(EMPTY_SET)
+        self.memoize(obj)
+        for start in range(0, len(items), self._BATCHSIZE):
+            self.write(MARK)
+            for item in items[start:start + self._BATCHSIZE]:
+                self.save(item)
+            self.write(ADDITEMS)
+    dispatch[set] = save_set
+
+    def save_frozenset(self, obj):
+        if not self.deterministic:
+            pickle._Pickler.save_frozenset(self, obj)
+            return
+        items = self._canonical_order(obj)
+        if self.proto < 4:
+            self.save_reduce(frozenset, (items,), obj=obj)
+            return
+        self.write(MARK)
+        for item in items:
+            self.save(item)
+        if id(obj) in self.memo:
+            # It's recursive; see pickle._Pickler.save_frozenset
+            self.write(POP_MARK + self.get(self.memo[id(obj)][0]))
+            return
+        self.write(FROZENSET)
+        self.memoize(obj)
+    dispatch[frozenset] = save_frozenset
+
     def save_code(self, obj):
+        if self.code_cache is not None:
+            args = _cached_code(self.code_cache, obj, self.slim)
+            ids = self.allow_out_of_band(args)
+            try:
+                self.save_reduce(load_code, args, obj=obj)
+            finally:
+                self._out_of_band.difference_update(ids)
+            return
+
         # This one's not much easier than function.
         func = types.CodeType
         pre_args = ()
@@ -309,28 +1678,48 @@ class _Pickler(pickle._Pickler):
             # not to use it if it's got a chance of actually being pickled.
             pre_args = (func,)
             func = __newobj__
-        self.save_reduce(
-            func, pre_args +
-            (obj.co_argcount, obj.co_kwonlyargcount,
-             obj.co_nlocals, obj.co_stacksize, obj.co_flags, obj.co_code,
-             obj.co_consts, obj.co_names, obj.co_varnames, obj.co_filename,
-             obj.co_name, obj.co_firstlineno, obj.co_lnotab, obj.co_freevars,
-             obj.co_cellvars),
-            obj=obj
-        )
+        args = _slim_code_args(obj) if self.slim else _code_args(obj)
+        ids = self.allow_out_of_band(args)
+        try:
+            self.save_reduce(func, pre_args + args, obj=obj)
+        finally:
+            self._out_of_band.difference_update(ids)
     dispatch[types.CodeType] = save_code
 
     def save_cell(self, obj):
-        self.save_function_call(
-            getattr, (1,
-                ctypes.cast, (1,
-                    ctypes.pythonapi.PyCell_New, (1,
-                        ctypes.py_object, (0, obj.cell_contents)
-                    )
-                ),
-                (0, ctypes.py_object)
-            ), (0, "value")
-        )
+        contents = _cell_contents(obj)
+        if (contents and self._saving_functions and
+                type(contents[0]) not in _atomic_types and
+                id(contents[0]) not in self.memo):
+            # The contents might refer back to a function that's still being
+            # saved, directly or not, and it can't be loaded before its
+            # closure; so the cell is left empty until the outermost one is
+            # memoized, by when they all are.
+            self._unfilled_cells.setdefault(
+                self._saving_functions[0], []).append((obj, contents[0]))
+            contents = ()
+        # _new_cell is pickled by value, so CellType is preferred.
+        self.save_reduce(_CellType or _new_cell, contents, obj=obj)
+
+    def fill_cells(self, func):
+        """Fill in the cells that were left empty while func was being
+        saved, now that it's memoized; see save_cell."""
+        for cell_, value in self._unfilled_cells.pop(id(func), ()):
+            self.fill_cell(cell_, value)
+
+    def fill_cell(self, cell_, value):
+        """Set the contents of an already-saved cell, without using the stack.
+        """
+        if _cell_contents_writable:
+            self.save_reduce(set_cell_contents, (cell_, value))
+        else:
+            import ctypes
+            self.save_function_call(
+                ctypes.pythonapi.PyCell_Set,
+                (1, ctypes.py_object, (0, cell_)),
+                (1, ctypes.py_object, (0, value))
+            )
+        self.write(POP)
     dispatch[cell] = save_cell
 
     def save_compiled_regex(self, obj):
@@ -339,10 +1728,20 @@ class _Pickler(pickle._Pickler):
             (0, obj.pattern),
             (0, obj.flags)
         )
-    dispatch[re._pattern_type] = save_compiled_regex
+    dispatch[_pattern_type] = save_compiled_regex
+
+    def save_generator(self, obj):
+        func, qualname, state = _generator_reduction(obj)
+        self.save_reduce(_new_generator, (func, qualname), obj=obj)
+        # The frame is filled in once the generator is memoized, since what's
+        # in it might refer back to the generator.
+        self.save_reduce(_set_generator_state, (obj, state))
+        self.write(POP)
+    dispatch[types.GeneratorType] = save_generator
+    dispatch[types.CoroutineType] = save_generator
 
     # dispatch_table is a registry of reduction functions
-    dispatch_table = _ChainedDictionary(copyreg.dispatch_table)
+    dispatch_table = _DispatchTable(copyreg.dispatch_table)
 
     # pickle functions from arbitrary CDLLs
     def _ctypes_FuncPtr(name):
@@ -350,8 +1749,35 @@ class _Pickler(pickle._Pickler):
         p= lambda f: basename + f.__name__
         p.__name__ = "pickle_ctypes_{}_FuncPtr".format(name)
         return p
-    dispatch_table[ctypes.pythonapi._FuncPtr] = _ctypes_FuncPtr('pythonapi')
-    dispatch_table[ctypes.PyDLL] = lambda d: "pythonapi"
+
+    # ctypes is slow to import, and none of its types can turn up before it
+    # has been imported.
+    def _add_ctypes(dispatch_table, _ctypes_FuncPtr=_ctypes_FuncPtr):
+        import ctypes
+        dispatch_table[ctypes.pythonapi._FuncPtr] = _ctypes_FuncPtr(
+            'pythonapi')
+        dispatch_table[ctypes.PyDLL] = lambda d: "pythonapi"
+    dispatch_table.add_lazy('ctypes', _add_ctypes)
+
+    # dataclasses tells fields apart, and finds their defaults, by comparing
+    # them with sentinels of its own, so those are pickled by reference.
+    def _add_dataclasses(dispatch_table):
+        import dataclasses
+        dispatch_table[dataclasses._FIELD_BASE] = lambda f: f.name
+        for name in ('MISSING', '_HAS_DEFAULT_FACTORY', 'KW_ONLY'):
+            sentinel = getattr(dataclasses, name, None)
+            if sentinel is not None:
+                dispatch_table[type(sentinel)] = lambda s, name=name: name
+    dispatch_table.add_lazy('dataclasses', _add_dataclasses)
+
+    # Descriptors in the namespaces of classes pickled by value
+    dispatch_table[classmethod] = lambda m: (classmethod, (m.__func__,))
+    dispatch_table[staticmethod] = lambda m: (staticmethod, (m.__func__,))
+    dispatch_table[property] = lambda p: (
+        property, (p.fget, p.fset, p.fdel, p.__doc__))
+    # Read-only views, such as dataclass fields' metadata, are copied.
+    dispatch_table[types.MappingProxyType] = lambda m: (
+        types.MappingProxyType, (dict(m),))
 
     # sys
     dispatch_table[sys.version_info.__class__] = lambda v: "version_info"
@@ -361,28 +1787,41 @@ class _Pickler(pickle._Pickler):
     # dispatch_singletons is documented in save
     # It's like dispatch, but for singletons and using ids as keys.
     dispatch_singletons = {}
-    dispatch_singletons[id(cell)] = lambda s, d={}: s.save_function_call(
-        (1,
-            getattr,  # Takes three arguments; last one has default value None
-            (0, d),
-            (0, "__getitem__"),
-            (1,        # exec returns None, which needs to be discarded from
-                exec,  # the stack; placing it as the third argument to getattr
-                (0,    # serves to discard it
-                    # Golfed quite a bit.
-                    "cell=(lambda x:lambda:x)(0).__closure__[0].__class__"
-                ),
-                (0, d)  # Variable "cell" is put into this dictionary.
-            )
-        ),  # d.__getitem__
-        (0, "cell")
-    )
+    # Without types.CellType, the cell type has no importable name.
+    if _CellType is None:
+        dispatch_singletons[id(cell)] = lambda s, d={}: s.save_function_call(
+            (1,
+                # Takes three arguments; last one has default value None
+                getattr,
+                (0, d),
+                (0, "__getitem__"),
+                # exec returns None, which needs to be discarded from the
+                # stack; placing it as the third argument to getattr serves
+                # to discard it
+                (1,
+                    exec,
+                    (0,
+                        # Golfed quite a bit.
+                        "cell=(lambda x:lambda:x)(0).__closure__[0].__class__"
+                    ),
+                    (0, d)  # Variable "cell" is put into this dictionary.
+                )
+            ),  # d.__getitem__
+            (0, "cell")
+        )
 
 def whichmodule(obj, name):
-    location = resolve_location(obj)
-    if location is not None:
-        # resolvable_location(obj)[1] should == name
-        return location[0]
+    module_name = getattr(obj, '__module__', None)
+    if module_name is None:
+        # Look it up in the index, instead of searching all of sys.modules.
+        location = _location_index.lookup(obj)
+        if location is not None and location[1] == name:
+            return location[0]
+    else:
+        location = resolve_location(obj)
+        if location is not None:
+            # resolve_location(obj)[1] should == name
+            return location[0]
     return pickle.whichmodule(obj, name)
 
 class DebugUnpickler(pickle._Unpickler):
@@ -420,17 +1859,1800 @@ class DebugUnpickler(pickle._Unpickler):
                 raise AttributeError("Stop load from running!")
         return super().__getattribute__(key)
             
-# Shorthands
-_dump = _duplicate(pickle._dump)
-_dumps = _duplicate(pickle._dumps)
-
-# Use the faster _pickall if I ever get around to writing it
-try:
-    from _pickall import (
-        Pickler,
-        dump,
-        dumps,
-    )
-except ImportError:
-    Pickler = _Pickler
-    dump, dumps = _dump, _dumps
+# Payload analysis, for python -m pickall analyze
+class _Node:
+    """A value on the stack of a pickle that's being analyzed.
+
+    own is the number of bytes of opcodes that made or changed this value;
+    size, worked out afterwards, includes its children as well."""
+    __slots__ = ('name', 'value', 'children', 'own', 'ref', 'parent',
+                 'label', 'size', 'digest')
+
+    def __init__(self, name, value=None, children=(), own=0, ref=None):
+        self.name = name
+        self.value = value
+        self.children = list(children)
+        self.own = own
+        self.ref = ref  # The memoized node, for memo gets
+        self.parent = None
+        self.label = None
+
+    def deref(self):
+        return self if self.ref is None else self.ref
+
+    def path(self):
+        """Describe where this is, by the labels of it and its ancestors."""
+        labels = [] if self.label is not None else [self.name]
+        node = self
+        while node is not None:
+            if node.label is not None:
+                labels.append(node.label)
+            node = node.parent
+        return " > ".join(reversed(labels))
+
+class Analysis:
+    """Where the bytes of one pickle went; made by analyze.
+
+    Nothing in the pickle is executed or imported; the opcodes are only
+    simulated on a stack of _Nodes."""
+    # Opcodes that change the value below them in place
+    in_place = frozenset({'APPEND', 'APPENDS', 'SETITEM', 'SETITEMS',
+                          'ADDITEMS', 'BUILD', 'READONLY_BUFFER'})
+    # Opcodes that call a callable; the callable is their first argument
+    calls = frozenset({'REDUCE', 'NEWOBJ', 'NEWOBJ_EX'})
+
+    def __init__(self, file):
+        import pickletools
+        self.markobject = pickletools.markobject
+        self.roots = []     # Values that were popped or returned
+        self.overhead = 0   # PROTO, FRAME, POP and STOP
+        start = file.tell()
+        stack = []
+        memo = {}
+        ops = list(pickletools.genops(file))
+        self.size = file.tell() - start
+        for i, (op, arg, pos) in enumerate(ops):
+            end = ops[i + 1][2] if i + 1 < len(ops) else start + self.size
+            self._step(stack, memo, op, arg, end - pos)
+        self.opcodes = len(ops)
+        self._finish()
+
+    def _step(self, stack, memo, op, arg, size):
+        name = op.name
+        if name in ('PROTO', 'FRAME', 'STOP'):
+            self.overhead += size
+            if name == 'STOP':
+                self.roots.append(stack.pop())
+            return
+        if name == 'MARK':
+            stack.append(self.markobject)
+            stack.append(_Node('MARK', own=size))
+            return
+        if name in ('PUT', 'BINPUT', 'LONG_BINPUT', 'MEMOIZE'):
+            memo[len(memo) if name == 'MEMOIZE' else arg] = stack[-1].deref()
+            stack[-1].own += size
+            return
+        if name in ('GET', 'BINGET', 'LONG_BINGET'):
+            stack.append(_Node(name, own=size, ref=memo[arg]))
+            return
+        if name == 'DUP':
+            stack.append(stack[-1])
+            return
+
+        # Pop the arguments; MARK leaves a marker followed by a node that
+        # holds its byte, so that it can be given to whatever uses it.
+        items = []
+        before = op.stack_before
+        if self.markobject in before:
+            index = len(stack) - 1
+            while stack[index] is not self.markobject:
+                index -= 1
+            items = stack[index + 1:]
+            del stack[index:]
+            size += items.pop(0).own
+            count = before.index(self.markobject)
+            if count:
+                items[:0] = stack[-count:]
+                del stack[-count:]
+        elif before:
+            items = stack[-len(before):]
+            del stack[-len(before):]
+
+        if name in ('POP', 'POP_MARK'):
+            self.overhead += size
+            for item in items:
+                # State setters are called, then popped, after the object
+                # they set up is memoized; they're counted as part of it, as
+                # are memo gets that are popped after adding items to them
+                # (see _Pickler.save_function).
+                target = item
+                if item.name == 'REDUCE' and item.children[1].deref().children:
+                    target = item.children[1].deref().children[0]
+                if target.ref is not None:
+                    self._adopt(target.ref, item)
+                else:
+                    self.roots.append(item)
+            return
+        if name in self.in_place:
+            target, *items = items
+            node = target.deref()
+            target.own += size
+            for item in items:
+                self._adopt(node, item)
+            stack.append(target)
+            return
+
+        node = _Node(name, arg, own=size)
+        for item in items:
+            self._adopt(node, item)
+        if op.stack_after:
+            stack.append(node)
+        else:
+            self.roots.append(node)
+
+    @staticmethod
+    def _adopt(parent, child):
+        child.parent = parent
+        parent.children.append(child)
+
+    def _finish(self):
+        self.nodes = self._post_order()
+        for node in self.nodes:
+            if node.name in self.calls:
+                self._label_call(node)
+            node.size = node.own + sum(child.size for child in node.children)
+            if node.ref is not None:
+                node.digest = hash(('GET', id(node.ref)))
+            else:
+                value = node.value
+                if isinstance(value, bytearray):  # The only unhashable one
+                    value = bytes(value)
+                node.digest = hash((node.name, value,
+                                    tuple(child.digest
+                                          for child in node.children)))
+        if self.roots[-1].label is None:
+            self.roots[-1].label = "pickle"  # The one that STOP returned
+
+    def _post_order(self):
+        """Return every node, children first."""
+        # Without recursion, since pickles can be deep
+        nodes = []
+        stack = list(self.roots)
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(node.children)
+        nodes.reverse()
+        return nodes
+
+    # Callables that are only worth a simpler label
+    call_labels = {
+        '_codecs.encode': "bytes",  # How protocols 0 to 2 save bytes
+        'builtins.bytes': "bytes",
+        'builtins.bytearray': "bytearray",
+    }
+
+    @classmethod
+    def _imported_name(cls, node):
+        """Return the dotted name that node imports, or None.
+
+        As well as GLOBAL and friends, this understands the
+        getattr(__import__(module, ...), qualname) that _pickall uses."""
+        node = node.deref()
+        if node.name in ('GLOBAL', 'INST'):
+            return node.value.replace(' ', '.').replace('__builtin__.',
+                                                        'builtins.')
+        if node.name == 'STACK_GLOBAL':
+            module, qualname = (child.deref().value
+                                for child in node.children)
+            return "{}.{}".format(module, qualname)
+        if node.name == 'REDUCE':
+            func = cls._imported_name(node.children[0])
+            args = [arg.deref() for arg in node.children[1].deref().children]
+            if func == 'builtins.__import__' and args:
+                return args[0].value
+            if func == 'builtins.getattr' and len(args) == 2:
+                module = cls._imported_name(args[0])
+                if module is not None and isinstance(args[1].value, str):
+                    return "{}.{}".format(module, args[1].value)
+        return None
+
+    def _label_call(self, node):
+        if len(node.children) < 2 or self._imported_name(node) is not None:
+            return
+        callable_ = node.children[0].deref()
+        func = self._imported_name(callable_)
+        if func is None and callable_.label is not None:
+            func = callable_.label.replace("function ", "", 1)
+        args = node.children[1].deref().children
+        if func == 'types.FunctionType' and len(args) >= 2:
+            name = args[2].deref().value if len(args) > 2 else None
+            node.label = "function {}".format(name)
+            args[0].label = "code"
+            args[1].label = "globals"
+            self._label_globals(args[1])
+            if len(args) > 4 and args[4].deref().name != 'NONE':
+                args[4].label = "closure"
+        elif func == 'set_function_state' and len(args) == 2:
+            # See set_function_state; this labels the pruned globals.
+            state = args[1].deref().children
+            if len(state) > 3:
+                state[3].label = "globals"
+                self._label_globals(state[3])
+        elif func == 'pickall._new_module' and args:
+            node.label = "module {!r}".format(args[0].deref().value)
+        elif func == 'builtins.vars' and len(args) == 1:
+            # A module's globals; see _Pickler.save_module_dict
+            module = args[0].deref()
+            name = self._imported_name(module)
+            node.label = "globals of {}".format(
+                module.label if name is None else "module {!r}".format(name))
+            self._label_globals(node)
+        elif func == 'set_module_namespace' and len(args) == 2:
+            self._label_globals(args[1])
+        elif func in ('types.CellType', '_new_cell'):
+            node.label = "cell"
+        elif func in ('types.CodeType', 'pickall.load_code'):
+            node.label = "code"
+        elif func is not None:
+            node.label = self.call_labels.get(func, "{}()".format(func))
+        if args and args[0].ref is not None and node.parent is args[0].ref:
+            node.label = "state"  # A state setter; see _step
+
+    @staticmethod
+    def _label_globals(node):
+        """Label the values in node, a dictionary of globals, by their
+        names."""
+        node = node.deref()
+        items = node.children
+        if node.name == 'REDUCE':
+            # vars(module), which _Pickler.save_module adds the items to
+            items = items[2:]
+        for key, value in zip(items[::2], items[1::2]):
+            if value.label is None:
+                value.label = "global {!r}".format(key.deref().value)
+
+    def largest(self, count=20):
+        """Return the count largest labelled nodes."""
+        labelled = [node for node in self.nodes if node.label is not None]
+        labelled.sort(key=lambda node: node.size, reverse=True)
+        return labelled[:count]
+
+    def duplicates(self, min_size=64):
+        """Return lists of identical nodes of at least min_size bytes, that
+        were pickled more than once instead of being memoized; most wasted
+        bytes first. Repeats inside other repeats aren't included."""
+        groups = collections.defaultdict(list)
+        for node in self.nodes:
+            if node.size >= min_size and node.ref is None:
+                groups[node.digest].append(node)
+        groups = [nodes for nodes in groups.values() if len(nodes) > 1]
+        repeated = {id(node) for nodes in groups for node in nodes}
+        groups = [nodes for nodes in groups
+                  if not all(node.parent is not None and
+                             id(node.parent) in repeated for node in nodes)]
+        groups.sort(key=lambda nodes: nodes[0].size * (len(nodes) - 1),
+                    reverse=True)
+        return groups
+
+    def report(self, top=20, min_size=64):
+        lines = ["{} bytes, {} opcodes ({} bytes of PROTO, FRAME, POP and "
+                 "STOP)".format(self.size, self.opcodes, self.overhead),
+                 "", "Largest parts:",
+                 "{:>12} {:>7}  {}".format("bytes", "%", "part")]
+        for node in self.largest(top):
+            lines.append("{:>12} {:>6.1f}%  {}".format(
+                node.size, node.size * 100 / self.size, node.path()))
+        groups = self.duplicates(min_size)
+        lines += ["", "Repeated subtrees that weren't memoized:"]
+        if not groups:
+            lines.append("  (none of at least {} bytes)".format(min_size))
+        else:
+            lines.append("{:>6} {:>12} {:>12}  {}".format(
+                "count", "bytes each", "wasted", "first"))
+        for nodes in groups[:top]:
+            lines.append("{:>6} {:>12} {:>12}  {}".format(
+                len(nodes), nodes[0].size, nodes[0].size * (len(nodes) - 1),
+                nodes[0].path()))
+        return "\n".join(lines)
+
+def analyze(file):
+    """Analyze each pickle in file, a binary file or bytes, in turn.
+
+    Returns a list of Analysis objects."""
+    if isinstance(file, (bytes, bytearray)):
+        file = io.BytesIO(file)
+    analyses = []
+    while True:
+        position = file.tell()
+        if not file.read(1):
+            return analyses
+        file.seek(position)
+        analyses.append(Analysis(file))
+
+def _main(args=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m pickall")
+    commands = parser.add_subparsers(dest='command')
+    analyze_parser = commands.add_parser(
+        'analyze', help="show what takes up the space in a pickle file")
+    analyze_parser.add_argument('file')
+    analyze_parser.add_argument('--top', type=int, default=20,
+                                help="how many parts to list")
+    analyze_parser.add_argument('--min-size', type=int, default=64,
+                                help="smallest repeated subtree to list")
+    args = parser.parse_args(args)
+    if args.command != 'analyze':
+        parser.print_help()
+        return 2
+
+    with open(args.file, 'rb') as file:
+        analyses = analyze(file)
+    for i, analysis in enumerate(analyses):
+        if len(analyses) > 1:
+            print("Pickle {} of {}:".format(i + 1, len(analyses)))
+        print(analysis.report(args.top, args.min_size))
+        print()
+    return 0
+
+# Send-once function registry, for process pools
+
+# Maps each code object to a dictionary mapping the id of its globals and
+# whether it's slim to (digest, globals, attributes), for RegistryPickler;
+# the globals are kept so that their id isn't reused.
+_registry_templates = None
+
+class RegistryPickler(_Pickler):
+    """A _Pickler that sends each function's template only once.
+
+    A function's template is its code, globals, defaults and other
+    attributes; sent is the set of digests of the templates the unpickling
+    side's FunctionRegistry already has. The digests of the templates that
+    a dump writes are collected in new_digests, and only added to sent once
+    the dump has finished, so that a failed dump doesn't leave sent
+    claiming templates that were never sent. Functions are then sent as
+    their digest and the contents of their closure cells, which is usually
+    all that changes between calls.
+
+    The data must be loaded with an Unpickler whose persistent_load is a
+    FunctionRegistry's.
+    """
+    dispatch = _Pickler.dispatch.copy()
+
+    def __init__(self, file, protocol=None, *, sent, **kwargs):
+        super().__init__(file, protocol, **kwargs)
+        if not self.bin:
+            raise ValueError("RegistryPickler needs protocol >= 1")
+        self.sent = sent
+        self.new_digests = set()
+
+    def dump(self, obj):
+        self.new_digests = set()
+        super().dump(obj)
+        self.sent.update(self.new_digests)
+
+    _template_attributes = ('__name__', '__qualname__', '__defaults__',
+                            '__kwdefaults__', '__annotations__', '__dict__',
+                            '__doc__', '__module__')
+
+    # Left out of templates by slim picklers
+    _slim_attributes = ('__annotations__', '__doc__')
+
+    def _template(self, obj):
+        templates = _weak_key_cache('_registry_templates').setdefault(
+            obj.__code__, {})
+        key = id(obj.__globals__), self.slim
+        try:
+            return templates[key]
+        except KeyError:
+            pass
+        import hashlib
+        digest = hashlib.sha1(marshal.dumps(obj.__code__))
+        digest.update(str(key).encode("ascii"))
+        attributes = {}
+        for name in self._template_attributes:
+            if self.slim and name in self._slim_attributes:
+                continue
+            value = getattr(obj, name)
+            if isinstance(value, dict):
+                value = value.copy()  # Later changes mustn't affect it.
+            attributes[name] = value
+        template = digest.hexdigest(), obj.__globals__, attributes
+        templates[key] = template
+        return template
+
+    def save_function(self, obj):
+        if obj.__module__ in ('ctypes',) or obj in _by_reference:
+            return super().save_function(obj)
+
+        digest, globals_, attributes = self._template(obj)
+        if digest not in self.sent and digest not in self.new_digests:
+            self.new_digests.add(digest)
+            # Loading this registers the template and pushes its (empty)
+            # globals, which are only filled in afterwards so that they can
+            # refer to the function.
+            self.save_pers(('pickall.template', digest, obj.__code__,
+                            attributes))
+            if self.prune_globals:
+                names = _global_names(obj.__code__)
+                items = [(name, globals_[name]) for name in names
+                         if name in globals_]
+                builtins_ = globals_.get('__builtins__', builtins)
+                if isinstance(builtins_, types.ModuleType):
+                    builtins_ = vars(builtins_)
+                items.append(('__builtins__', {
+                    name: builtins_[name] for name in names
+                    if name not in globals_ and name in builtins_
+                }))
+            else:
+                items = list(globals_.items())
+            self._batch_setitems(iter(items))
+            self.write(POP)
+
+        # Attributes that differ from the template's go with the function.
+        changed = {}
+        for name, value in attributes.items():
+            current = getattr(obj, name)
+            if current is not value and current != value:
+                changed[name] = current
+
+        # The cells are saved as _Pickler.save_function saves them, so that
+        # ones referring back to obj are filled in once it's memoized.
+        self._saving_functions.append(id(obj))
+        try:
+            self.save_pers(('pickall.function', digest, obj.__closure__,
+                            changed))
+        finally:
+            self._saving_functions.pop()
+        if id(obj) in self.memo:
+            # It's recursive; see pickle._Pickler.save_reduce
+            self.write(POP + self.get(self.memo[id(obj)][0]))
+        else:
+            self.memoize(obj)
+        self.fill_cells(obj)
+    dispatch[types.FunctionType] = save_function
+
+class FunctionRegistry:
+    """The unpickling side of RegistryPickler.
+
+    Use its persistent_load as an Unpickler's; the templates it's been sent
+    stay registered for later loads."""
+    def __init__(self):
+        self.templates = {}
+
+    def persistent_load(self, pid):
+        kind, digest, *args = pid
+        if kind == 'pickall.template':
+            code, attributes = args
+            globals_ = {}
+            self.templates[digest] = code, globals_, attributes
+            return globals_
+        elif kind == 'pickall.function':
+            closure, changed = args
+            code, globals_, attributes = self.templates[digest]
+            func = types.FunctionType(code, globals_, attributes['__name__'],
+                                      attributes['__defaults__'], closure)
+            for name, value in attributes.items():
+                if name == '__dict__':
+                    func.__dict__.update(value)
+                else:
+                    setattr(func, name, value)
+            for name, value in changed.items():
+                setattr(func, name, value)
+            return func
+        raise UnpicklingError("unsupported persistent id: {!r}".format(pid))
+
+def _registry_worker(connection):
+    """The main loop of a ProcessPoolExecutor's worker process."""
+    registry = FunctionRegistry()
+    while True:
+        data = connection.recv_bytes()
+        if not data:
+            return
+        # The task id is outside the pickle, so that a task that can't be
+        # loaded only fails its own future.
+        task_id = int.from_bytes(data[:8], 'little')
+        try:
+            unpickler = Unpickler(io.BytesIO(data[8:]))
+            unpickler.persistent_load = registry.persistent_load
+            fn, args, kwargs = unpickler.load()
+            result = True, fn(*args, **kwargs)
+        except BaseException as e:
+            result = False, e
+        try:
+            data = dumps((task_id,) + result, HIGHEST_PROTOCOL)
+        except Exception as e:
+            data = dumps((task_id, False, PicklingError(
+                "Can't pickle result: {!r}".format(e))), HIGHEST_PROTOCOL)
+        connection.send_bytes(data)
+
+class ProcessPoolExecutor:
+    """A process pool that only sends each function's template once per
+    worker, using RegistryPickler.
+
+    pickler_options are passed on to RegistryPickler; by default, globals
+    are pruned. Submitted functions are otherwise treated like
+    concurrent.futures.ProcessPoolExecutor's, but are pickled by value.
+    """
+    def __init__(self, max_workers=None, mp_context=None, **pickler_options):
+        import multiprocessing
+        import os
+        import threading
+        if mp_context is None:
+            mp_context = multiprocessing.get_context()
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        pickler_options.setdefault('prune_globals', True)
+        self._pickler_options = pickler_options
+        self._futures = {}
+        self._task_ids = iter(range(sys.maxsize))
+        self._lock = threading.Lock()
+        self._shutdown = False
+        self._next_worker = 0
+        self._workers = []
+        for _ in range(max_workers):
+            connection, child_connection = mp_context.Pipe()
+            process = mp_context.Process(target=_registry_worker,
+                                         args=(child_connection,),
+                                         daemon=True)
+            process.start()
+            child_connection.close()
+            reader = threading.Thread(target=self._read_results,
+                                      args=(connection,), daemon=True)
+            reader.start()
+            # Each worker has its own set of sent template digests, and its
+            # own lock, so that tasks are pickled and sent to it in turn
+            # without holding up the other workers' results.
+            self._workers.append((process, connection, reader, set(),
+                                  threading.Lock()))
+
+    def _read_results(self, connection):
+        while True:
+            try:
+                task_id, ok, value = loads(connection.recv_bytes())
+            except (EOFError, OSError):
+                break
+            future, _ = self._futures.pop(task_id)
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+        # The worker has gone away.
+        with self._lock:
+            futures = [future for task_id, (future, worker_connection)
+                       in list(self._futures.items())
+                       if worker_connection is connection]
+        for future in futures:
+            if not future.done():
+                future.set_exception(RuntimeError(
+                    "A worker process terminated abruptly"))
+
+    def submit(self, fn, *args, **kwargs):
+        from concurrent.futures import Future
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("cannot submit after shutdown")
+            task_id = next(self._task_ids)
+            process, connection, reader, sent, send_lock = self._workers[
+                self._next_worker]
+            self._next_worker = (self._next_worker + 1) % len(self._workers)
+            future = Future()
+            self._futures[task_id] = future, connection
+
+        # Sending can block until the worker's reader takes results off the
+        # pipe, so it's done without holding self._lock.
+        with send_lock:
+            new_digests = ()
+            try:
+                if self._shutdown:
+                    # The worker may already have been told to exit.
+                    raise RuntimeError("cannot submit after shutdown")
+                f = io.BytesIO()
+                f.write(task_id.to_bytes(8, 'little'))
+                pickler = RegistryPickler(f, HIGHEST_PROTOCOL, sent=sent,
+                                          **self._pickler_options)
+                new_digests = pickler.new_digests
+                pickler.dump((fn, args, kwargs))
+                connection.send_bytes(f.getbuffer())
+            except BaseException:
+                # The worker never got these templates.
+                self._futures.pop(task_id, None)
+                sent.difference_update(new_digests)
+                raise
+        return future
+
+    def map(self, fn, *iterables, timeout=None, chunksize=1):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return (future.result(timeout) for future in futures)
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+        for process, connection, reader, sent, send_lock in self._workers:
+            with send_lock:
+                try:
+                    connection.send_bytes(b'')
+                except OSError:
+                    pass  # The worker has already exited.
+        if wait:
+            for process, connection, reader, sent, send_lock in self._workers:
+                process.join()
+                reader.join()
+                connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown(wait=True)
+        return False
+
+# Streaming
+class _ChunkWriter:
+    """A file that passes on what's written to it, a frame at a time.
+
+    The framer writes each frame's contents as a memoryview, after its
+    header; anything else is held until then. Large bytes that are written
+    outside of frames (see pickle._Framer.write_large_bytes) are passed on
+    by themselves."""
+    def __init__(self, put, frame_size):
+        self._put = put
+        self.frame_size = frame_size
+        self.pending = []
+        self.cancelled = False
+
+    def put(self, chunk):
+        if self.cancelled:
+            raise _Cancelled
+        self._put(chunk)
+
+    def write(self, data):
+        if isinstance(data, memoryview):
+            # Only valid during this call, on Python 3.6 and 3.7
+            self.pending.append(data)
+            self.flush()
+        elif len(data) >= self.frame_size:
+            self.flush()
+            self.put(bytes(data))
+        else:
+            self.pending.append(data)
+        return len(data)
+
+    def flush(self):
+        if self.pending:
+            chunk = b"".join(self.pending)
+            self.pending.clear()
+            self.put(chunk)
+
+class _ChunkReader:
+    """A file that reads from an iterable of bytes-like chunks, only
+    taking each chunk when it's needed."""
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = b""
+        self.position = 0
+
+    def _next_chunk(self):
+        for chunk in self.chunks:
+            if chunk:
+                self.buffer = chunk if type(chunk) is bytes else bytes(chunk)
+                self.position = 0
+                return True
+        return False
+
+    def read(self, size=-1):
+        parts = []
+        while size:
+            if self.position == len(self.buffer) and not self._next_chunk():
+                break
+            end = len(self.buffer)
+            if size > 0:
+                end = min(end, self.position + size)
+                size -= end - self.position
+            if self.position == 0 and end == len(self.buffer):
+                parts.append(self.buffer)  # Whole frames aren't copied
+            else:
+                parts.append(self.buffer[self.position:end])
+            self.position = end
+        return b"".join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        parts = []
+        while self.position < len(self.buffer) or self._next_chunk():
+            end = self.buffer.find(b"\n", self.position) + 1
+            if not end:
+                end = len(self.buffer)
+            parts.append(self.buffer[self.position:end])
+            self.position = end
+            if parts[-1].endswith(b"\n"):
+                break
+        return b"".join(parts)
+
+class _Cancelled(Exception):
+    """Stops a dump_iter pickler when the generator is closed."""
+
+def dump_iter(obj, protocol=None, *, frame_size=64 * 1024, queue_size=2,
+              **kwargs):
+    """Pickle obj, returning a generator of the pickle a frame at a time.
+
+    Each chunk is a complete frame of about frame_size bytes, or a large
+    bytes object (or its opcode) that protocol 5 writes outside of frames;
+    see pickle._Framer.write_large_bytes. The pickler runs in a thread,
+    which waits once queue_size chunks are waiting to be taken; so memory
+    use doesn't depend on the size of the pickle. obj mustn't be changed
+    until the generator is exhausted or closed.
+
+    protocol must be 4 or higher, since lower protocols don't have frames.
+    Other keyword arguments are passed to _Pickler."""
+    import queue
+    chunks = queue.Queue(queue_size)
+    writer = _ChunkWriter(chunks.put, frame_size)
+    pickler = _Pickler(writer, protocol, frame_size=frame_size, **kwargs)
+    if pickler.proto < 4:
+        raise ValueError("dump_iter needs protocol 4 or higher")
+    return _dump_chunks(pickler, writer, obj, chunks)
+
+def _dump_chunks(pickler, writer, obj, chunks):
+    import queue
+    import threading
+    def dump():
+        # The chunks are followed by None, or the exception that stopped it
+        try:
+            pickler.dump(obj)
+            writer.flush()
+        except _Cancelled:
+            return
+        except BaseException as e:
+            chunks.put(e)
+        else:
+            chunks.put(None)
+
+    thread = threading.Thread(target=dump, daemon=True)
+    thread.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            yield chunk
+    finally:
+        # Let the pickler stop at its next chunk, if it's still going.
+        writer.cancelled = True
+        while thread.is_alive():
+            try:
+                chunks.get(timeout=0.01)
+            except queue.Empty:
+                pass
+
+def load_iter(chunks, **kwargs):
+    """Unpickle an object from an iterable of bytes-like chunks, such as
+    dump_iter generates, taking each chunk only when it's needed.
+
+    Keyword arguments are passed to Unpickler."""
+    return Unpickler(_ChunkReader(chunks), **kwargs).load()
+
+# Compression
+# Codecs for dump_compressed, by name: (compress(data, level), decompress)
+_codecs = {}
+
+def register_codec(name, compress, decompress):
+    """Make a compression codec available to dump_compressed by name.
+
+    compress(data, level) returns the compressed form of a bytes-like
+    object, using the codec's default level if level is None, and
+    decompress(data) reverses it. Each frame is compressed separately.
+    """
+    if len(name.encode('ascii')) > 255:
+        raise ValueError("codec name is too long")
+    _codecs[name] = compress, decompress
+
+def _codec(name):
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("unknown codec {!r}".format(name)) from None
+
+# lzma and bz2 are optional parts of the standard library, so these are
+# only imported when they're used.
+def _zlib_compress(data, level):
+    import zlib
+    return zlib.compress(data, -1 if level is None else level)
+
+def _zlib_decompress(data):
+    import zlib
+    return zlib.decompress(data)
+
+def _lzma_compress(data, level):
+    import lzma
+    # FORMAT_ALONE's header is much smaller than FORMAT_XZ's.
+    return lzma.compress(data, lzma.FORMAT_ALONE, preset=level)
+
+def _lzma_decompress(data):
+    import lzma
+    return lzma.decompress(data, lzma.FORMAT_ALONE)
+
+def _bz2_compress(data, level):
+    import bz2
+    return bz2.compress(data, 9 if level is None else level)
+
+def _bz2_decompress(data):
+    import bz2
+    return bz2.decompress(data)
+
+register_codec('zlib', _zlib_compress, _zlib_decompress)
+register_codec('lzma', _lzma_compress, _lzma_decompress)
+register_codec('bz2', _bz2_compress, _bz2_decompress)
+
+# A compressed pickle is this, the length and ASCII name of its codec, then
+# blocks of a little-endian 8-byte length and that much compressed data,
+# ending with an empty block.
+_compressed_magic = b'PKALZ1'
+_block_header = '<Q'
+
+def dump_compressed(obj, file, protocol=None, *, codec='zlib', level=None,
+                    frame_size=64 * 1024, **kwargs):
+    """Pickle obj to file, compressing each frame separately as it's
+    written, so that the pickle is never held uncompressed as a whole.
+
+    codec is the name of a codec given to register_codec: 'zlib', 'lzma'
+    and 'bz2' are built in. level is passed on to it. Bigger frames
+    compress better, but need more memory to write and read.
+
+    protocol must be 4 or higher. Other keyword arguments are passed to
+    _Pickler. Load it with load_compressed, or an Unpickler reading from a
+    CompressedReader."""
+    import struct
+    compress, _ = _codec(codec)
+
+    def put(chunk):
+        data = compress(chunk, level)
+        file.write(struct.pack(_block_header, len(data)))
+        file.write(data)
+
+    writer = _ChunkWriter(put, frame_size)
+    pickler = _Pickler(writer, protocol, frame_size=frame_size, **kwargs)
+    if pickler.proto < 4:
+        raise ValueError("dump_compressed needs protocol 4 or higher")
+    name = codec.encode('ascii')
+    file.write(_compressed_magic + bytes((len(name),)) + name)
+    pickler.dump(obj)
+    writer.flush()
+    file.write(struct.pack(_block_header, 0))
+
+def dumps_compressed(obj, protocol=None, **kwargs):
+    f = io.BytesIO()
+    dump_compressed(obj, f, protocol, **kwargs)
+    return f.getvalue()
+
+def _read_exactly(file, size):
+    parts = []
+    while size:
+        data = file.read(size)
+        if not data:
+            raise UnpicklingError("compressed pickle is truncated")
+        parts.append(data)
+        size -= len(data)
+    return b"".join(parts)
+
+class CompressedReader(_ChunkReader):
+    """A file that reads the pickles that dump_compressed wrote to file,
+    decompressing each block only when it's needed."""
+    def __init__(self, file):
+        super().__init__(self._blocks(file))
+        # The first block is read now, since the C Unpickler turns errors
+        # reading the first opcode into EOFError.
+        self._next_chunk()
+
+    @staticmethod
+    def _blocks(file):
+        import struct
+        header_size = struct.calcsize(_block_header)
+        while True:
+            # Pickles can follow each other in file, like uncompressed ones.
+            magic = file.read(len(_compressed_magic))
+            if not magic:
+                return
+            if magic != _compressed_magic:
+                raise UnpicklingError("not a compressed pickle")
+            name = _read_exactly(file, _read_exactly(file, 1)[0])
+            _, decompress = _codec(name.decode('ascii'))
+            size, = struct.unpack(_block_header,
+                                  _read_exactly(file, header_size))
+            while size:
+                data = _read_exactly(file, size)
+                # The next header is read first, so that the empty block
+                # ending the pickle has been read once its last block has.
+                size, = struct.unpack(_block_header,
+                                      _read_exactly(file, header_size))
+                yield decompress(data)
+
+def load_compressed(file, **kwargs):
+    """Unpickle an object that dump_compressed wrote to file; keyword
+    arguments are passed to Unpickler."""
+    return Unpickler(CompressedReader(file), **kwargs).load()
+
+def loads_compressed(data, **kwargs):
+    return load_compressed(io.BytesIO(data), **kwargs)
+
+# asyncio
+def _running_loop():
+    import asyncio
+    if sys.version_info >= (3, 7):
+        return asyncio.get_running_loop()
+    # Python 3.6 has no get_running_loop, but this is the same in coroutines
+    return asyncio.get_event_loop()
+
+def _run_in_thread(loop, executor, func):
+    """Return an asyncio future for func(), called by executor, or in a new
+    thread if executor is None."""
+    if executor is not None:
+        return loop.run_in_executor(executor, func)
+    import threading
+    future = loop.create_future()
+
+    def set_result(result, exception):
+        if future.cancelled():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def run():
+        try:
+            result = func()
+        except BaseException as e:
+            result, exception = None, e
+        else:
+            exception = None
+        try:
+            loop.call_soon_threadsafe(set_result, result, exception)
+        except RuntimeError:
+            # The loop is closed, so nothing is waiting for the result.
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+class _LoopCaller:
+    """Runs coroutines in an event loop for another thread, until cancel is
+    called in the loop's thread."""
+    def __init__(self, loop):
+        self.loop = loop
+        self.cancelled = False
+        self.pending = None
+
+    def __call__(self, coroutine):
+        """Return coroutine's result, once the loop has run it; raise
+        _Cancelled if cancel has been called, or the loop is closed."""
+        import asyncio
+        import concurrent.futures
+        if self.cancelled:
+            coroutine.close()
+            raise _Cancelled
+        try:
+            future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        except RuntimeError:
+            coroutine.close()
+            raise _Cancelled
+        self.pending = future
+        # cancel may have been called before pending was set.
+        if self.cancelled:
+            raise _Cancelled
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise _Cancelled from None
+
+    def cancel(self):
+        self.cancelled = True
+        if self.pending is not None:
+            self.pending.cancel()
+
+class _AsyncReaderFile:
+    """A file that reads from an asyncio StreamReader, for an Unpickler
+    that's running in a thread other than the event loop's."""
+    def __init__(self, reader, loop):
+        self.reader = reader
+        self._wait = _LoopCaller(loop)
+
+    def cancel(self):
+        """Make reads raise _Cancelled, including one that's waiting."""
+        self._wait.cancel()
+
+    def read(self, size=-1):
+        import asyncio
+        if size < 0:
+            return self._wait(self.reader.read())
+        try:
+            return self._wait(self.reader.readexactly(size))
+        except asyncio.IncompleteReadError as e:
+            return e.partial
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def readline(self):
+        return self._wait(self.reader.readline())
+
+async def dump_async(obj, writer, protocol=None, *, frame_size=64 * 1024,
+                     queue_size=2, executor=None, **kwargs):
+    """Pickle obj to writer, an asyncio StreamWriter, a frame at a time.
+
+    As with dump_iter, the pickling is done in another thread, since it
+    can't be paused part-way through; it's done by executor if that's
+    given, or else in a thread of its own. Each frame is written and
+    drained before the pickler is let past the next queue_size frames, so
+    the event loop only ever waits for the GIL, and the writer's flow
+    control is respected. obj mustn't be changed until this returns.
+
+    protocol must be 4 or higher. Other keyword arguments are passed to
+    _Pickler. If this is cancelled, the pickler stops at its next frame."""
+    import asyncio
+    loop = _running_loop()
+    chunks = asyncio.Queue(queue_size)
+    call = _LoopCaller(loop)
+
+    def put(chunk):
+        call(chunks.put(chunk))
+
+    chunk_writer = _ChunkWriter(put, frame_size)
+    pickler = _Pickler(chunk_writer, protocol, frame_size=frame_size,
+                       **kwargs)
+    if pickler.proto < 4:
+        raise ValueError("dump_async needs protocol 4 or higher")
+
+    def dump():
+        # See _dump_chunks
+        try:
+            pickler.dump(obj)
+            chunk_writer.flush()
+        except _Cancelled:
+            return
+        except BaseException as e:
+            end = e
+        else:
+            end = None
+        try:
+            put(end)
+        except _Cancelled:
+            pass
+
+    _run_in_thread(loop, executor, dump)
+    try:
+        while True:
+            chunk = await chunks.get()
+            if chunk is None:
+                return
+            if isinstance(chunk, BaseException):
+                raise chunk
+            writer.write(chunk)
+            await writer.drain()
+    finally:
+        # Stop the pickler at its next chunk, if it's still going; this
+        # also wakes it if it's waiting for room in chunks.
+        call.cancel()
+
+async def load_async(reader, *, executor=None, **kwargs):
+    """Unpickle an object from reader, an asyncio StreamReader.
+
+    The Unpickler runs in another thread (see dump_async), and waits for
+    the event loop to read each frame; pickles with protocol 4 or higher
+    are read a frame at a time, but older ones need a read per opcode.
+    If this is cancelled, the Unpickler stops at its next read. Keyword
+    arguments are passed to Unpickler."""
+    loop = _running_loop()
+    file = _AsyncReaderFile(reader, loop)
+    unpickler = Unpickler(file, **kwargs)
+    try:
+        return await _run_in_thread(loop, executor, unpickler.load)
+    finally:
+        file.cancel()
+
+# Archives
+class _ArchivePickler(_Pickler):
+    """The pickler for an Archive's deduplicated entries.
+
+    Code objects are saved as persistent ids referring to the archive's
+    shared code records, and each module's pruned globals are saved as a
+    persistent id for the archive's copy of them, which the entry then adds
+    the globals its functions need to; see Archive.
+    """
+    dispatch = _Pickler.dispatch.copy()
+
+    def __init__(self, file, protocol=None, *, archive, **kwargs):
+        kwargs['prune_globals'] = True
+        super().__init__(file, protocol, **kwargs)
+        if not self.bin:
+            raise ValueError("dedupe needs protocol >= 1")
+        self.archive = archive
+        # Maps the id of each pruned globals dictionary to it and the name
+        # of the module it's from.
+        self._shared_globals = {}
+
+    def persistent_id(self, obj):
+        if type(obj) is types.CodeType:
+            return 'pickall.code', self.archive._add_code(obj, self.slim)
+        return None
+
+    def save(self, obj, save_persistent_id=True):
+        shared = self._shared_globals.get(id(obj))
+        if shared is not None and id(obj) not in self.memo:
+            # The dictionaries are memoized so that save_function can push
+            # them again to fill them in.
+            pruned, name = shared
+            self.save_pers(('pickall.globals', name))
+            self.memoize(pruned)
+            self.save_pers(('pickall.builtins', name))
+            self.memoize(pruned['__builtins__'])
+            self.write(POP)
+            return
+        super().save(obj, save_persistent_id)
+
+    def save_function(self, obj):
+        globals_ = obj.__globals__
+        if id(globals_) not in self._pruned_globals:
+            module = _globals_module(globals_)
+            if module is not None:
+                # Start the session off as _pruned_globals would, but noting
+                # which dictionaries are the module's. Other namespaces
+                # have no name to share them by, so their globals are saved
+                # with the entry.
+                pruned = {'__builtins__': {}}
+                self._pruned_globals[id(globals_)] = globals_, pruned, set()
+                self._shared_globals[id(pruned)] = pruned, globals_['__name__']
+        super().save_function(obj)
+    dispatch[types.FunctionType] = save_function
+
+class Archive:
+    """A file of many separately pickled entries, with an index of them.
+
+    mode is 'r' to read an existing archive, 'w' to create a new one, or
+    'a' to add entries to an existing archive (or create it). In 'r' mode
+    the file is memory-mapped, so loading an entry only reads that entry
+    (and the index).
+
+    Each entry is a complete pickle, made by dumps with the protocol and
+    any other keyword arguments given here, so raw(name) can be loaded with
+    pickle.loads. With dedupe=True, entries are instead made by a _Pickler
+    that stores each distinct code object once for the whole archive, and
+    gives the functions from each module in sys.modules one globals
+    dictionary between them, which each entry adds the globals it needs to
+    (so it's like the module's, after loading). These entries need the
+    archive's persistent_load, which load uses; dedupe implies
+    prune_globals.
+
+    The format is a header pointing to a pickled index, then the entries
+    and shared code records. close writes a new index after everything
+    else, and only then points the header at it; until then, the old index
+    is still there, so an archive that isn't closed still has the entries
+    it had before.
+    """
+    _magic = b'PKALARC2'
+    _header_format = '<8sQQ'  # _magic, index offset, index length
+
+    def __init__(self, path, mode='r', *, protocol=None, dedupe=False,
+                 **kwargs):
+        import os
+        import mmap
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError("mode must be 'r', 'w' or 'a'")
+        if mode == 'a' and not os.path.exists(path):
+            mode = 'w'
+        self.mode = mode
+        self.protocol = protocol
+        self.dedupe = dedupe
+        self.pickler_options = kwargs
+        self._code_cache = CodeCache()
+        self._loaded_code = {}
+        self._globals = {}
+        self._mmap = None
+        self._file = open(path, {'r': 'rb', 'w': 'w+b', 'a': 'r+b'}[mode])
+        try:
+            if mode == 'w':
+                self._write_header(0, 0)
+                self._end = self._file.tell()
+                self._entries = {}
+                self._code = {}
+                return
+            if mode == 'r':
+                self._mmap = mmap.mmap(self._file.fileno(), 0,
+                                       access=mmap.ACCESS_READ)
+            self._read_index()
+            # New entries go after the old index, which stays valid.
+            self._end = self._file.seek(0, io.SEEK_END)
+        except BaseException:
+            self.close()
+            raise
+
+    def _read(self, offset, length):
+        if self._file is None:
+            raise ValueError("archive is closed")
+        if self._mmap is not None:
+            return memoryview(self._mmap)[offset:offset + length]
+        self._file.seek(offset)
+        return self._file.read(length)
+
+    def _write_header(self, index_offset, index_length):
+        import struct
+        self._file.seek(0)
+        self._file.write(struct.pack(self._header_format, self._magic,
+                                     index_offset, index_length))
+
+    def _read_index(self):
+        import struct
+        header_size = struct.calcsize(self._header_format)
+        size = self._file.seek(0, io.SEEK_END)
+        if size < header_size:
+            raise UnpicklingError("not a pickall archive")
+        magic, index_offset, index_length = struct.unpack(
+            self._header_format, self._read(0, header_size))
+        if magic != self._magic:
+            raise UnpicklingError("not a pickall archive")
+        if not index_offset:
+            raise UnpicklingError("pickall archive has no index")
+        if index_offset < header_size or index_offset + index_length > size:
+            raise UnpicklingError("pickall archive's index is truncated")
+        try:
+            entries, code = loads(self._read(index_offset, index_length))
+            if not (type(entries) is dict and type(code) is dict):
+                raise TypeError("index isn't two dicts")
+        except Exception as e:
+            raise UnpicklingError(
+                "pickall archive's index is malformed: {}".format(e)) from e
+        self._entries, self._code = entries, code
+
+    def _write(self, data):
+        self._file.seek(self._end)
+        self._file.write(data)
+        offset = self._end
+        self._end += len(data)
+        return offset, len(data)
+
+    def _check_writable(self):
+        if self._file is None:
+            raise ValueError("archive is closed")
+        if self.mode == 'r':
+            raise ValueError("archive isn't writable in 'r' mode")
+
+    def _add_code(self, code, slim):
+        """Store code as a shared record, unless there already is one, and
+        return its digest."""
+        digest, data = _cached_code(self._code_cache, code, slim)
+        if digest not in self._code:
+            self._code[digest] = self._write(data)
+        return digest
+
+    def add(self, name, obj):
+        """Pickle obj as the entry name, which mustn't already exist."""
+        self._check_writable()
+        if name in self._entries:
+            raise ValueError("archive already has an entry {!r}".format(name))
+        if self.dedupe:
+            f = io.BytesIO()
+            _ArchivePickler(f, self.protocol, archive=self,
+                            **self.pickler_options).dump(obj)
+            data = f.getvalue()
+        else:
+            data = dumps(obj, self.protocol, **self.pickler_options)
+        self._entries[name] = self._write(data) + (self.dedupe,)
+
+    def raw(self, name):
+        """Return the pickle for the entry name, as a bytes-like object; in
+        'r' mode, it's a memoryview of the file, which must be released
+        before the archive is closed."""
+        offset, length, _ = self._entries[name]
+        return self._read(offset, length)
+
+    def load(self, name, **kwargs):
+        """Unpickle the entry name; keyword arguments are passed to
+        Unpickler."""
+        data = self.raw(name)
+        if not self._entries[name][2]:
+            return loads(data, **kwargs)
+        unpickler = Unpickler(io.BytesIO(data), **kwargs)
+        unpickler.persistent_load = self.persistent_load
+        return unpickler.load()
+
+    def persistent_load(self, pid):
+        kind, key = pid
+        if kind == 'pickall.code':
+            try:
+                return self._loaded_code[key]
+            except KeyError:
+                pass
+            code = self._loaded_code[key] = marshal.loads(
+                self._read(*self._code[key]))
+            return code
+        elif kind == 'pickall.globals':
+            return self._globals.setdefault(key, {'__builtins__': {}})
+        elif kind == 'pickall.builtins':
+            return self._globals.setdefault(
+                key, {'__builtins__': {}})['__builtins__']
+        raise UnpicklingError("unsupported persistent id: {!r}".format(pid))
+
+    def names(self):
+        return list(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def close(self):
+        """Write the index if the archive is writable, and close it."""
+        if self._file is None:
+            return
+        try:
+            if self.mode != 'r':
+                index = self._write(dumps((self._entries, self._code), 4))
+                self._file.truncate()
+                self._file.flush()
+                self._write_header(*index)
+        finally:
+            if self._mmap is not None:
+                self._mmap.close()
+            self._file.close()
+            self._file = self._mmap = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+# Delta pickling
+class _Fingerprints:
+    """Merkle fingerprints of an object graph, for Snapshot and dumps_delta.
+
+    An object's fingerprint is a digest of its type and its parts'
+    fingerprints, so equal graphs have equal fingerprints, even in
+    different processes, and a change only changes the fingerprints of
+    the objects on its way up to the root. Dictionaries, lists, tuples,
+    sets, functions, cells and code objects are broken down into parts;
+    functions' parts include the globals they refer to. Anything else is
+    fingerprinted by its deterministic pickle.
+
+    by_id maps the ids of the objects that are worth referring to, rather
+    than pickling (see min_size), to their keys, and objects maps their keys
+    to them. A key is the object's fingerprint, with the number of distinct
+    objects already met with that fingerprint appended, so that equal but
+    distinct objects stay distinct; both sides meet them in the same order.
+    Atomic objects' identities don't matter (and aren't kept by pickling),
+    so their keys are just their fingerprints."""
+    # Objects whose pickles are estimated to be smaller than this are
+    # pickled anyway, since a persistent id isn't free.
+    min_size = 64
+    # Maps atomic types to a tag and a function encoding their values
+    _atomic = {
+        str: (b's', lambda obj: obj.encode('utf-8', 'surrogatepass')),
+        bytes: (b'b', lambda obj: obj),
+        int: (b'i', lambda obj: str(obj).encode('ascii')),
+        bool: (b'?', lambda obj: b'1' if obj else b'0'),
+        float: (b'f', lambda obj: obj.hex().encode('ascii')),
+        complex: (b'c', lambda obj: repr(obj).encode('ascii')),
+        type(None): (b'n', lambda obj: b''),
+    }
+
+    def __init__(self, obj):
+        self.by_id = {}
+        self.objects = {}
+        # Maps ids to (fingerprint, size, object); the object is kept so
+        # that its id isn't reused, since some attributes (such as co_code,
+        # on Python 3.11) are made anew each time they're got.
+        self._done = {}
+        self._in_progress = {}  # Maps ids to their depth
+        self._recorded = []
+        self._counts = {}  # Maps fingerprints to how many objects have them
+        import hashlib
+        self._sha1 = hashlib.sha1
+        self.root = self._fingerprint(obj)[0]
+
+    def _fingerprint(self, obj):
+        """Return obj's fingerprint and an estimate of its pickled size."""
+        t = type(obj)
+        atomic = self._atomic.get(t)
+        if atomic is not None:
+            tag, encode = atomic
+            data = encode(obj)
+            size = len(data) + 2
+            if size < self.min_size:
+                # Hashing these would take most of the time, so they're
+                # their own fingerprints.
+                return tag + data, size
+            digest = self._sha1(tag)
+            digest.update(data)
+            fingerprint = digest.digest()
+            if id(obj) not in self.by_id:
+                self._record(obj, fingerprint)
+            return fingerprint, size
+
+        done = self._done.get(id(obj))
+        if done is not None:
+            return done[:2]
+        depth = self._in_progress.get(id(obj))
+        if depth is not None:
+            # A cycle; both sides walk their copies in the same order, so
+            # they meet it at the same depth.
+            depth = len(self._in_progress) - depth
+            return self._sha1(b'cycle %d' % depth).digest(), 2
+
+        self._in_progress[id(obj)] = len(self._in_progress)
+        try:
+            parts = self._parts(obj, t)
+            if parts is None:
+                data = _dumps(obj, 4, prune_globals=True, deterministic=True)
+                fingerprint, size = self._sha1(data).digest(), len(data)
+            else:
+                digest = self._sha1('{}.{} {}'.format(
+                    t.__module__, t.__qualname__, len(parts)).encode('utf-8'))
+                fingerprints = []
+                size = 2
+                for part in parts:
+                    part_fingerprint, part_size = self._fingerprint(part)
+                    # Fingerprints of small atomic objects vary in length.
+                    fingerprints.append(bytes((len(part_fingerprint),)) +
+                                        part_fingerprint)
+                    size += part_size
+                if t in (set, frozenset):
+                    fingerprints.sort()
+                digest.update(b''.join(fingerprints))
+                fingerprint = digest.digest()
+        finally:
+            del self._in_progress[id(obj)]
+        self._done[id(obj)] = fingerprint, size, obj
+        if size >= self.min_size:
+            count = self._counts.get(fingerprint, 0)
+            self._counts[fingerprint] = count + 1
+            self._record(obj, fingerprint + b'#%d' % count if count
+                         else fingerprint)
+        return fingerprint, size
+
+    def _record(self, obj, key):
+        self.by_id[id(obj)] = key
+        self._recorded.append(obj)  # See _done
+        self.objects.setdefault(key, obj)
+
+    def _parts(self, obj, t):
+        """Return a list of the objects that make up obj, or None if obj is
+        to be fingerprinted as a whole."""
+        if t is dict:
+            return [part for item in obj.items() for part in item]
+        elif t in (list, tuple, set, frozenset):
+            return list(obj)
+        elif t is types.FunctionType:
+            # Only what pickall pickles; __qualname__ and __module__ aren't.
+            parts = [obj.__code__, obj.__name__, obj.__defaults__,
+                     obj.__kwdefaults__, obj.__annotations__, vars(obj),
+                     obj.__closure__]
+            globals_ = obj.__globals__
+            for name in sorted(_global_names(obj.__code__)):
+                if name in globals_:
+                    parts += name, globals_[name]
+            return parts
+        elif t is cell:
+            return list(_cell_contents(obj))
+        elif t is types.CodeType:
+            return list(_code_args(obj))
+        return None
+
+class Snapshot:
+    """A base object graph that both sides of a connection have, so that
+    dumps_delta only needs to pickle what's changed since.
+
+    The sending side makes a Snapshot of the object it sent, and the
+    receiving side one of the object it loaded; their fingerprints match.
+    Objects that are in the base are loaded as the receiving side's own
+    objects, so they're shared rather than copied."""
+    def __init__(self, obj):
+        fingerprints = _Fingerprints(obj)
+        self.obj = obj
+        self.fingerprint = fingerprints.root
+        # Maps the keys of the objects in the graph to the objects; see
+        # _Fingerprints
+        self.objects = fingerprints.objects
+
+    def persistent_load(self, pid):
+        try:
+            return self.objects[pid]
+        except KeyError:
+            raise UnpicklingError("object isn't in the base snapshot") \
+                from None
+
+class _DeltaPickler(_Pickler):
+    """A _Pickler that saves the objects in base as persistent ids.
+
+    fingerprints is a _Fingerprints of the object being pickled."""
+    def __init__(self, file, protocol=None, *, base, fingerprints,
+                 **kwargs):
+        super().__init__(file, protocol, **kwargs)
+        if not self.bin:
+            raise ValueError("dumps_delta needs protocol >= 1")
+        self.base = base
+        self.fingerprints = fingerprints
+
+    def persistent_id(self, obj):
+        key = self.fingerprints.by_id.get(id(obj))
+        if key is not None and key in self.base.objects:
+            return key
+        return None
+
+def dumps_delta(obj, base, protocol=None, **kwargs):
+    """Pickle obj, referring to base, a Snapshot, for the parts of obj that
+    haven't changed since it was taken; see Snapshot.
+
+    Other keyword arguments are passed to _Pickler. Load it with
+    loads_delta and the receiving side's Snapshot."""
+    f = io.BytesIO()
+    _DeltaPickler(f, protocol, base=base, fingerprints=_Fingerprints(obj),
+                  **kwargs).dump(obj)
+    return f.getvalue()
+
+def loads_delta(data, base, **kwargs):
+    """Unpickle what dumps_delta returned; base is the receiving side's
+    Snapshot. Keyword arguments are passed to Unpickler."""
+    unpickler = Unpickler(io.BytesIO(data), **kwargs)
+    unpickler.persistent_load = base.persistent_load
+    return unpickler.load()
+
+# Shared memory
+# Out-of-band buffers are aligned to this in shared memory segments.
+_shared_alignment = 64
+
+# The segments that this process has made with share, and those that it's
+# attached to with SharedHandle.load, by name.
+_owned_segments = set()
+_attached_segments = {}
+
+class SharedHandle(collections.namedtuple('SharedHandle',
+                                          'name stream buffers')):
+    """A reference to a pickle in a shared memory segment, made by share.
+
+    It's small and picklable, so it can be sent to other processes for them
+    to load. stream is the (offset, length) of the pickle in the segment,
+    and buffers is a list of (offset, length, readonly) for its out-of-band
+    buffers."""
+    __slots__ = ()
+
+    def load(self, **kwargs):
+        """Unpickle the object from the segment, without copying the pickle
+        or its out-of-band buffers out of it (though bytes and bytearray
+        objects are still copied, by their constructors).
+
+        The segment stays attached as long as anything loaded from it
+        refers to its buffers; it's detached by the next call to load once
+        nothing does. Keyword arguments are passed to Unpickler."""
+        _detach_segments(self.name)
+        segment = _attached_segments.get(self.name)
+        if segment is None:
+            segment = _attached_segments[self.name] = _attach_segment(
+                self.name)
+        view = segment.buf
+        buffers = []
+        for offset, length, readonly in self.buffers:
+            buffer = view[offset:offset + length]
+            buffers.append(buffer.toreadonly() if readonly else buffer)
+        offset, length = self.stream
+        stream = view[offset:offset + length]
+        try:
+            return loads(stream, buffers=buffers, **kwargs)
+        finally:
+            stream.release()
+
+# The id of this process if it started its own resource tracker by attaching
+# to a segment; see _attach_segment.
+_private_tracker_pid = None
+
+def _attach_segment(name):
+    import os
+    from multiprocessing import shared_memory, resource_tracker
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # Python 3.13+
+    except TypeError:
+        pass
+    global _private_tracker_pid
+    if resource_tracker._resource_tracker._fd is None:
+        # Attaching will start a resource tracker for this process alone.
+        _private_tracker_pid = os.getpid()
+    segment = shared_memory.SharedMemory(name)
+    if _private_tracker_pid == os.getpid() and name not in _owned_segments:
+        # A resource tracker of this process's own would unlink the segment
+        # when this process exits, even though it's still the owner's. Child
+        # processes share their parent's tracker, which the owner's
+        # registration is already in, so they mustn't unregister it.
+        resource_tracker.unregister(segment._name, 'shared_memory')
+    return segment
+
+def _detach_segments(keep):
+    """Detach from the segments, other than keep, that nothing refers to."""
+    for name, segment in list(_attached_segments.items()):
+        if name == keep:
+            continue
+        try:
+            segment.close()
+        except BufferError:
+            continue  # Something loaded from it is still alive.
+        del _attached_segments[name]
+
+class SharedPickle:
+    """A pickle in a shared memory segment, made by share.
+
+    handle is the SharedHandle to send to other processes. The segment is
+    unlinked by close, when the SharedPickle is garbage collected, or when
+    this process exits, whichever comes first; processes that have already
+    loaded from it keep their mapping until they're done with it, but it
+    can't be loaded any more.
+    """
+    def __init__(self, segment, handle):
+        import weakref
+        self.handle = handle
+        self._finalizer = weakref.finalize(self, self._unlink, segment)
+
+    @staticmethod
+    def _unlink(segment):
+        _owned_segments.discard(segment.name)
+        segment.close()
+        segment.unlink()
+
+    @property
+    def closed(self):
+        return not self._finalizer.alive
+
+    def close(self):
+        self._finalizer()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def share(obj, protocol=None, **kwargs):
+    """Pickle obj into a new shared memory segment, so that any number of
+    local processes can load it from there, and return a SharedPickle.
+
+    Out-of-band buffers (PickleBuffers, and large bytes in code objects and
+    pruned globals) are put in the segment after the pickle, so they aren't
+    copied into it, and aren't copied out of it by SharedHandle.load
+    either. protocol must be 5 or higher; it's HIGHEST_PROTOCOL by default.
+    Other keyword arguments are passed to Pickler. Needs Python 3.8+.
+
+    >>> big = pickle.PickleBuffer(bytearray(100000))  # doctest: +SKIP
+    >>> with share(big) as shared:                    # doctest: +SKIP
+    ...     pool.map(SharedHandle.load, [shared.handle] * 64)
+    """
+    from multiprocessing import shared_memory
+    if protocol is None:
+        protocol = HIGHEST_PROTOCOL
+    if protocol < 5:
+        raise ValueError("share needs protocol 5 or higher")
+    raw_buffers = []
+
+    def buffer_callback(buffer):
+        try:
+            raw = buffer.raw()
+        except BufferError:
+            return True  # Not contiguous, so it's pickled in-band.
+        raw_buffers.append((raw, raw.readonly))
+        return False
+
+    data = dumps(obj, protocol, buffer_callback=buffer_callback, **kwargs)
+    size = len(data)
+    buffers = []
+    for raw, readonly in raw_buffers:
+        size += -size % _shared_alignment
+        buffers.append((size, raw.nbytes, readonly))
+        size += raw.nbytes
+
+    segment = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    _owned_segments.add(segment.name)
+    shared = SharedPickle(segment, SharedHandle(segment.name, (0, len(data)),
+                                                buffers))
+    view = segment.buf
+    view[:len(data)] = data
+    for (offset, length, _), (raw, _) in zip(buffers, raw_buffers):
+        view[offset:offset + length] = raw
+        raw.release()
+    return shared
+
+# Shorthands
+def _dump(obj, file, protocol=None, *, fix_imports=True, **kwargs):
+    _Pickler(file, protocol, fix_imports=fix_imports, **kwargs).dump(obj)
+
+def _dumps(obj, protocol=None, *, fix_imports=True, **kwargs):
+    f = io.BytesIO()
+    _Pickler(f, protocol, fix_imports=fix_imports, **kwargs).dump(obj)
+    return f.getvalue()
+
+# Use the faster _pickall where it works, on Python 3.8+. _pickall imports
+# this module, so it isn't imported until Pickler or dump is first needed;
+# importing it here would be circular.
+if sys.version_info >= (3, 8):
+    def _import_accelerator():
+        """Import Pickler and dump from _pickall into this module."""
+        global Pickler, dump
+        from _pickall import Pickler, dump
+
+    def __getattr__(name):
+        # Only called for names that aren't globals (yet); see PEP 562.
+        if name in ('Pickler', 'dump'):
+            _import_accelerator()
+            return globals()[name]
+        raise AttributeError("module {!r} has no attribute {!r}".format(
+            __name__, name))
+
+    def _get_pickler():
+        try:
+            return Pickler
+        except NameError:
+            _import_accelerator()
+            return Pickler
+else:
+    Pickler = _Pickler
+    dump = _dump
+
+    def _get_pickler():
+        return Pickler
+
+# _thread._local is threading.local, without importing threading.
+class _PicklerPool(_thread._local):
+    """Idle picklers, each with its BytesIO, for dumps to reuse.
+
+    Picklers are taken out of the pool while they're in use, so a dumps
+    call made while pickling (say, by a __reduce__ method) gets its own."""
+    def __init__(self):
+        self.idle = {}
+
+_pool = _PicklerPool()
+
+# Pooled BytesIOs keep their buffers between dumps, unless they grow past
+# this many bytes.
+_pool_buffer_limit = 1 << 20
+
+def dumps(obj, protocol=None, *, fix_imports=True, **kwargs):
+    if kwargs:
+        # Not worth pooling every combination of options
+        f = io.BytesIO()
+        _get_pickler()(f, protocol, fix_imports=fix_imports,
+                       **kwargs).dump(obj)
+        return f.getvalue()
+
+    key = protocol, fix_imports
+    entry = _pool.idle.pop(key, None)
+    if entry is None:
+        f = io.BytesIO()
+        entry = _get_pickler()(f, protocol, fix_imports=fix_imports), f
+    pickler, f = entry
+    try:
+        pickler.dump(obj)
+        # The buffer may be longer than this pickle, from an earlier one.
+        # read doesn't copy, if it's the right size.
+        size = f.tell()
+        f.seek(0)
+        return f.read(size)
+    finally:
+        # A pickler that failed part-way is fine to reuse once it's reset.
+        pickler.reset()
+        if f.tell() > _pool_buffer_limit:
+            f.truncate(0)
+        f.seek(0)
+        _pool.idle[key] = entry
+
+if __name__ == '__main__':
+    sys.exit(_main())
@@ -2,6 +2,14 @@ import unittest
 import doctest
 import pickall
 import pickle
+import types
+import io
+import sys
+import copyreg
+import threading
+import os
+import subprocess
+import traceback
 
 # Utilities
 class UnitTestDocTestRunner(doctest.DocTestRunner):
@@ -29,6 +37,32 @@ class UnitTestDocTestRunner(doctest.DocTestRunner):
     def report_unexpected_exception(self, out, test, example, exc_info):
         self._unittest_subtest.__exit__(*exc_info)
         self._unittest_subtest = None
+
+class PicklerTestMixin:
+    """Helpers for TestCases that try each pickler, or each dumps."""
+    # Keyword arguments for every pickler that dumps and copy make
+    options = {}
+    # The dumps functions that copy tries
+    dumps_functions = (pickall._dumps, pickall.dumps)
+
+    def picklers(self):
+        yield pickall._Pickler
+        try:
+            import _pickall
+        except ImportError:
+            return
+        yield _pickall.Pickler
+
+    def dumps(self, Pickler, obj, protocol=pickle.HIGHEST_PROTOCOL,
+              **kwargs):
+        f = io.BytesIO()
+        Pickler(f, protocol, **dict(self.options, **kwargs)).dump(obj)
+        return f.getvalue()
+
+    def copy(self, obj, **kwargs):
+        for dumps in self.dumps_functions:
+            with self.subTest(dumps=dumps):
+                yield pickle.loads(dumps(obj, **dict(self.options, **kwargs)))
     
 
 # Backwards- (pickle-)compatibility
@@ -51,6 +85,29 @@ class ImportTestCase(unittest.TestCase):
     def test_star(self):
         exec("from pickall import *")
 
+    def test_lazy_imports(self):
+        # These are slow to import, and only needed by some features. On
+        # Python 3.6, pickle imports weakref itself.
+        script = ("import sys, pickle; before = set(sys.modules);"
+                  "import pickall;"
+                  "sys.stdout.write(' '.join(sorted("
+                  "{'ctypes', 'dis', 'hashlib', 'threading', 'weakref'} &"
+                  "(set(sys.modules) - before))))")
+        output = subprocess.check_output(
+            [sys.executable, '-c', script],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(output, b'')
+
+    def test_ctypes(self):
+        # The reducers for ctypes are added when they're first needed.
+        import ctypes
+        functions = [ctypes.pythonapi.PyCell_Set, ctypes.pythonapi]
+        for Pickler in {pickall._Pickler, pickall.Pickler}:
+            with self.subTest(Pickler=Pickler):
+                f = io.BytesIO()
+                Pickler(f, 2).dump(functions)
+                self.assertEqual(pickle.loads(f.getvalue()), functions)
+
 # Documented
 class FunctionPicklingTestCase(unittest.TestCase):
     def test_basic_isolated_function(self):
@@ -162,6 +219,1526 @@ class FunctionPicklingTestCase(unittest.TestCase):
                     self.assertEqual(original(),
                                      new_func())
 
+# Globals for PruneGlobalsTestCase
+_prune_constant = 21
+_prune_unused = "unused" * 100000
+
+def _prune_double():
+    return _prune_constant * len("ab")
+
+def _prune_factorial(n):
+    return 1 if n <= 1 else n * _prune_factorial(n - 1)
+
+def _prune_set(value):
+    global _prune_constant
+    _prune_constant = value
+
+def _prune_get():
+    return _prune_constant
+
+def _prune_import():
+    import os
+    return os.sep
+
+def _prune_class():
+    class Local:
+        pass
+    return Local.__name__
+
+class PruneGlobalsTestCase(unittest.TestCase):
+    def test_only_referenced(self):
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    pickle_string = dumps(_prune_double, protocol,
+                                          prune_globals=True)
+                    self.assertLess(len(pickle_string), len(_prune_unused))
+                    self.assertEqual(pickle.loads(pickle_string)(), 42)
+
+    def test_recursive(self):
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    new_func = pickle.loads(dumps(_prune_factorial, protocol,
+                                                  prune_globals=True))
+                    self.assertEqual(new_func(5), 120)
+
+    def test_shared_globals(self):
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    new_set, new_get = pickle.loads(dumps(
+                        (_prune_set, _prune_get), protocol,
+                        prune_globals=True))
+                    new_set(7)
+                    self.assertEqual(new_get(), 7)
+                    self.assertEqual(_prune_constant, 21)
+
+    def test_implicit_builtins(self):
+        # import and class statements need __import__ and __build_class__
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    new_import, new_class = pickle.loads(dumps(
+                        (_prune_import, _prune_class), protocol,
+                        prune_globals=True))
+                    self.assertEqual(new_import(), os.sep)
+                    self.assertEqual(new_class(), 'Local')
+
+class CodeCacheTestCase(unittest.TestCase):
+    def test_reuse(self):
+        @pickall._no_globals
+        def original(a, b=3):
+            return a * b
+
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    cache = pickall.CodeCache()
+                    first = pickle.loads(dumps(original, protocol,
+                                               code_cache=cache))
+                    second = pickle.loads(dumps(original, protocol,
+                                                code_cache=cache))
+                    self.assertEqual(first(2), 6)
+                    self.assertIs(first.__code__, second.__code__)
+                    info = cache.cache_info()
+                    self.assertEqual((info.hits, info.misses), (1, 1))
+
+    def test_eviction(self):
+        cache = pickall.CodeCache(maxsize=2)
+        codes = [compile(str(i), "<test>", "eval") for i in range(3)]
+        for code in codes:
+            pickall.dumps(code, code_cache=cache)
+        self.assertEqual(cache.cache_info(),
+                         pickall.CodeCacheInfo(hits=0, misses=3, evictions=1,
+                                               maxsize=2, currsize=2))
+        self.assertEqual(eval(pickle.loads(pickall.dumps(
+            codes[0], code_cache=cache))), 0)
+
+# Globals for RegistryTestCase
+_registry_large = list(range(100000))
+
+def _registry_make_task(k):
+    def task(x):
+        return x + k + len(_registry_large)
+    return task
+
+def _registry_make_factorial():
+    def factorial(n):
+        return n and n * factorial(n - 1) or 1
+    return factorial
+
+class _RegistryUnloadable:
+    def __reduce__(self):
+        return int, ('not a number',)
+
+class RegistryTestCase(unittest.TestCase):
+    def test_sent_once(self):
+        sent = set()
+        registry = pickall.FunctionRegistry()
+        sizes = []
+        for k in range(3):
+            f = io.BytesIO()
+            pickall.RegistryPickler(f, sent=sent, prune_globals=True).dump(
+                _registry_make_task(k))
+            sizes.append(len(f.getvalue()))
+            unpickler = pickle.Unpickler(io.BytesIO(f.getvalue()))
+            unpickler.persistent_load = registry.persistent_load
+            self.assertEqual(unpickler.load()(1), 1 + k + 100000)
+        self.assertGreater(sizes[0], len(_registry_large))
+        self.assertLess(sizes[1], 200)
+        self.assertEqual(sizes[1], sizes[2])
+
+    def test_recursive_closure(self):
+        registry = pickall.FunctionRegistry()
+        for protocol in range(1, pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                f = io.BytesIO()
+                pickall.RegistryPickler(f, protocol, sent=set(),
+                                        prune_globals=True).dump(
+                    _registry_make_factorial())
+                unpickler = pickle.Unpickler(io.BytesIO(f.getvalue()))
+                unpickler.persistent_load = registry.persistent_load
+                self.assertEqual(unpickler.load()(5), 120)
+
+    def test_implicit_builtins(self):
+        registry = pickall.FunctionRegistry()
+        for func, result in ((_prune_import, os.sep), (_prune_class, 'Local')):
+            with self.subTest(func=func):
+                f = io.BytesIO()
+                pickall.RegistryPickler(f, sent=set(),
+                                        prune_globals=True).dump(func)
+                unpickler = pickle.Unpickler(io.BytesIO(f.getvalue()))
+                unpickler.persistent_load = registry.persistent_load
+                self.assertEqual(unpickler.load()(), result)
+
+    def test_executor(self):
+        with pickall.ProcessPoolExecutor(2) as executor:
+            self.assertEqual(list(executor.map(_registry_make_task(1),
+                                               range(4))),
+                             [100001, 100002, 100003, 100004])
+            with self.assertRaises(TypeError):
+                executor.submit(_registry_make_task(1), "x").result()
+
+    def test_executor_errors(self):
+        task = _registry_make_task(2)
+        with pickall.ProcessPoolExecutor(1) as executor:
+            # Neither failure leaves the worker without task's template.
+            with self.assertRaises(TypeError):
+                executor.submit(task, threading.Lock())
+            with self.assertRaises(ValueError):
+                executor.submit(task, _RegistryUnloadable()).result()
+            self.assertEqual(executor.submit(task, 1).result(), 100003)
+
+    def test_executor_large(self):
+        # Sending large arguments mustn't stop large results being read.
+        data = bytes(1 << 20)
+        with pickall.ProcessPoolExecutor(1) as executor:
+            futures = [executor.submit(bytes, data) for _ in range(20)]
+            for future in futures:
+                self.assertEqual(len(future.result(60)), len(data))
+
+try:
+    import _pickall
+except ImportError:
+    _pickall = None
+
+@unittest.skipIf(_pickall is None, "_pickall needs Python 3.8+")
+class AcceleratorTestCase(unittest.TestCase):
+    def test_is_used(self):
+        self.assertIs(pickall.Pickler, _pickall.Pickler)
+        self.assertIs(pickall.dump, _pickall.dump)
+
+    def test_import_order(self):
+        # Importing _pickall first mustn't leave pickall without it
+        for imports in ('import _pickall, pickall',
+                        'import pickall, _pickall'):
+            with self.subTest(imports=imports):
+                subprocess.check_call([
+                    sys.executable, '-c',
+                    imports + '; assert pickall.Pickler is _pickall.Pickler; '
+                    'assert pickall.dump is _pickall.dump; '
+                    'assert pickall.dumps(len) == _pickall.dumps(len)'],
+                    cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def test_pure_options(self):
+        pickler = _pickall.Pickler(io.BytesIO(), deterministic=True)
+        self.assertIsInstance(pickler, pickall._Pickler)
+        self.assertIsInstance(_pickall.Pickler(io.BytesIO(), stats=False),
+                              _pickall.Pickler)
+        class Subclass(_pickall.Pickler):
+            pass
+        self.assertRaises(TypeError, Subclass, io.BytesIO(), stats=True)
+
+    def test_standard_types_match_pickle(self):
+        data = [1, 2.5, "three", b"four", None, True,
+                {"five": (6, 7)}, {8, 9}, frozenset({10})]
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                self.assertEqual(_pickall.dumps(data, protocol),
+                                 pickle.dumps(data, protocol))
+
+    def test_function(self):
+        @pickall._no_globals
+        def original(a: int, b=12, *, c=42):
+            return a, b, c
+        original.d = "this is d"
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                new_func = pickle.loads(_pickall.dumps(original, protocol))
+                self.assertEqual(original(1), new_func(1))
+                for attribute in ('__annotations__', '__kwdefaults__',
+                                  '__name__', 'd'):
+                    self.assertEqual(getattr(original, attribute),
+                                     getattr(new_func, attribute))
+
+    def test_types(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            for obj in (pickall.cell, types.FunctionType, types.CodeType):
+                with self.subTest(protocol=protocol, obj=obj):
+                    self.assertIs(pickle.loads(_pickall.dumps(obj, protocol)),
+                                  obj)
+
+class LocationIndexTestCase(unittest.TestCase):
+    def test_types(self):
+        self.assertEqual(pickall.resolve_location(types.FunctionType),
+                         ('types', 'FunctionType'))
+        self.assertEqual(pickall.resolve_location(types.CodeType),
+                         ('types', 'CodeType'))
+        self.assertIsNone(pickall.resolve_location(int))
+
+    def test_incremental(self):
+        pickall.resolve_location(types.FunctionType)  # Build the index
+
+        class located:
+            pass
+        located.__module__ = None
+        module = types.ModuleType("_pickall_test_location")
+        module.located = located
+        sys.modules[module.__name__] = module
+        try:
+            self.assertEqual(pickall.whichmodule(located, "located"),
+                             module.__name__)
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(protocol=protocol):
+                    self.assertIs(pickle.loads(pickall.dumps(located,
+                                                             protocol)),
+                                  located)
+            del module.located
+            self.assertIsNone(pickall.resolve_location(located))
+        finally:
+            del sys.modules[module.__name__]
+
+    def test_weak(self):
+        # The index doesn't keep the objects in it alive.
+        import gc
+        import weakref
+
+        class located:
+            pass
+        located.__module__ = None
+        module = types.ModuleType("_pickall_test_location")
+        module.located = located
+        sys.modules[module.__name__] = module
+        try:
+            self.assertIsNotNone(pickall.resolve_location(located))
+        finally:
+            del sys.modules[module.__name__]
+        reference = weakref.ref(located)
+        del module, located
+        gc.collect()
+        self.assertIsNone(reference())
+
+class _PlanCacheExample:
+    pass
+
+class PlanCacheTestCase(unittest.TestCase):
+    def test_invalidation(self):
+        f = io.BytesIO()
+        pickler = pickall._Pickler(f, 2)
+        pickler.dump(_PlanCacheExample())
+        copyreg.pickle(_PlanCacheExample, lambda obj: (int, (7,)))
+        try:
+            pickler.dump(_PlanCacheExample())
+        finally:
+            del copyreg.dispatch_table[_PlanCacheExample]
+        pickler.dump(_PlanCacheExample())
+
+        f.seek(0)
+        unpickler = pickle.Unpickler(f)  # The memo is shared between dumps
+        self.assertIsInstance(unpickler.load(), _PlanCacheExample)
+        self.assertEqual(unpickler.load(), 7)
+        self.assertIsInstance(unpickler.load(), _PlanCacheExample)
+
+    def test_unchanged(self):
+        pickler = pickall._Pickler(io.BytesIO(), 2)
+        pickler.dispatch_table = dict(copyreg.dispatch_table)
+        pickler.dump(_PlanCacheExample())
+        plan = pickler._compiled_plans[_PlanCacheExample]
+        pickler.dump(_PlanCacheExample())
+        self.assertIs(pickler._compiled_plans[_PlanCacheExample], plan)
+        # An equal table keeps the plans too
+        pickler.dispatch_table = dict(copyreg.dispatch_table)
+        pickler.dump(_PlanCacheExample())
+        self.assertIs(pickler._compiled_plans[_PlanCacheExample], plan)
+
+    def test_class_dispatch_table(self):
+        class Pickler(pickall._Pickler):
+            dispatch_table = pickall._ChainedDictionary(
+                pickall._Pickler.dispatch_table)
+        f = io.BytesIO()
+        pickler = Pickler(f, 2)
+        pickler.dump(_PlanCacheExample())
+        Pickler.dispatch_table[_PlanCacheExample] = lambda obj: (int, (8,))
+        pickler.dump(_PlanCacheExample())
+
+        f.seek(0)
+        unpickler = pickle.Unpickler(f)
+        self.assertIsInstance(unpickler.load(), _PlanCacheExample)
+        self.assertEqual(unpickler.load(), 8)
+
+    def test_replaced_entry(self):
+        f = io.BytesIO()
+        pickler = pickall._Pickler(f, 2)
+        copyreg.pickle(_PlanCacheExample, lambda obj: (int, (7,)))
+        try:
+            pickler.dump(_PlanCacheExample())
+            copyreg.pickle(_PlanCacheExample, lambda obj: (int, (9,)))
+            pickler.dump(_PlanCacheExample())
+        finally:
+            del copyreg.dispatch_table[_PlanCacheExample]
+
+        f.seek(0)
+        unpickler = pickle.Unpickler(f)
+        self.assertEqual(unpickler.load(), 7)
+        self.assertEqual(unpickler.load(), 9)
+
+    def test_class_changed(self):
+        class Example:
+            pass
+        f = io.BytesIO()
+        pickler = pickall._Pickler(f, 2)
+        pickler.dump(Example())
+        Example.__reduce__ = lambda self: (int, (6,))
+        pickler.dump(Example())
+
+        f.seek(0)
+        unpickler = pickle.Unpickler(f)
+        self.assertEqual(type(unpickler.load()).__name__, 'Example')
+        self.assertEqual(unpickler.load(), 6)
+
+class CellTestCase(PicklerTestMixin, unittest.TestCase):
+    options = {'prune_globals': True}
+
+    def round_trip(self, obj):
+        for Pickler in self.picklers():
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(pickler=Pickler, protocol=protocol):
+                    yield pickle.loads(self.dumps(Pickler, obj, protocol))
+
+    def test_empty_cell(self):
+        def wrapper():
+            def original():
+                return x
+            return original
+            x = None
+        for new_func in self.round_trip(wrapper()):
+            self.assertRaises(NameError, new_func)
+
+    def test_shared_cell(self):
+        def wrapper():
+            x = 0
+            def increment():
+                nonlocal x
+                x += 1
+            def get():
+                return x
+            return increment, get
+        for increment, get in self.round_trip(wrapper()):
+            increment()
+            increment()
+            self.assertEqual(get(), 2)
+
+    def test_recursive_closure(self):
+        def wrapper():
+            def factorial(n):
+                return 1 if n <= 1 else n * factorial(n - 1)
+            return factorial
+        for new_func in self.round_trip(wrapper()):
+            self.assertEqual(new_func(5), 120)
+            self.assertIs(new_func.__closure__[0].cell_contents, new_func)
+
+    def test_mutually_recursive_closures(self):
+        def wrapper():
+            def is_even(n):
+                return n == 0 or is_odd(n - 1)
+            def is_odd(n):
+                return n != 0 and is_even(n - 1)
+            return is_even, is_odd
+        for is_even, is_odd in self.round_trip(wrapper()):
+            self.assertTrue(is_even(10))
+            self.assertTrue(is_odd(7))
+            self.assertIs(is_even.__closure__[0].cell_contents, is_odd)
+            self.assertIs(is_odd.__closure__[0].cell_contents, is_even)
+
+    def test_indirect_recursion(self):
+        # The closure only refers back to the function through a container
+        def wrapper():
+            def fact(n):
+                return 1 if n <= 1 else n * functions[0](n - 1)
+            functions = (fact,)
+            return fact
+        for fact in self.round_trip(wrapper()):
+            self.assertEqual(fact(5), 120)
+            self.assertIs(fact.__closure__[0].cell_contents[0], fact)
+
+# Globals for OutOfBandTestCase
+_out_of_band_global = bytes(range(256)) * 64
+
+# A function with a large bytes constant; the compiler won't fold one.
+_out_of_band_constant = eval("lambda: {!r}".format(b"\xff" * 20000))
+
+def _out_of_band_function():
+    return _out_of_band_constant(), _out_of_band_global
+
+@unittest.skipIf(pickle.HIGHEST_PROTOCOL < 5, "needs protocol 5")
+class OutOfBandTestCase(PicklerTestMixin, unittest.TestCase):
+    options = {'prune_globals': True}
+
+    def test_out_of_band(self):
+        for Pickler in self.picklers():
+            with self.subTest(pickler=Pickler):
+                buffers = []
+                data = self.dumps(Pickler, _out_of_band_function, 5,
+                                  buffer_callback=buffers.append)
+                self.assertLess(len(data), 16384)
+                self.assertEqual(sorted(len(buffer.raw())
+                                        for buffer in buffers),
+                                 [16384, 20000])
+                new_func = pickle.loads(data, buffers=buffers)
+                self.assertEqual(new_func(), _out_of_band_function())
+
+    def test_threshold(self):
+        for Pickler in self.picklers():
+            with self.subTest(pickler=Pickler):
+                buffers = []
+                data = self.dumps(Pickler, _out_of_band_function, 5,
+                                  buffer_callback=buffers.append,
+                                  buffer_threshold=18000)
+                self.assertEqual([len(buffer.raw()) for buffer in buffers],
+                                 [20000])
+                new_func = pickle.loads(data, buffers=buffers)
+                self.assertEqual(new_func(), _out_of_band_function())
+
+    def test_other_bytes(self):
+        # Only code and pruned globals are out-of-band, with either pickler
+        obj = [b"x" * 20000, bytearray(20000), _out_of_band_function]
+        for Pickler in self.picklers():
+            with self.subTest(pickler=Pickler):
+                buffers = []
+                data = self.dumps(Pickler, obj, 5,
+                                  buffer_callback=buffers.append)
+                self.assertEqual(len(buffers), 2)
+                new_obj = pickle.loads(data, buffers=buffers)
+                self.assertEqual(new_obj[:2], obj[:2])
+
+    def test_in_band(self):
+        for Pickler in self.picklers():
+            with self.subTest(pickler=Pickler):
+                data = self.dumps(Pickler, _out_of_band_function, 5,
+                                  buffer_callback=lambda buffer: True)
+                self.assertGreater(len(data), 36384)
+                self.assertEqual(pickle.loads(data)(),
+                                 _out_of_band_function())
+
+class _PoolReentrant:
+    def __reduce__(self):
+        return pickle.loads, (pickall.dumps([self.__class__.__name__]),)
+
+class PoolTestCase(unittest.TestCase):
+    def test_reset(self):
+        data = [b"shared"] * 3
+        f = io.BytesIO()
+        pickler = pickall.Pickler(f, 2)
+        pickler.dump(data)
+        first = f.getvalue()
+        pickler.reset()
+        pickler.dump(data)
+        self.assertEqual(f.getvalue(), first * 2)
+
+    def test_reused(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                long = pickall.dumps(list(range(1000)), protocol)
+                short = pickall.dumps((1, "a"), protocol)
+                self.assertEqual(short, pickle.dumps((1, "a"), protocol))
+                self.assertEqual(pickle.loads(long), list(range(1000)))
+                self.assertEqual(pickall.dumps((1, "a"), protocol), short)
+
+    def test_buffer_kept(self):
+        long = pickall.dumps(list(range(1000)), 2)
+        _, f = pickall._pool.idle[2, True]
+        self.assertEqual(pickall.dumps((1, "a"), 2), pickle.dumps((1, "a"), 2))
+        self.assertGreaterEqual(len(f.getbuffer()), len(long))
+        pickall.dumps(b"x" * (pickall._pool_buffer_limit + 1), 2)
+        self.assertEqual(len(f.getbuffer()), 0)
+
+    def test_reentrant(self):
+        self.assertEqual(pickle.loads(pickall.dumps([_PoolReentrant()])),
+                         [["_PoolReentrant"]])
+
+    def test_after_error(self):
+        self.assertRaises(TypeError, pickall.dumps, [1, threading.Lock()])
+        self.assertEqual(pickle.loads(pickall.dumps([1, 2])), [1, 2])
+
+    def test_threads(self):
+        results = {}
+        def work(n):
+            results[n] = [pickle.loads(pickall.dumps((n, i)))
+                          for i in range(200)]
+        threads = [threading.Thread(target=work, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for n in range(4):
+            self.assertEqual(results[n], [(n, i) for i in range(200)])
+
+class StatsTestCase(unittest.TestCase):
+    def make_function(self):
+        x = [1, 2, 3]
+        @pickall._no_globals
+        def original():
+            return x, x
+        return original
+
+    def test_stats(self):
+        f = io.BytesIO()
+        pickler = pickall._Pickler(f, 2, stats=True)
+        pickler.dump(self.make_function())
+        stats = pickler.get_stats()
+
+        self.assertEqual(stats['bytes'], len(f.getvalue()))
+        # Everything but PROTO and STOP is written by some save
+        self.assertEqual(sum(record['bytes'] for record in stats['objects']),
+                         len(f.getvalue()) - 3)
+        for method in ('save_function', 'save_code', 'save_cell',
+                       'save_type', 'save_list', 'memo'):
+            self.assertIn(method, stats['methods'])
+        self.assertEqual(stats['types']['list']['count'], 1)
+        # The cell's saved empty, then got from the memo to be filled in.
+        self.assertEqual(stats['types']['cell']['count'], 2)
+        self.assertEqual(stats['memo_size'], len(pickler.memo))
+        self.assertGreaterEqual(stats['max_depth'], 4)
+
+    def test_frames(self):
+        f = io.BytesIO()
+        pickler = pickall._Pickler(f, pickle.HIGHEST_PROTOCOL, stats=True)
+        pickler.dump([b"x" * 200000, list(range(10000))])
+        stats = pickler.get_stats()
+        self.assertLessEqual(stats['bytes'], len(f.getvalue()))
+        self.assertGreater(stats['types']['bytes']['bytes'], 200000)
+
+    def test_disabled(self):
+        pickler = pickall._Pickler(io.BytesIO())
+        self.assertNotIn('save', vars(pickler))
+        self.assertRaises(ValueError, pickler.get_stats)
+
+    def test_public(self):
+        # The accelerator can't measure what it saves, so _Pickler is used.
+        f = io.BytesIO()
+        pickler = pickall.Pickler(f, 2, stats=True)
+        pickler.dump(self.make_function())
+        self.assertEqual(pickler.get_stats()['bytes'], len(f.getvalue()))
+        data = pickall.dumps(self.make_function(), stats=True)
+        self.assertEqual(pickle.loads(data)(), ([1, 2, 3], [1, 2, 3]))
+
+# Globals for AnalyzeTestCase
+_analyze_big = list(range(5000))
+
+def _analyze_function():
+    return len(_analyze_big)
+
+class AnalyzeTestCase(unittest.TestCase):
+    def test_function(self):
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    data = dumps(_analyze_function, protocol,
+                                 prune_globals=True)
+                    analysis, = pickall.analyze(data)
+                    self.assertEqual(analysis.size, len(data))
+                    largest = analysis.largest(5)
+                    # The function is the whole pickle
+                    self.assertEqual(largest[0].path(),
+                                     "function _analyze_function")
+                    self.assertEqual(largest[0].size + analysis.overhead,
+                                     len(data))
+                    self.assertTrue(any(
+                        node.path().endswith("global '_analyze_big'")
+                        for node in largest))
+
+    def test_module(self):
+        # Without prune_globals, the function's globals are its module's,
+        # which is pickled by value since it can't be imported.
+        module = types.ModuleType('_analyze_module')
+        exec("big = list(range(5000))\n"
+             "def task():\n"
+             "    return len(big)\n", vars(module))
+        sys.modules[module.__name__] = module
+        self.addCleanup(sys.modules.pop, module.__name__)
+        for dumps in (pickall.dumps, pickall._dumps):
+            for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+                with self.subTest(dumps=dumps, protocol=protocol):
+                    analysis, = pickall.analyze(dumps(module.task, protocol))
+                    paths = [node.path() for node in analysis.largest(10)]
+                    self.assertTrue(any(
+                        path.endswith("module '_analyze_module' > state > "
+                                      "global 'big'") for path in paths),
+                                    paths)
+                    self.assertFalse(any("None" in path for path in paths),
+                                     paths)
+
+    def test_duplicates(self):
+        data = pickall.dumps([bytes(100), bytes(100), b"x" * 100], 2)
+        (group,), = [analysis.duplicates()
+                     for analysis in pickall.analyze(data)]
+        self.assertEqual(len(group), 2)
+
+    def test_cli(self):
+        import tempfile
+        import contextlib
+        with tempfile.TemporaryDirectory() as directory:
+            path = directory + "/test.pickle"
+            with open(path, 'wb') as file:
+                pickall.dump(_analyze_function, file, prune_globals=True)
+                pickall.dump([1, 2], file)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                self.assertEqual(pickall._main(['analyze', path]), 0)
+        self.assertIn("Pickle 2 of 2:", output.getvalue())
+        self.assertIn("global '_analyze_big'", output.getvalue())
+
+class StreamingTestCase(unittest.TestCase):
+    def make_object(self):
+        def original(n):
+            return [n] * 3
+        return [list(range(i)) for i in range(300)] + [original, b"x" * 5000]
+
+    def test_public_frame_size(self):
+        # The accelerator can't change its frame size, so _Pickler is used.
+        obj = [list(range(i)) for i in range(300)]
+        data = pickall.dumps(obj, 4, frame_size=1024)
+        self.assertEqual(data, pickall._dumps(obj, 4, frame_size=1024))
+        f = io.BytesIO()
+        pickall.dump(obj, f, 4, frame_size=1024)
+        self.assertEqual(f.getvalue(), data)
+        f = io.BytesIO()
+        pickall.Pickler(f, 4, frame_size=1024).dump(obj)
+        self.assertEqual(f.getvalue(), data)
+        self.assertEqual(pickle.loads(data), obj)
+
+    def test_frames(self):
+        obj = self.make_object()
+        for protocol in range(4, pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                chunks = list(pickall.dump_iter(obj, protocol,
+                                                frame_size=2048,
+                                                prune_globals=True))
+                self.assertGreater(len(chunks), 10)
+                data = b"".join(chunks)
+                self.assertEqual(data, pickall._dumps(obj, protocol,
+                                                      frame_size=2048,
+                                                      prune_globals=True))
+                # Every frame is in a chunk by itself
+                for chunk in chunks[1:]:
+                    if chunk[0] == pickle.FRAME[0]:
+                        self.assertEqual(len(chunk), 9 + int.from_bytes(
+                            chunk[1:9], 'little'))
+                new_obj = pickall.load_iter(iter(chunks))
+                self.assertEqual(new_obj[:-2], obj[:-2])
+                self.assertEqual(new_obj[-2](4), [4, 4, 4])
+
+    def test_load_small_chunks(self):
+        data = pickall._dumps(self.make_object()[:-2], 4)
+        chunks = (data[i:i + 3] for i in range(0, len(data), 3))
+        self.assertEqual(pickall.load_iter(chunks), pickle.loads(data))
+        data = pickall._dumps(self.make_object()[:-2], 0)
+        chunks = (data[i:i + 3] for i in range(0, len(data), 3))
+        self.assertEqual(pickall.load_iter(chunks), pickle.loads(data))
+
+    def test_protocol(self):
+        self.assertRaises(ValueError, pickall.dump_iter, [], 3)
+
+    def test_error(self):
+        chunks = pickall.dump_iter([list(range(10000)), threading.Lock()], 4,
+                                   frame_size=1024)
+        self.assertRaises(TypeError, list, chunks)
+
+    def test_close(self):
+        threads = threading.active_count()
+        chunks = pickall.dump_iter([list(range(100000))], 4,
+                                   frame_size=1024)
+        next(chunks)
+        self.assertEqual(threading.active_count(), threads + 1)
+        chunks.close()
+        self.assertEqual(threading.active_count(), threads)
+
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def round_trip(self, obj, **kwargs):
+        import asyncio
+        async def round_trip():
+            loaded = self.loop.create_future()
+            async def handle(reader, writer):
+                try:
+                    loaded.set_result(await pickall.load_async(reader))
+                except Exception as e:
+                    loaded.set_exception(e)
+                writer.close()
+            server = await asyncio.start_server(handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+            try:
+                await pickall.dump_async(obj, writer, 4, **kwargs)
+            finally:
+                writer.close()
+            try:
+                return await loaded
+            finally:
+                server.close()
+        return self.loop.run_until_complete(round_trip())
+
+    def test_round_trip(self):
+        def original(n):
+            return n * 2
+        obj = [list(range(i)) for i in range(300)] + [original]
+        new_obj = self.round_trip(obj, frame_size=1024, prune_globals=True)
+        self.assertEqual(new_obj[:-1], obj[:-1])
+        self.assertEqual(new_obj[-1](21), 42)
+
+    def test_error(self):
+        self.assertRaises(TypeError, self.round_trip,
+                          [list(range(10000)), threading.Lock()])
+
+    def test_protocol(self):
+        async def dump():
+            await pickall.dump_async([], None, 3)
+        self.assertRaises(ValueError, self.loop.run_until_complete, dump())
+
+    def cancel(self, coroutine):
+        # Cancels coroutine once its thread has started, and checks that
+        # the thread stops.
+        import asyncio
+        import time
+        threads = threading.active_count()
+        async def cancel():
+            task = asyncio.ensure_future(coroutine)
+            await asyncio.sleep(0.05)
+            self.assertEqual(threading.active_count(), threads + 1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.loop.run_until_complete(cancel())
+        deadline = time.monotonic() + 5
+        while (threading.active_count() > threads
+               and time.monotonic() < deadline):
+            time.sleep(0.01)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_cancel_load(self):
+        import asyncio
+        async def load():
+            reader = asyncio.StreamReader()
+            reader.feed_data(pickle.dumps(list(range(1000)), 4)[:100])
+            return await pickall.load_async(reader)
+        self.cancel(load())
+
+    def test_cancel_dump(self):
+        import asyncio
+        class StuckWriter:
+            def write(self, data):
+                pass
+            async def drain(self):
+                await asyncio.Event().wait()
+        obj = [list(range(i)) for i in range(300)]
+        self.cancel(pickall.dump_async(obj, StuckWriter(), 4,
+                                       frame_size=1024, queue_size=1))
+
+def _slim_example(x: int, *, scale=2) -> int:
+    """A docstring that slim picklers leave out."""
+    def divide():
+        return x * scale / 0
+    return divide
+
+class SlimTestCase(PicklerTestMixin, unittest.TestCase):
+    options = {'prune_globals': True}
+
+    def test_runs(self):
+        for Pickler in self.picklers():
+            for code_cache in (None, pickall.CodeCache()):
+                with self.subTest(pickler=Pickler, code_cache=code_cache):
+                    new_func = pickle.loads(self.dumps(
+                        Pickler, _slim_example, slim=True,
+                        code_cache=code_cache))
+                    self.assertIsNone(new_func.__doc__)
+                    self.assertEqual(new_func.__annotations__, {})
+                    self.assertEqual(new_func.__kwdefaults__, {'scale': 2})
+                    self.assertEqual(new_func.__code__.co_filename, '')
+                    try:
+                        new_func(1)()
+                    except ZeroDivisionError:
+                        # Formatting the traceback needs a valid line table.
+                        self.assertIn('line 1, in divide',
+                                      traceback.format_exc())
+                    else:
+                        self.fail("ZeroDivisionError not raised")
+
+    def test_smaller(self):
+        for Pickler in self.picklers():
+            with self.subTest(pickler=Pickler):
+                self.assertLess(
+                    len(self.dumps(Pickler, _slim_example, slim=True)),
+                    len(self.dumps(Pickler, _slim_example)))
+
+    def test_string_constant(self):
+        # A string that's used isn't a docstring, even if it comes first.
+        for Pickler in self.picklers():
+            with self.subTest(pickler=Pickler):
+                new_func = pickle.loads(self.dumps(
+                    Pickler, lambda: "not a docstring", slim=True))
+                self.assertEqual(new_func(), "not a docstring")
+
+    def test_registry(self):
+        sent = set()
+        registry = pickall.FunctionRegistry()
+        for slim in (False, True):
+            f = io.BytesIO()
+            pickall.RegistryPickler(f, sent=sent, prune_globals=True,
+                                    slim=slim).dump(_slim_example)
+            unpickler = pickle.Unpickler(io.BytesIO(f.getvalue()))
+            unpickler.persistent_load = registry.persistent_load
+            new_func = unpickler.load()
+            self.assertEqual(new_func.__doc__ is None, slim)
+            self.assertRaises(ZeroDivisionError, new_func(1))
+
+_deterministic_options = {'a', 'b', 'c', 'd', 'e'}
+
+def _deterministic_example(option):
+    return option in _deterministic_options, option in {'x', 'y', 'z'}
+
+class DeterministicTestCase(PicklerTestMixin, unittest.TestCase):
+    options = {'prune_globals': True, 'deterministic': True}
+
+    def test_dict_order(self):
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                self.assertEqual(
+                    self.dumps(pickall._Pickler, {'a': 1, 2: 'b'}, protocol),
+                    self.dumps(pickall._Pickler, {2: 'b', 'a': 1}, protocol))
+                data = self.dumps(pickall._Pickler,
+                                  {'b': {1, 2.5}, 'a': frozenset('xy')},
+                                  protocol)
+                self.assertEqual(pickle.loads(data),
+                                 {'a': frozenset('xy'), 'b': {1, 2.5}})
+
+    def test_string_identity(self):
+        first, second = "".join(["sha", "red"]), "".join(["sha", "red"])
+        self.assertIsNot(first, second)
+        self.assertEqual(self.dumps(pickall._Pickler, [first, second]),
+                         self.dumps(pickall._Pickler, [first, first]))
+
+    def test_hash_seeds(self):
+        # Sets of strs iterate in a different order for each hash seed.
+        script = ("import sys, pickall, test;"
+                  "sys.stdout.write(pickall._dumps("
+                  "test._deterministic_example, -1, prune_globals=True,"
+                  "deterministic=True).hex())")
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output(
+                [sys.executable, '-c', script], env=env,
+                cwd=os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(len(outputs), 1)
+        new_func = pickle.loads(bytes.fromhex(outputs.pop().decode()))
+        self.assertEqual(new_func('a'), (True, False))
+        self.assertEqual(new_func('x'), (False, True))
+
+    def test_module_by_value(self):
+        # Without prune_globals, a __main__ function's globals are its module,
+        # which is pickled by value.
+        script = ("import sys, pickall\n"
+                  "def f(option):\n"
+                  "    return option in {'a', 'b'}, sys.maxsize > 0\n"
+                  "sys.stdout.write(pickall._dumps(f, -1,"
+                  "deterministic=True).hex())")
+        outputs = set()
+        for seed in ('1', '2', '3'):
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output(
+                [sys.executable, '-c', script], env=env,
+                cwd=os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(len(outputs), 1)
+        new_func = pickle.loads(bytes.fromhex(outputs.pop().decode()))
+        self.assertEqual(new_func('a'), (True, True))
+        self.assertIsNot(new_func.__globals__, vars(sys.modules['__main__']))
+
+    def test_code_cache(self):
+        self.assertRaises(ValueError, pickall._Pickler, io.BytesIO(),
+                          deterministic=True, code_cache=pickall.CodeCache())
+
+    def test_public(self):
+        # The accelerator can't do this, so _Pickler is used.
+        obj = [{'b': 1, 'a': {2.5, 'x'}}, list(range(2000))]
+        for kwargs in ({'deterministic': True},
+                       {'deterministic': True, 'frame_size': 1024}):
+            with self.subTest(**kwargs):
+                data = pickall.dumps(obj, 4, **kwargs)
+                self.assertEqual(data, pickall._dumps(obj, 4, **kwargs))
+                f = io.BytesIO()
+                pickall.dump(obj, f, 4, **kwargs)
+                self.assertEqual(f.getvalue(), data)
+                f = io.BytesIO()
+                pickall.Pickler(f, 4, **kwargs).dump(obj)
+                self.assertEqual(f.getvalue(), data)
+                self.assertEqual(pickle.loads(data), obj)
+
+def _archive_make(k):
+    def task(x):
+        return _archive_scale * x + k
+    return task
+
+_archive_scale = 3
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name + "/test.pickall"
+
+    def test_entries(self):
+        with pickall.Archive(self.path, 'w', prune_globals=True) as archive:
+            archive.add('task', _archive_make(1))
+            archive.add('data', [1, "two", 3.0])
+            self.assertRaises(ValueError, archive.add, 'data', None)
+        with pickall.Archive(self.path) as archive:
+            self.assertEqual(archive.names(), ['task', 'data'])
+            self.assertEqual(archive.load('task')(2), 7)
+            # Each entry is an ordinary pickle.
+            raw = archive.raw('data')
+            self.assertEqual(pickle.loads(raw), [1, "two", 3.0])
+            raw.release()
+            self.assertRaises(KeyError, archive.load, 'missing')
+            self.assertRaises(ValueError, archive.add, 'more', None)
+
+    def test_append(self):
+        for k in range(3):
+            with pickall.Archive(self.path, 'a') as archive:
+                archive.add(k, k * 10)
+        with pickall.Archive(self.path) as archive:
+            self.assertEqual([archive.load(k) for k in archive],
+                             [0, 10, 20])
+
+    def test_append_unclosed(self):
+        with pickall.Archive(self.path, 'w') as archive:
+            archive.add('first', 1)
+        archive = pickall.Archive(self.path, 'a')
+        self.addCleanup(archive.close)
+        archive.add('second', 2)
+        archive._file.flush()
+        # As if this process had crashed before closing the archive
+        with pickall.Archive(self.path) as reader:
+            self.assertEqual(reader.names(), ['first'])
+            self.assertEqual(reader.load('first'), 1)
+        archive.close()
+        with pickall.Archive(self.path) as reader:
+            self.assertEqual([reader.load(name) for name in reader], [1, 2])
+
+    def test_malformed_index(self):
+        with pickall.Archive(self.path, 'w') as archive:
+            archive.add('first', 1)
+        with open(self.path, 'r+b') as file:
+            file.seek(-4, io.SEEK_END)
+            file.write(b'\0\0\0\0')
+        self.assertRaises(pickle.UnpicklingError, pickall.Archive, self.path)
+        with open(self.path, 'r+b') as file:
+            file.seek(8)
+            file.write((1 << 40).to_bytes(8, 'little'))
+        self.assertRaises(pickle.UnpicklingError, pickall.Archive, self.path)
+
+    def test_dedupe(self):
+        sizes = []
+        for dedupe in (False, True):
+            with pickall.Archive(self.path, 'w', dedupe=dedupe,
+                                 prune_globals=True) as archive:
+                for k in range(20):
+                    archive.add(k, _archive_make(k))
+                code_records = len(archive._code)
+            sizes.append(os.path.getsize(self.path))
+        self.assertLess(sizes[1], sizes[0] * 0.75)
+        with pickall.Archive(self.path, 'a', dedupe=True) as archive:
+            archive.add('extra', _archive_make(20))
+            self.assertEqual(len(archive._code), code_records)
+        with pickall.Archive(self.path) as archive:
+            tasks = [archive.load(k) for k in range(20)]
+            tasks.append(archive.load('extra'))
+            self.assertEqual([task(1) for task in tasks],
+                             [3 + k for k in range(21)])
+            # The functions share their code and globals, like the module's.
+            self.assertIs(tasks[0].__code__, tasks[1].__code__)
+            self.assertIs(tasks[0].__globals__, tasks[20].__globals__)
+
+    def test_dedupe_namespaces(self):
+        # Namespaces that aren't modules' don't share globals.
+        functions = []
+        for x in (1, 2):
+            namespace = {'X': x}
+            exec("def f():\n    return X", namespace)
+            functions.append(namespace['f'])
+        with pickall.Archive(self.path, 'w', dedupe=True) as archive:
+            for k, f in enumerate(functions):
+                archive.add(k, f)
+        with pickall.Archive(self.path) as archive:
+            loaded = [archive.load(k) for k in range(2)]
+        self.assertEqual([f() for f in loaded], [1, 2])
+
+    def test_not_archive(self):
+        with open(self.path, 'wb') as file:
+            file.write(pickall.dumps(None))
+        self.assertRaises(pickle.UnpicklingError, pickall.Archive, self.path)
+
+class CompressionTestCase(unittest.TestCase):
+    def make_object(self):
+        numbers = list(range(50000))
+        def total():
+            return sum(numbers)
+        return total
+
+    def test_codecs(self):
+        obj = self.make_object()
+        uncompressed = len(pickall._dumps(obj, 4, prune_globals=True))
+        for codec in ('zlib', 'lzma', 'bz2'):
+            with self.subTest(codec=codec):
+                data = pickall.dumps_compressed(obj, 4, codec=codec,
+                                                frame_size=4096,
+                                                prune_globals=True)
+                self.assertLess(len(data), uncompressed)
+                self.assertEqual(pickall.loads_compressed(data)(),
+                                 obj())
+
+    def test_consecutive(self):
+        f = io.BytesIO()
+        pickall.dump_compressed("first", f, 4)
+        pickall.dump_compressed(["second"], f, 4, codec='lzma')
+        f.seek(0)
+        reader = pickall.CompressedReader(f)
+        self.assertEqual(pickle.Unpickler(reader).load(), "first")
+        self.assertEqual(pickle.Unpickler(reader).load(), ["second"])
+        self.assertRaises(EOFError, pickle.Unpickler(reader).load)
+
+    def test_load_consecutive(self):
+        f = io.BytesIO()
+        pickall.dump_compressed("first", f, 4)
+        pickall.dump_compressed(["second"], f, 4, frame_size=4)
+        f.seek(0)
+        self.assertEqual(pickall.load_compressed(f), "first")
+        self.assertEqual(pickall.load_compressed(f), ["second"])
+        self.assertEqual(f.read(), b"")
+
+    def test_register_codec(self):
+        self.addCleanup(pickall._codecs.pop, 'reversed')
+        pickall.register_codec('reversed', lambda data, level: data[::-1],
+                               lambda data: data[::-1])
+        data = pickall.dumps_compressed([1, 2, 3], 4, codec='reversed')
+        self.assertIn(b'reversed', data)
+        self.assertEqual(pickall.loads_compressed(data), [1, 2, 3])
+
+    def test_errors(self):
+        self.assertRaises(ValueError, pickall.dumps_compressed, 1, 3)
+        self.assertRaises(ValueError, pickall.dumps_compressed, 1, 4,
+                          codec='missing')
+        data = pickall.dumps_compressed(self.make_object(), 4,
+                                        prune_globals=True)
+        # Like a truncated pickle, this can raise either.
+        self.assertRaises((EOFError, pickle.UnpicklingError),
+                          pickall.loads_compressed, data[:len(data) // 2])
+        self.assertRaises(pickle.UnpicklingError, pickall.loads_compressed,
+                          pickle.dumps(1))
+
+_delta_scale = 2
+
+def _delta_make_handler():
+    total = 0
+    def handler(x):
+        nonlocal total
+        total += x
+        return total * _delta_scale
+    handler.options = {'name': 'handler', 'tags': ['tag'] * 50}
+    return handler
+
+class DeltaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.state = {
+            'tables': [list(range(k, k + 100)) for k in range(50)],
+            'handler': _delta_make_handler(),
+            'blob': bytes(range(256)) * 10,
+        }
+        self.loaded = pickle.loads(
+            pickall._dumps(self.state, 4, prune_globals=True))
+        self.sender = pickall.Snapshot(self.state)
+        self.receiver = pickall.Snapshot(self.loaded)
+
+    def round_trip(self):
+        delta = pickall.dumps_delta(self.state, self.sender, 4,
+                                    prune_globals=True)
+        return delta, pickall.loads_delta(delta, self.receiver)
+
+    def test_fingerprints_match(self):
+        self.assertEqual(self.sender.fingerprint, self.receiver.fingerprint)
+
+    def test_unchanged(self):
+        delta, new = self.round_trip()
+        self.assertLess(len(delta), 40)
+        self.assertIs(new, self.loaded)
+
+    def test_changed(self):
+        full = len(pickall._dumps(self.state, 4, prune_globals=True))
+        self.state['tables'][3] = "changed"
+        self.state['handler'](5)
+        self.state['handler'].options['name'] = "renamed"
+        delta, new = self.round_trip()
+        self.assertLess(len(delta), full / 4)
+        self.assertEqual(new['tables'][3], "changed")
+        self.assertIs(new['tables'][4], self.loaded['tables'][4])
+        self.assertIs(new['blob'], self.loaded['blob'])
+        self.assertEqual(new['handler'].options['name'], "renamed")
+        self.assertEqual(new['handler'](1), 12)
+        # The base is unchanged.
+        self.assertEqual(self.loaded['handler'](1), 2)
+
+    def test_equal_objects(self):
+        # Equal but distinct objects in the base stay distinct.
+        state = {'a': [0] * 100, 'b': [0] * 100, 'c': 'x'}
+        loaded = pickle.loads(pickall._dumps(state, 4))
+        sender, receiver = pickall.Snapshot(state), pickall.Snapshot(loaded)
+        state['c'] = 'y'
+        new = pickall.loads_delta(pickall.dumps_delta(state, sender, 4),
+                                  receiver)
+        self.assertEqual(new, state)
+        self.assertIs(new['a'], loaded['a'])
+        self.assertIs(new['b'], loaded['b'])
+        self.assertIsNot(new['a'], new['b'])
+
+    def test_missing(self):
+        delta = pickall.dumps_delta(self.state, self.sender, 4,
+                                    prune_globals=True)
+        self.assertRaises(pickle.UnpicklingError, pickall.loads_delta,
+                          delta, pickall.Snapshot(None))
+
+class _SharedBuffer:
+    """Pickled with a PickleBuffer, so that it's loaded without copying."""
+    def __init__(self, data):
+        self.data = data
+
+    def __reduce_ex__(self, protocol):
+        return _SharedBuffer, (pickle.PickleBuffer(self.data),)
+
+def _shared_load_length(handle):
+    return len(handle.load()[0])
+
+@unittest.skipIf(sys.version_info < (3, 8), "shared_memory needs 3.8+")
+class SharedTestCase(unittest.TestCase):
+    def make_object(self):
+        return [bytes(100000), _SharedBuffer(bytearray(b"abc" * 1000))]
+
+    def test_load(self):
+        with pickall.share(self.make_object()) as shared:
+            # The bytes are in-band, but in the segment.
+            self.assertEqual(len(shared.handle.buffers), 1)
+            data, buffer = shared.handle.load()
+            self.assertEqual(data, bytes(100000))
+            # The buffer is the segment's memory.
+            self.assertIsInstance(buffer.data, memoryview)
+            self.assertEqual(bytes(buffer.data[:3]), b"abc")
+            name = shared.handle.name
+            self.assertIn(name, pickall._attached_segments)
+            # Once it's not referred to, it's detached by the next load.
+            del buffer
+            with pickall.share(None) as other:
+                other.handle.load()
+            self.assertNotIn(name, pickall._attached_segments)
+        self.assertTrue(shared.closed)
+        self.assertRaises(FileNotFoundError, shared.handle.load)
+
+    def test_processes(self):
+        import multiprocessing
+        with pickall.share(self.make_object()) as shared:
+            with multiprocessing.Pool(2) as pool:
+                self.assertEqual(
+                    pool.map(_shared_load_length, [shared.handle] * 4),
+                    [100000] * 4)
+
+    def test_protocol(self):
+        self.assertRaises(ValueError, pickall.share, None, 4)
+
+def _generator_loop(n, *, step=1):
+    def scale(x):
+        return x * step
+    total = 0
+    for i in range(n):
+        total += scale(i)
+        yield total
+
+def _generator_try(log):
+    try:
+        yield 1
+        yield 2
+    except ValueError:
+        yield 'caught'
+    finally:
+        log.append('finally')
+
+@types.coroutine
+def _generator_suspend(value):
+    return (yield value)
+
+async def _generator_coroutine(a):
+    b = await _generator_suspend(a)
+    c = await _generator_suspend(a + b)
+    return c
+
+@unittest.skipIf(sys.implementation.name != 'cpython' or
+                 sys.version_info >= (3, 12), "needs CPython 3.6 to 3.11")
+class GeneratorTestCase(PicklerTestMixin, unittest.TestCase):
+    options = {'prune_globals': True}
+
+    def test_loop(self):
+        gen = _generator_loop(10, step=2)
+        for _ in range(3):
+            next(gen)
+        for copy in self.copy(gen):
+            self.assertEqual(list(copy), [12, 20, 30, 42, 56, 72, 90])
+        self.assertEqual(next(gen), 12)
+
+    def test_not_started(self):
+        for copy in self.copy(_generator_loop(3)):
+            self.assertEqual(list(copy), [0, 1, 3])
+
+    def test_exhausted(self):
+        gen = _generator_loop(3)
+        list(gen)
+        for copy in self.copy(gen):
+            self.assertEqual(list(copy), [])
+
+    def test_try(self):
+        log = []
+        gen = _generator_try(log)
+        next(gen)
+        for copy, copy_log in self.copy((gen, log)):
+            self.assertEqual(copy.throw(ValueError), 'caught')
+            self.assertEqual(copy_log, [])
+            self.assertEqual(list(copy), [])
+            self.assertEqual(copy_log, ['finally'])
+        for copy, copy_log in self.copy((gen, log)):
+            copy.close()
+            self.assertEqual(copy_log, ['finally'])
+        gen.close()
+
+    def test_coroutine(self):
+        coroutine = _generator_coroutine(1)
+        self.assertEqual(coroutine.send(None), 1)
+        for copy in self.copy(coroutine):
+            self.assertEqual(copy.send(2), 3)
+            with self.assertRaises(StopIteration) as cm:
+                copy.send(10)
+            self.assertEqual(cm.exception.value, 10)
+        coroutine.close()
+
+    def test_shared(self):
+        gen = _generator_loop(3)
+        next(gen)
+        for first, second in self.copy([gen, gen]):
+            self.assertIs(first, second)
+
+    def test_running(self):
+        def pickle_self():
+            yield pickall._dumps(gen)
+        gen = pickle_self()
+        self.assertRaises(pickle.PicklingError, next, gen)
+
+def _class_make():
+    class Base:
+        """Base's docstring"""
+        def __init__(self, x):
+            self.x = x
+
+        def describe(self):
+            return 'x={}'.format(self.x)
+
+    class Local(Base):
+        __slots__ = ('y', '__z')
+        instances = 0
+
+        def __init__(self, x, y=2):
+            super().__init__(x)
+            self.y = y
+            self.__z = 3
+
+        def describe(self):
+            return 'local ' + super().describe()
+
+        @classmethod
+        def make(cls, x):
+            return cls(x)
+
+        @staticmethod
+        def double(value):
+            return value * 2
+
+        @property
+        def total(self):
+            """x, y and z added up"""
+            return self.x + self.y + self.__z
+
+        @total.setter
+        def total(self, value):
+            self.y = value - self.x - self.__z
+    return Local
+
+class _ClassPlain:
+    def __init__(self, x):
+        self.x = x
+
+class _ClassState(_ClassPlain):
+    def __getstate__(self):
+        return {'x': -self.x}
+
+class ClassTestCase(PicklerTestMixin, unittest.TestCase):
+    options = {'prune_globals': True}
+
+    def test_local(self):
+        obj = _class_make().make(1)
+        for copy in self.copy(obj):
+            cls = type(copy)
+            self.assertIsNot(cls, type(obj))
+            self.assertEqual(cls.__qualname__, '_class_make.<locals>.Local')
+            self.assertEqual(cls.__bases__[0].__doc__, "Base's docstring")
+            self.assertEqual(copy.describe(), 'local x=1')
+            self.assertEqual(copy.total, 6)
+            copy.total = 10
+            self.assertEqual(copy.y, 6)
+            self.assertEqual(cls.double(2), 4)
+            self.assertEqual(cls.make(2).total, 7)
+            self.assertEqual(cls.total.__doc__, "x, y and z added up")
+            self.assertEqual(cls.__slots__, ('y', '__z'))
+
+    def test_dynamic(self):
+        cls = type('Dynamic', (), {'answer': lambda self: 42})
+        cls.default = cls()
+        for copy in self.copy(cls):
+            self.assertEqual(copy.default.answer(), 42)
+            self.assertIs(type(copy.default), copy)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "dataclasses needs 3.7+")
+    def test_dataclass(self):
+        import dataclasses
+        @dataclasses.dataclass
+        class Point:
+            x: int
+            y: int = dataclasses.field(default=0, metadata={'unit': 'm'})
+            tags: list = dataclasses.field(default_factory=list)
+        for copy in self.copy(Point):
+            self.assertEqual(repr(copy(1, 2)), repr(Point(1, 2)))
+            self.assertEqual(copy(1), copy(1, 0))
+            self.assertEqual(dataclasses.fields(copy)[1].metadata['unit'],
+                             'm')
+
+    def test_abc(self):
+        import abc
+        class Shape(abc.ABC):
+            @abc.abstractmethod
+            def area(self):
+                pass
+        class Square(Shape):
+            def area(self):
+                return 4
+        for copy in self.copy(Square):
+            base = copy.__bases__[0]
+            self.assertIs(type(copy), abc.ABCMeta)
+            self.assertEqual(copy().area(), 4)
+            self.assertTrue(issubclass(copy, base))
+            self.assertRaises(TypeError, base)
+
+    def test_by_reference(self):
+        for copy in self.copy(_ClassPlain):
+            self.assertIs(copy, _ClassPlain)
+
+    def test_template(self):
+        objects = [_ClassPlain(i) for i in range(3)] + [_ClassState(4)]
+        for protocol in range(2, pickle.HIGHEST_PROTOCOL + 1):
+            with self.subTest(protocol=protocol):
+                f = io.BytesIO()
+                pickler = pickall._Pickler(f, protocol)
+                pickler.dump(objects)
+                self.assertIs(pickler._plans[_ClassPlain],
+                              pickall._Pickler._save_plain_instance)
+                self.assertIs(pickler._plans[_ClassState],
+                              pickall._Pickler._save_reduce_ex)
+                self.assertEqual(f.getvalue(),
+                                 pickle._dumps(objects, protocol))
+
+_module_source = """
+import json
+
+counter = 0
+
+def bump():
+    global counter
+    counter += 1
+    return json.dumps(counter)
+"""
+
+class ModuleTestCase(PicklerTestMixin, unittest.TestCase):
+    def setUp(self):
+        # Made at runtime, so it can't be imported
+        self.module = types.ModuleType('_pickall_test_module')
+        exec(_module_source, vars(self.module))
+        sys.modules[self.module.__name__] = self.module
+        self.addCleanup(sys.modules.pop, self.module.__name__)
+
+    def test_importable_globals(self):
+        # Under the default policy, an importable module's functions have
+        # their globals copied, so they load where it can't be imported.
+        import importlib
+        import tempfile
+        name = '_pickall_test_importable'
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, name + '.py'), 'w') as file:
+                file.write(_module_source)
+            sys.path.insert(0, path)
+            self.addCleanup(sys.modules.pop, name, None)
+            try:
+                importlib.invalidate_caches()
+                module = importlib.import_module(name)
+            finally:
+                sys.path.remove(path)
+            data = [dumps(module.bump) for dumps in self.dumps_functions]
+        del sys.modules[name]
+        for pickled in data:
+            bump = pickle.loads(pickled)
+            self.assertEqual(bump(), '1')
+            self.assertIsNot(bump.__globals__, vars(module))
+        self.assertEqual(module.counter, 0)
+
+    def test_by_reference(self):
+        import json
+        for copy in self.copy([json, self.module.bump],
+                              module_policy='reference'):
+            self.assertIs(copy[0], json)
+            self.assertIs(copy[1].__globals__, vars(self.module))
+
+    def test_by_value(self):
+        obj = [self.module.bump, self.module, self.module.bump]
+        for bump, module, same in self.copy(obj):
+            self.assertIsNot(module, self.module)
+            self.assertIs(bump, same)
+            self.assertIs(bump.__globals__, vars(module))
+            self.assertIs(module.json, sys.modules['json'])
+            self.assertEqual(bump(), '1')
+            self.assertEqual(module.counter, 1)
+            self.assertEqual(self.module.counter, 0)
+
+    def test_shared(self):
+        # Functions from one module, loaded separately, share their globals.
+        for dumps in self.dumps_functions:
+            with self.subTest(dumps=dumps):
+                first = pickle.loads(dumps(self.module.bump))
+                second = pickle.loads(dumps(self.module.bump))
+                self.assertIs(first.__globals__, second.__globals__)
+
+    def test_policy(self):
+        import json
+        import string
+        policy = lambda module: 'value' if module is string else 'reference'
+        for copy in self.copy([string, self.module], module_policy=policy):
+            self.assertIsNot(copy[0], string)
+            self.assertEqual(copy[0].capwords('by value'), 'By Value')
+            self.assertIs(copy[1], self.module)
+        for dumps in self.dumps_functions:
+            self.assertRaises(ValueError, dumps, json, module_policy='copy')
+            self.assertRaises(ValueError, dumps, json,
+                              module_policy=lambda module: None)
+
 # Undocumented
 class _duplicateTestCase(unittest.TestCase):
     def test_optional_kwonly(self):